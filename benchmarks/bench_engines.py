@@ -0,0 +1,110 @@
+"""
+Benchmark cases for every simulation engine
+
+Each case is a function that takes the case parameters, runs one simulation
+and returns (work, unit) where work is the number of work units done, e.g.
+agent-steps for agent engines or right hand side evaluations for ODE solvers.
+CASES maps the case name to the function and to the parameter grid of each
+preset, which benchmarks/run.py expands into individual runs. Runs of a
+case with a workers parameter are also reported as speedups over one worker.
+warm_up is called before the timed run so that the deferred imports of the
+engines are not counted as part of it.
+"""
+import importlib
+
+import numpy as np
+
+from sir.profiling import Profiler
+from sir.odeSim import odeSim
+from sir import discreteSim
+from sir.discreteSim_spatial import discrete_spatial_simulation
+from sir.variation_2 import runSimulation
+from sir import varsim_tori
+from sir.odeSim_spatial import odeSim_spatial
+from sir.domain import decomposed_simulation
+from sir.backend import get_backend
+
+# Modules the engines import on first use
+PRELOAD = ('scipy.integrate', 'scipy.sparse', 'scipy.spatial')
+
+
+def warm_up():
+    """
+    Imports the modules of PRELOAD and loads the agent kernels of the default backend
+    """
+    for module in PRELOAD:
+        importlib.import_module(module)
+    get_backend('auto')
+
+
+def bench_solve_odes(t):
+    profiler = Profiler(steps=False)
+    odeSim(1000, 0.5, 1/3, t).solve_odes(profiler=profiler)
+    return profiler.rhs_calls, 'rhs_evals'
+
+
+def bench_simulateSIR(n, t):
+    discreteSim.simulateSIR(n, 2, 0.3, t)
+    return n * t, 'agent_steps'
+
+
+def bench_discrete_spatial_simulation(n, t):
+    # Radius chosen so that b = n * pi * q**2 = 2 for every population size
+    q = np.sqrt(2 / (np.pi * n))
+    discrete_spatial_simulation(0.1, q, 0.03, n, t, position='Random', num_initial_infected=10)
+    return n * t, 'agent_steps'
+
+
+def bench_runSimulation(n, t):
+    q = np.sqrt(2 / (np.pi * n))
+    runSimulation(0.1, q, p=0.03, n=n, t=t)
+    return n * t, 'agent_steps'
+
+
+def bench_varsim_tori(n, t):
+    varsim_tori.simulateSIR(n, 2, 0.1, 0.5, 0.5, t)
+    return n * t, 'agent_steps'
+
+
+def bench_decomposed_simulation(n, t, workers):
+    q = np.sqrt(2 / (np.pi * n))
+    decomposed_simulation(0.1, q, 0.03, n, t, position='Random', num_initial_infected=10, workers=workers)
+    return n * t, 'agent_steps'
+
+
+def bench_solve_pdes(M, t):
+    profiler = Profiler(steps=False)
+    odeSim_spatial(b=1, k=0.3, p=0.6, t=t, M=M, initial_position='center').solve_pdes(profiler=profiler)
+    return profiler.rhs_calls, 'rhs_evals'
+
+
+CASES = {
+    'odeSim.solve_odes': (bench_solve_odes, {
+        'quick': {'t': [500, 5000]},
+        'full': {'t': [500, 5000, 50000]},
+    }),
+    'discreteSim.simulateSIR': (bench_simulateSIR, {
+        'quick': {'n': [1000, 3000], 't': [20]},
+        'full': {'n': [1000, 5000, 20000], 't': [50, 200]},
+    }),
+    'discreteSim_spatial.discrete_spatial_simulation': (bench_discrete_spatial_simulation, {
+        'quick': {'n': [2000, 5000], 't': [20]},
+        'full': {'n': [2000, 20000, 100000], 't': [50, 200]},
+    }),
+    'variation_2.runSimulation': (bench_runSimulation, {
+        'quick': {'n': [1000, 3000], 't': [20]},
+        'full': {'n': [2000, 20000], 't': [50, 100]},
+    }),
+    'varsim_tori.simulateSIR': (bench_varsim_tori, {
+        'quick': {'n': [1000, 3000], 't': [20]},
+        'full': {'n': [1000, 5000], 't': [50, 200]},
+    }),
+    'domain.decomposed_simulation': (bench_decomposed_simulation, {
+        'quick': {'n': [50000], 't': [20], 'workers': [1, 2, 4]},
+        'full': {'n': [200000, 1000000], 't': [50], 'workers': [1, 2, 4, 8]},
+    }),
+    'odeSim_spatial.solve_pdes': (bench_solve_pdes, {
+        'quick': {'M': [50, 100], 't': [50]},
+        'full': {'M': [50, 100, 200], 't': [100, 400]},
+    }),
+}
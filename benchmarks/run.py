@@ -0,0 +1,189 @@
+"""
+Benchmark runner for the simulation engines
+
+Usage (from the repository root):
+    python benchmarks/run.py                      # run the quick preset and compare to baseline.json
+    python benchmarks/run.py --preset full        # larger populations, grids and horizons
+    python benchmarks/run.py --save               # store the results as the new baseline
+    python benchmarks/run.py --only solve_pdes    # only cases whose name contains the string
+    python benchmarks/run.py --imports            # also report the import time of the package
+
+Every run is executed in a fresh process so that the reported peak RSS belongs
+to that run alone; the deferred imports of the engines are done before the
+clock starts. For each run the wall time (best of --repeat), peak RSS and
+throughput (agent-steps/s or RHS evals/s) are recorded. A run is reported as a
+regression when its wall time exceeds the baseline by more than --tolerance,
+and the runner then exits with status 1. Runs whose baseline is shorter than
+--min-time are too noisy to compare and are skipped. For cases with a workers
+parameter, e.g. the domain decomposed simulation, the speedup over one worker
+and the parallel efficiency (speedup / workers) are reported as well.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+
+def expand(grid):
+    """
+    Expands a dictionary of parameter lists into a list of parameter dictionaries
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def run_key(name, params):
+    """
+    Returns the key of one run, e.g. 'odeSim_spatial.solve_pdes[M=50,t=20]'
+    """
+    return name + '[' + ','.join(f'{key}={value}' for key, value in sorted(params.items())) + ']'
+
+
+def _child(name, params, seed, queue):
+    """
+    Runs one case in a child process and puts its measurements on the queue
+    """
+    import numpy as np
+    from bench_engines import CASES, warm_up
+    from sir.profiling import peak_rss
+
+    warm_up()
+    np.random.seed(seed)
+    fn = CASES[name][0]
+    start = time.perf_counter()
+    work, unit = fn(**params)
+    wall = time.perf_counter() - start
+    queue.put({'wall_time': wall, 'work': work, 'unit': unit, 'peak_rss_kb': peak_rss()})
+
+
+def measure(name, params, repeat=1, seed=0):
+    """
+    Runs one case repeat times, each in a fresh process, and returns the best run
+    """
+    ctx = multiprocessing.get_context('spawn')
+    best = None
+    for r in range(repeat):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_child, args=(name, params, seed, queue))
+        proc.start()
+        result = queue.get()
+        proc.join()
+        if best is None or result['wall_time'] < best['wall_time']:
+            best = result
+
+    best['throughput'] = best['work'] / best['wall_time']
+    return best
+
+
+def scaling(runs, results):
+    """
+    Adds the speedup over the run with one worker and otherwise the same
+    parameters to every run of a case with a workers parameter, and returns
+    the list of (key, workers, speedup) of those runs
+    """
+    speedups = []
+    for name, params, key in runs:
+        if params.get('workers', 1) == 1:
+            continue
+        serial = run_key(name, dict(params, workers=1))
+        if serial in results:
+            speedup = results[serial]['wall_time'] / results[key]['wall_time']
+            results[key]['speedup'] = speedup
+            speedups.append((key, params['workers'], speedup))
+    return speedups
+
+
+def compare(results, baseline, tolerance, min_time=0.0):
+    """
+    Returns the list of (key, ratio) of runs slower than the baseline by more than tolerance
+    """
+    regressions = []
+    for key, result in results.items():
+        if key in baseline and baseline[key]['wall_time'] >= min_time:
+            ratio = result['wall_time'] / baseline[key]['wall_time']
+            result['baseline_ratio'] = ratio
+            if ratio > 1 + tolerance:
+                regressions.append((key, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the SIR simulation engines')
+    parser.add_argument('--preset', default='quick', choices=['quick', 'full'])
+    parser.add_argument('--only', default=None, help='only run cases whose name contains this string')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative slowdown before a run counts as a regression')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='skip the comparison for runs whose baseline is shorter than this (seconds)')
+    parser.add_argument('--save', action='store_true', help='write the results to the baseline file')
+    parser.add_argument('--output', default=None, help='also write the results to this JSON file')
+    parser.add_argument('--imports', action='store_true',
+                        help='also report the import time of the package with python -X importtime')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, BENCH_DIR)
+    from bench_engines import CASES
+
+    if args.imports:
+        from sir.profiling import import_times
+        times = import_times(['sir', 'sir.engines'])
+        for module in ('sir', 'sir.engines'):
+            print(f"{'import ' + module:70s} {times[module]:9.3f} s")
+        print(f"{'scipy imported':70s} {any(name.startswith('scipy') for name in times)}")
+
+    results = {}
+    runs = []
+    for name, (fn, presets) in CASES.items():
+        if args.only is not None and args.only not in name:
+            continue
+        for params in expand(presets[args.preset]):
+            key = run_key(name, params)
+            runs.append((name, params, key))
+            results[key] = measure(name, params, args.repeat)
+            res = results[key]
+            print(f"{key:70s} {res['wall_time']:9.3f} s  {res['throughput']:12.4g} {res['unit']}/s  "
+                  f"{res['peak_rss_kb']} kB")
+
+    for key, workers, speedup in scaling(runs, results):
+        print(f"SCALING {key}: {speedup:.2f}x one worker, {100 * speedup / workers:.0f}% parallel efficiency")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save to create one')
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.tolerance, args.min_time)
+    for key, ratio in regressions:
+        print(f'REGRESSION {key}: {ratio:.2f}x baseline wall time')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,7 +6,9 @@ import setuptools
 
 this_dir = os.path.dirname(os.path.realpath(__file__))
 
-__version__ = '0.0.0'
+# The version is defined once in sir/__init__.py (it is part of the result cache keys)
+with open(os.path.join(this_dir, 'sir', '__init__.py')) as f:
+    __version__ = [line.split("'")[1] for line in f if line.startswith('__version__')][0]
 
 
 setup(
@@ -19,6 +21,7 @@ setup(
     python_requires='>=3.6',
     packages=['sir'],
     zip_safe=True,
+    entry_points={'console_scripts': ['sir=sir.cli:main']},
     install_requires=['numpy', 'scipy','matplotlib', 'pandas']
 
 )
@@ -1,5 +1,24 @@
-from . import odeSim
-from . import discreteSim
-from . import odeSim_spatial
-from . import discreteSim_spatial
-from . import variation_2
\ No newline at end of file
+__version__ = '0.0.0'
+
+import importlib
+
+# Submodules are imported on first attribute access (sir.odeSim, ...), so that
+# `import sir` stays cheap for the many short jobs of a batch run. SciPy is in
+# turn only imported by the functions that use it.
+SUBMODULES = ('odeSim', 'discreteSim', 'odeSim_spatial', 'discreteSim_spatial', 'variation_2',
+              'varsim_tori', 'population', 'profiling', 'engines', 'cache', 'phase_diagram',
+              'fitting', 'covid_data', 'metapopulation', 'network', 'backend', 'domain',
+              'transport', 'initial_conditions', 'coupling', 'cli', 'checkpoint', 'service',
+              'sensitivity', 'emulator', 'inference')
+
+__all__ = list(SUBMODULES)
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
@@ -0,0 +1,133 @@
+"""
+Numba kernels of sir.backend.NumbaBackend
+
+This module imports Numba, so it is only imported when a NumbaBackend is
+created. The kernels give the same results as the NumPy kernels of
+sir.backend for the same random numbers.
+"""
+import numba
+import numpy as np
+
+from sir.backend import _S, _I, _R
+
+
+@numba.njit(parallel=True, cache=True)
+def move(pos, directions, p, periodic, moving):
+    for a in numba.prange(pos.shape[0]):
+        if not moving[a]:
+            continue
+        x = pos[a, 0] + directions[a, 0] * p
+        y = pos[a, 1] + directions[a, 1] * p
+        if periodic:
+            x = x % 1.0
+            y = y % 1.0
+            if x >= 1.0:
+                x = 0.0
+            if y >= 1.0:
+                y = 0.0
+        elif not (0 <= x <= 1 and 0 <= y <= 1):
+            continue
+        pos[a, 0] = x
+        pos[a, 1] = y
+
+@numba.njit(cache=True)
+def cell_list(pos, m):
+    # Counting sort of the agents by cell, stable like np.argsort(kind='stable')
+    n = pos.shape[0]
+    cells = np.empty(n, dtype=np.int64)
+    start = np.zeros(m * m + 1, dtype=np.int64)
+    for a in range(n):
+        cx = min(int(pos[a, 0] * m), m - 1)
+        cy = min(int(pos[a, 1] * m), m - 1)
+        cells[a] = cx * m + cy
+        start[cells[a] + 1] += 1
+    for c in range(m * m):
+        start[c + 1] += start[c]
+    fill = start[:-1].copy()
+    order = np.empty(n, dtype=np.int64)
+    for a in range(n):
+        order[fill[cells[a]]] = a
+        fill[cells[a]] += 1
+    return order, start
+
+@numba.njit(parallel=True, cache=True)
+def infect(pos, states, infected, order, start, m, q, periodic):
+    hit = np.zeros(pos.shape[0], dtype=np.bool_)
+    for j in numba.prange(infected.shape[0]):
+        a = infected[j]
+        cx = min(int(pos[a, 0] * m), m - 1)
+        cy = min(int(pos[a, 1] * m), m - 1)
+        for dx in range(-1, 2):
+            for dy in range(-1, 2):
+                nx = cx + dx
+                ny = cy + dy
+                if periodic:
+                    nx %= m
+                    ny %= m
+                elif nx < 0 or nx >= m or ny < 0 or ny >= m:
+                    continue
+                c = nx * m + ny
+                for s in range(start[c], start[c + 1]):
+                    b = order[s]
+                    if states[b] != _S:
+                        continue
+                    ddx = pos[b, 0] - pos[a, 0]
+                    ddy = pos[b, 1] - pos[a, 1]
+                    if periodic:
+                        ddx -= np.round(ddx)
+                        ddy -= np.round(ddy)
+                    # Concurrent writes all store True, so no atomics are needed
+                    if ddx * ddx + ddy * ddy <= q * q:
+                        hit[b] = True
+    return hit
+
+@numba.njit(cache=True)
+def infect_sequential(pos, states, active, order, start, m, q, periodic):
+    # A plain loop in index order: agents infected by a lower index are visited later in the same loop
+    hit = np.zeros(pos.shape[0], dtype=np.bool_)
+    visited = np.empty(pos.shape[0], dtype=np.intp)
+    count = 0
+    for a in range(pos.shape[0]):
+        if states[a] != _I:
+            continue
+        visited[count] = a
+        count += 1
+        if not active[a]:
+            continue
+        cx = min(int(pos[a, 0] * m), m - 1)
+        cy = min(int(pos[a, 1] * m), m - 1)
+        for dx in range(-1, 2):
+            for dy in range(-1, 2):
+                nx = cx + dx
+                ny = cy + dy
+                if periodic:
+                    # With fewer than 3 cells per side a cell can come up twice,
+                    # but its agents are no longer susceptible the second time
+                    nx %= m
+                    ny %= m
+                elif nx < 0 or nx >= m or ny < 0 or ny >= m:
+                    continue
+                c = nx * m + ny
+                for s in range(start[c], start[c + 1]):
+                    b = order[s]
+                    if states[b] != _S or not active[b]:
+                        continue
+                    ddx = pos[b, 0] - pos[a, 0]
+                    ddy = pos[b, 1] - pos[a, 1]
+                    if periodic:
+                        ddx -= np.round(ddx)
+                        ddy -= np.round(ddy)
+                    if ddx * ddx + ddy * ddy <= q * q:
+                        states[b] = _I
+                        hit[b] = True
+    return hit, visited[:count]
+
+
+@numba.njit(parallel=True, cache=True)
+def recover(states, infected, draws, k):
+    recovers = np.zeros(infected.shape[0], dtype=np.bool_)
+    for j in numba.prange(infected.shape[0]):
+        if draws[j] < k:
+            states[infected[j]] = _R
+            recovers[j] = True
+    return recovers
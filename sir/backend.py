@@ -0,0 +1,247 @@
+"""
+Agent kernels of the array based spatial simulations
+
+The kernels cover movement, cell list neighbour search, synchronous and
+sequential infection and recovery for sir.discreteSim_spatial, and with the
+masks of agents that stay put or keep out of contacts, the quarantine and
+social distancing of sir.variation_2.
+"""
+import heapq
+import importlib.util
+
+import numpy as np
+
+# Numba is optional, the NumPy kernels are used when it is not installed. It is
+# only looked up here; sir._numba_kernels imports it and compiles the kernels
+# when the first NumbaBackend is created, since that takes far longer than
+# importing the package
+HAVE_NUMBA = importlib.util.find_spec('numba') is not None
+
+# State codes of sir.population.STATE_CODES
+_S, _I, _R = 0, 1, 2
+
+
+def cell_count(q):
+    """
+    Returns the number of cells per side of a cell list of the unit square
+    with cells no smaller than the radius of infection q, so that every contact
+    of an agent lies in its own cell or one of the 8 neighbouring cells
+    """
+    return max(1, int(1 / q))
+
+
+class NumpyBackend():
+    """
+    Agent kernels of the array based spatial simulation written with NumPy
+
+    All random numbers are drawn by the caller from np.random and passed in, so
+    every backend gives the same result for the same seed.
+    """
+
+    name = 'numpy'
+
+    def move(self, pos, directions, p, periodic, moving=None):
+        """
+        Moves the agents in place by a step of length p along the unit directions
+        Input:
+            pos(array): (n, 2) positions in the unit square
+            directions(array): (n, 2) unit vectors
+            p(float): step size
+            periodic(bool): wrap around the unit square instead of rejecting moves that leave it
+            moving(array): optional boolean mask of the agents that move, e.g. not quarantined
+        """
+        new = pos + directions * p
+        if periodic:
+            new = np.mod(new, 1.0)
+            new[new >= 1.0] = 0.0
+            accept = np.ones(len(pos), dtype=bool)
+        else:
+            accept = np.all((new >= 0) & (new <= 1), axis=1)
+        if moving is not None:
+            accept &= moving
+        pos[accept] = new[accept]
+
+    def cell_list(self, pos, m):
+        """
+        Sorts the agents by cell of an m x m cell list
+        Return:
+            order(array): agent indices sorted by cell
+            start(array): agents of cell c are order[start[c]:start[c + 1]]
+        """
+        cells = self._cells(pos, m)
+        order = np.argsort(cells[:, 0] * m + cells[:, 1], kind='stable')
+        start = np.zeros(m * m + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells[:, 0] * m + cells[:, 1], minlength=m * m), out=start[1:])
+        return order, start
+
+    def _cells(self, pos, m):
+        return np.minimum((pos * m).astype(np.int64), m - 1)
+
+    def infect(self, pos, states, q, periodic):
+        """
+        Synchronous infection step: every susceptible agent within distance q of
+        an agent infected at the start of the step becomes infected
+        Return:
+            Sorted indices of the newly infected agents (states is updated in place)
+        """
+        infected = np.flatnonzero(states == _I)
+        m = cell_count(q)
+        order, start = self.cell_list(pos, m)
+        cells = self._cells(pos[infected], m)
+
+        hits = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                nx = cells[:, 0] + dx
+                ny = cells[:, 1] + dy
+                if periodic:
+                    nx %= m
+                    ny %= m
+                    valid = np.ones(len(infected), dtype=bool)
+                else:
+                    valid = (nx >= 0) & (nx < m) & (ny >= 0) & (ny < m)
+                c = nx[valid] * m + ny[valid]
+
+                # Every agent of the neighbouring cell of every infected agent
+                lengths = start[c + 1] - start[c]
+                source = np.repeat(infected[valid], lengths)
+                offsets = np.repeat(start[c] - (np.cumsum(lengths) - lengths), lengths)
+                target = order[offsets + np.arange(len(offsets))]
+
+                keep = states[target] == _S
+                source, target = source[keep], target[keep]
+                d = pos[target] - pos[source]
+                if periodic:
+                    d -= np.round(d)
+                hits.append(target[d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1] <= q * q])
+
+        new_infected = np.unique(np.concatenate(hits))
+        states[new_infected] = _I
+        return new_infected
+
+    def infect_sequential(self, pos, states, q, periodic, active=None):
+        """
+        Sequential infection step: the agents are visited in index order and
+        every agent that is infected when it is visited at once infects the
+        susceptible agents within distance q, so agents infected by an agent
+        with a lower index infect others on the same day
+        Input:
+            active(array): optional boolean mask of the agents that take part
+                in contacts, e.g. not social distancing; the others neither
+                infect nor get infected
+        Return:
+            Sorted indices of the newly infected agents and the indices of the
+            visited agents in visiting order, which draw for recovery in that
+            order (states is updated in place)
+        """
+        m = cell_count(q)
+        order, start = self.cell_list(pos, m)
+        cells = self._cells(pos, m)
+
+        # Heap of the infected agents still to visit, as in PopulationState.scan
+        heap = list(np.flatnonzero(states == _I))
+        visited = []
+        new_infected = []
+        while heap:
+            a = heapq.heappop(heap)
+            if visited and a <= visited[-1]:
+                continue
+            visited.append(a)
+            if active is not None and not active[a]:
+                continue
+
+            nx = (cells[a, 0] + np.array([-1, 0, 1]))
+            ny = (cells[a, 1] + np.array([-1, 0, 1]))
+            if periodic:
+                nx, ny = np.unique(nx % m), np.unique(ny % m)
+            else:
+                nx, ny = nx[(nx >= 0) & (nx < m)], ny[(ny >= 0) & (ny < m)]
+            c = (nx[:, None] * m + ny[None, :]).ravel()
+            target = np.concatenate([order[start[cell]:start[cell + 1]] for cell in c])
+
+            keep = states[target] == _S
+            if active is not None:
+                keep &= active[target]
+            target = target[keep]
+            d = pos[target] - pos[a]
+            if periodic:
+                d -= np.round(d)
+            hits = target[d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1] <= q * q]
+
+            states[hits] = _I
+            new_infected.append(hits)
+            for b in hits[hits > a]:
+                heapq.heappush(heap, b)
+
+        new_infected = np.sort(np.concatenate(new_infected)) if new_infected else np.empty(0, dtype=np.intp)
+        return new_infected, np.array(visited, dtype=np.intp)
+
+    def recover(self, states, infected, draws, k):
+        """
+        Every agent of infected recovers when its uniform draw is below k
+        Return:
+            Indices of the recovered agents (states is updated in place)
+        """
+        recovered = infected[draws < k]
+        states[recovered] = _R
+        return recovered
+
+
+class NumbaBackend(NumpyBackend):
+    """
+    Agent kernels compiled with Numba, with parallel loops over the agents
+    except for the sequential infection, which is one loop in index order
+
+    Gives the same results as NumpyBackend for the same random numbers.
+    """
+
+    name = 'numba'
+
+    def __init__(self):
+        from sir import _numba_kernels
+        self.kernels = _numba_kernels
+
+    def move(self, pos, directions, p, periodic, moving=None):
+        if moving is None:
+            moving = np.ones(len(pos), dtype=bool)
+        self.kernels.move(pos, directions, p, periodic, moving)
+
+    def cell_list(self, pos, m):
+        return self.kernels.cell_list(pos, m)
+
+    def infect(self, pos, states, q, periodic):
+        infected = np.flatnonzero(states == _I)
+        m = cell_count(q)
+        order, start = self.kernels.cell_list(pos, m)
+        hit = self.kernels.infect(pos, states, infected, order, start, m, q, periodic)
+        new_infected = np.flatnonzero(hit)
+        states[new_infected] = _I
+        return new_infected
+
+    def infect_sequential(self, pos, states, q, periodic, active=None):
+        if active is None:
+            active = np.ones(len(pos), dtype=bool)
+        m = cell_count(q)
+        order, start = self.kernels.cell_list(pos, m)
+        hit, visited = self.kernels.infect_sequential(pos, states, active, order, start, m, q, periodic)
+        return np.flatnonzero(hit), visited
+
+    def recover(self, states, infected, draws, k):
+        return infected[self.kernels.recover(states, infected, draws, k)]
+
+
+def get_backend(name='auto'):
+    """
+    Returns the agent kernels called name
+    Input:
+        name(str): 'numpy', 'numba', or 'auto' for Numba when it is installed and NumPy otherwise
+    """
+    if name == 'auto':
+        name = 'numba' if HAVE_NUMBA else 'numpy'
+    if name == 'numpy':
+        return NumpyBackend()
+    if name == 'numba':
+        if not HAVE_NUMBA:
+            raise ImportError("the 'numba' backend needs numba to be installed")
+        return NumbaBackend()
+    raise ValueError(f'unknown backend {name!r}, expected one of numpy, numba, auto')
@@ -0,0 +1,206 @@
+import collections
+import functools
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import sir
+
+DEFAULT_CACHE_DIR = os.environ.get('SIR_CACHE_DIR',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'sir'))
+
+
+def result_key(engine, params, seed=None):
+    """
+    Returns the content address of one run: a hash of the engine name and
+    version, the package version, the normalized parameters and the seed
+
+    Arguments:
+        engine - sir.engines.Engine
+        params - Dictionary of keyword arguments of the engine's entry point
+        seed - Random seed of the run, ignored for deterministic engines
+    """
+    record = {'engine': engine.name,
+              'engine_version': engine.version,
+              'package_version': sir.__version__,
+              'params': engine.normalize(params),
+              'seed': seed if engine.stochastic else None}
+    text = json.dumps(record, sort_keys=True, default=_json_default)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _json_default(value):
+    """
+    Makes numpy scalars and arrays hashable as JSON
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'cannot hash parameter value {value!r}')
+
+
+def save_npz(filename, arrays, compressed=True):
+    """
+    Writes a dictionary of arrays to an .npz file atomically: the arrays are
+    written to a temporary file in the same directory first, which then
+    replaces filename, so that readers never see a partial file
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            (np.savez_compressed if compressed else np.savez)(f, **arrays)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class ResultCache():
+    """
+    Content addressed cache of simulation results
+
+    Results are dictionaries of arrays (e.g. S, I, R or the mean s, i, r of a PDE
+    run). They are kept in an in-memory LRU tier in front of an on-disk tier of
+    compressed .npz files whose total size is bounded; the least recently used
+    files are evicted first.
+
+    Stochastic runs are only cached when a seed is given, since otherwise two
+    runs with the same parameters are not expected to be equal.
+
+    Optional Arguments:
+        path - Directory of the disk tier, None for a memory only cache
+            (default $SIR_CACHE_DIR or ~/.cache/sir)
+        max_bytes - Size bound of the disk tier (default 1 GB)
+        memory_items - Number of results kept in memory (default 128)
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_bytes=2**30, memory_items=128):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns the cached result for key, or None if there is none
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        if self.path is None:
+            return None
+
+        filename = self._file(key)
+        try:
+            with np.load(filename) as data:
+                result = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+
+        # Touch the file so that eviction sees it as recently used
+        os.utime(filename)
+        self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+        """
+        Stores result (a dictionary of arrays) under key in both tiers and
+        returns the stored copy, whose arrays are read only
+        """
+        result = {name: np.array(value) for name, value in result.items()}
+        self._remember(key, result)
+
+        if self.path is not None:
+            save_npz(self._file(key), result)
+            self.evict()
+        return result
+
+    def _remember(self, key, result):
+        # Cached arrays are shared between callers, so they are made read only
+        for value in result.values():
+            value.setflags(write=False)
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def evict(self):
+        """
+        Deletes the least recently used files until the disk tier fits in max_bytes
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        for mtime, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(filename)
+            total -= size
+
+    def clear(self):
+        """
+        Removes every cached result from both tiers
+        """
+        self.memory.clear()
+        if self.path is not None:
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.npz'):
+                    os.remove(entry.path)
+
+    def run(self, engine, params, seed=None):
+        """
+        Returns the result of engine (a sir.engines.Engine) for params and seed,
+        running it only if it is not cached yet
+        """
+        if engine.stochastic and seed is None:
+            return engine.run(params, seed)
+
+        key = result_key(engine, params, seed)
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = engine.run(engine.normalize(params), seed)
+        # The memory tier may not keep it, e.g. with memory_items=0
+        return self.put(key, result)
+
+    def wrap(self, name):
+        """
+        Returns a function with the same arguments as the entry point of the
+        engine called name, plus a seed keyword, that goes through the cache and
+        returns the outputs as a tuple of arrays like the entry point does
+
+        Example:
+            simulateSIR = cache.wrap('discreteSim')
+            S, I, R = simulateSIR(1000, 2, 0.3, 100, seed=1)
+        """
+        from sir.engines import get_engine
+        engine = get_engine(name)
+
+        @functools.wraps(engine.fn)
+        def cached(*args, seed=None, **kwargs):
+            params = engine.signature.bind(*args, **kwargs).arguments
+            result = self.run(engine, dict(params), seed)
+            return tuple(result[output] for output in engine.outputs)
+
+        return cached
@@ -0,0 +1,227 @@
+import json
+import time
+
+import numpy as np
+
+from sir.backend import get_backend
+from sir.cache import save_npz
+from sir.discreteSim_spatial import array_step, initial_agents
+from sir.profiling import NULL_PROFILER
+
+
+def rng_state():
+    """
+    Returns the state of numpy's global random generator as a dictionary of arrays
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {'rng_name': np.asarray(name), 'rng_keys': keys, 'rng_pos': np.asarray(pos),
+            'rng_has_gauss': np.asarray(has_gauss), 'rng_cached_gaussian': np.asarray(cached_gaussian)}
+
+
+def restore_rng(checkpoint):
+    """
+    Sets numpy's global random generator to the state stored by rng_state
+    """
+    np.random.set_state((str(checkpoint['rng_name']), checkpoint['rng_keys'], int(checkpoint['rng_pos']),
+                         int(checkpoint['rng_has_gauss']), float(checkpoint['rng_cached_gaussian'])))
+
+
+def _params_text(params):
+    return json.dumps(params, sort_keys=True, default=lambda value: np.asarray(value).tolist())
+
+
+def save_checkpoint(filename, kind, params, arrays):
+    """
+    Writes a snapshot atomically to filename (an .npz file): the arrays, the
+    state of the global random generator, and the kind and parameters of the
+    run, which load_checkpoint checks on resume
+    """
+    snapshot = dict(arrays, **rng_state())
+    snapshot['kind'] = np.asarray(kind)
+    snapshot['params'] = np.asarray(_params_text(params))
+    save_npz(filename, snapshot, compressed=False)
+
+
+def load_checkpoint(filename, kind, params):
+    """
+    Returns the snapshot in filename as a dictionary of arrays, or None if
+    there is none yet. A snapshot of another kind of run or of other
+    parameters raises ValueError rather than being resumed.
+    """
+    try:
+        with np.load(filename) as data:
+            checkpoint = {name: data[name] for name in data.files}
+    except FileNotFoundError:
+        return None
+
+    if str(checkpoint['kind']) != kind or str(checkpoint['params']) != _params_text(params):
+        raise ValueError(f'{filename} is a checkpoint of a {checkpoint["kind"]} run with parameters '
+                         f'{checkpoint["params"]}, not of this run')
+    return checkpoint
+
+
+class _Interval():
+    """
+    Decides when to write the next snapshot: every `every` units of simulated
+    time and, if seconds is given, whenever that much wall time has passed
+    """
+
+    def __init__(self, start, every, seconds):
+        self.every = every
+        self.seconds = seconds
+        self.next = start + every if every is not None else np.inf
+        self.last = time.perf_counter()
+
+    def due(self, now):
+        if now >= self.next or (self.seconds is not None and time.perf_counter() - self.last >= self.seconds):
+            while self.next <= now:
+                self.next += self.every
+            self.last = time.perf_counter()
+            return True
+        return False
+
+
+def solve_pdes_checkpointed(model, filename, every=10, seconds=None, stop=None, profiler=None):
+    """
+    odeSim_spatial.solve_pdes with snapshots written to filename, resuming
+    from the snapshot when filename exists
+
+    The RK45 solver of solve_ivp is stepped directly, so that its full state
+    (the current time, the state vector, the derivative at the current time and
+    the next step size) can be stored and restored. The output at the daily
+    time points is interpolated exactly as solve_ivp does, so a run agrees with
+    solve_pdes up to the rounding of the means, and a resumed run gives the
+    same result bit for bit as an uninterrupted one.
+    Input:
+        model(odeSim_spatial): the model to solve
+        filename(str): .npz file of the snapshots
+        every(float): simulated time between snapshots (default 10 days)
+        seconds(float): also write a snapshot whenever this much wall time has passed
+        stop(float): stop after this simulated time, keeping the snapshot to
+            resume from, e.g. to split a run over several jobs with a time limit
+
+    Return:
+        time, s, i, r as solve_pdes, up to the time reached
+    """
+    from scipy.integrate import RK45
+    if profiler is None:
+        profiler = NULL_PROFILER
+    params = model._params()
+    profiler.begin('checkpoint.solve_pdes_checkpointed', **params)
+
+    t_eval = np.arange(0, model.t, 1)
+    fun = profiler.wrap_rhs(model.rhs_pdes)
+    checkpoint = load_checkpoint(filename, 'pdes', params)
+
+    if checkpoint is None:
+        with profiler.phase('initial_conditions'):
+            model.ics = model.initial_state()
+        solver = RK45(fun, 0, model.ics, model.t)
+        t_eval_i = 0
+        means = np.empty((3, 0))
+    else:
+        restore_rng(checkpoint)
+        t, y, h_abs = float(checkpoint['t']), checkpoint['y'], float(checkpoint['h_abs'])
+        solver = RK45(fun, t, y, model.t, first_step=min(h_abs, model.t - t) if t < model.t else None)
+        # The derivative and step size of the interrupted solver, not the ones of a fresh start
+        solver.f = checkpoint['f']
+        solver.h_abs = h_abs
+        if t >= model.t:
+            solver.status = 'finished'
+        t_eval_i = int(checkpoint['t_eval_i'])
+        means = checkpoint['means']
+
+    def snapshot():
+        with profiler.phase('checkpoint'):
+            save_checkpoint(filename, 'pdes', params,
+                            {'t': np.asarray(solver.t), 'y': solver.y, 'f': solver.f,
+                             'h_abs': np.asarray(solver.h_abs), 't_eval_i': np.asarray(t_eval_i),
+                             'means': means})
+
+    interval = _Interval(solver.t, every, seconds)
+    with profiler.phase('solve'):
+        while solver.status == 'running':
+            message = solver.step()
+            if solver.status == 'failed':
+                raise RuntimeError(f'the solver failed at t = {solver.t}: {message}')
+
+            # Output at the daily time points of this step, as solve_ivp computes it
+            t_eval_i_new = np.searchsorted(t_eval, solver.t, side='right')
+            if t_eval_i_new > t_eval_i:
+                y = solver.dense_output()(t_eval[t_eval_i:t_eval_i_new])
+                step_means = [np.mean(y[idx], axis=0) for idx in (model.s_idx, model.i_idx, model.r_idx)]
+                means = np.concatenate([means, step_means], axis=1)
+                t_eval_i = t_eval_i_new
+
+            if solver.status == 'finished' or interval.due(solver.t):
+                snapshot()
+            if stop is not None and solver.t >= stop:
+                if solver.status == 'running':
+                    snapshot()
+                break
+
+    profiler.end()
+    return t_eval[:t_eval_i], means[0], means[1], means[2]
+
+
+def spatial_simulation_checkpointed(k, q, p, n, t, filename, position='Center', num_initial_infected=5,
+                                    periodic=False, backend='numpy', every=10, seconds=None, stop=None,
+                                    profiler=None):
+    """
+    The array based discrete_spatial_simulation with snapshots of the
+    positions, states, counts and random generator written to filename,
+    resuming from the snapshot when filename exists
+
+    The random numbers are drawn in the same order as discrete_spatial_simulation
+    with the same backend, so a run gives the same result for a seed, and a
+    resumed run the same result bit for bit as an uninterrupted one.
+    Input:
+        k, q, p, n, t, position, num_initial_infected, periodic: as in discrete_spatial_simulation
+        filename(str): .npz file of the snapshots
+        backend(str): kernels of sir.backend (default 'numpy')
+        every(int): days between snapshots (default 10)
+        seconds(float): also write a snapshot whenever this much wall time has passed
+        stop(int): stop after this day, keeping the snapshot to resume from
+
+    Return:
+        List of S, I, R up to the day reached
+    """
+    if profiler is None:
+        profiler = NULL_PROFILER
+    params = {'k': k, 'q': q, 'p': p, 'n': n, 't': t, 'position': position,
+              'num_initial_infected': num_initial_infected, 'periodic': periodic, 'backend': backend}
+    profiler.begin('checkpoint.spatial_simulation_checkpointed', **params)
+    kernels = get_backend(backend)
+
+    checkpoint = load_checkpoint(filename, 'agents', params)
+    if checkpoint is None:
+        pos, states = initial_agents(n, position, num_initial_infected)
+        counts = np.bincount(states, minlength=3)[None]
+    else:
+        restore_rng(checkpoint)
+        pos, states, counts = checkpoint['pos'], checkpoint['states'], checkpoint['counts']
+
+    def snapshot():
+        with profiler.phase('checkpoint'):
+            save_checkpoint(filename, 'agents', params, {'pos': pos, 'states': states, 'counts': counts})
+
+    # Rows of counts are the days already simulated
+    day = len(counts) - 1
+    interval = _Interval(day, every, seconds)
+    rows = [counts]
+    current = counts[-1].copy()
+    while day < t and (stop is None or day < stop):
+        new_infected, recovered = array_step(pos, states, k, q, p, periodic, kernels, profiler)
+        current += [-len(new_infected), len(new_infected) - len(recovered), len(recovered)]
+        rows.append(current[None].copy())
+        day += 1
+        profiler.end_step(day, S=current[0], I=current[1], R=current[2])
+
+        if day == t or interval.due(day) or day == stop:
+            counts = np.concatenate(rows)
+            rows = [counts]
+            snapshot()
+
+    profiler.end()
+    counts = np.concatenate(rows)
+    return [int(c) for c in counts[:, 0]], [int(c) for c in counts[:, 1]], [int(c) for c in counts[:, 2]]
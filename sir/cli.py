@@ -0,0 +1,309 @@
+"""
+Command line runner of manifest driven batch sweeps
+
+Usage:
+    sir run manifest.json                # run every run of the manifest
+    sir run manifest.json --workers 8    # on 8 worker processes
+    sir run manifest.yaml --only pde     # only the runs whose name contains 'pde'
+    sir engines                          # list the registered engines and their parameters
+
+A manifest is a JSON (or, when PyYAML is installed, YAML) file such as
+
+    {"output": "results",
+     "workers": 4,
+     "runs": [{"name": "pde_sweep",
+               "engine": "odeSim_spatial",
+               "params": {"M": 50, "t": 100},
+               "grid": {"b": [1, 2, 3], "p": [0.5, 1]}},
+              {"name": "agents",
+               "engine": "discreteSim",
+               "params": {"n": 1000, "t": 100},
+               "grid": {"b": [1, 2], "k": [0.1, 0.2]},
+               "replicates": 10,
+               "seed": 0}]}
+
+Every combination of the grid values is run once per replicate. Replicate r
+of a stochastic engine uses the seed seed + r (default seed 0) at every grid
+point, or the r-th entry of an explicit "seeds" list; deterministic engines
+are run once per grid point.
+
+The result of every job is written to output/<run name>/jobs/<key>.npz as
+soon as it is done, where key is the sir.cache.result_key of the job, and jobs
+whose file exists are skipped. An interrupted sweep therefore continues where
+it stopped when it is started again. When all jobs of a run are done they are
+collected into the columnar store output/<run name>.npz (see load_results).
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from sir.cache import result_key, save_npz
+from sir.engines import ENGINES, get_engine
+
+# Keys of a run of the manifest
+RUN_KEYS = ('name', 'engine', 'params', 'grid', 'replicates', 'seed', 'seeds')
+
+
+def load_manifest(path):
+    """
+    Reads a manifest from a .json, .yaml or .yml file
+    """
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('YAML manifests need PyYAML to be installed, or use a JSON manifest')
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('runs'), list):
+        raise ValueError(f'{path}: a manifest is a mapping with a list of runs under "runs"')
+    return manifest
+
+
+def expand_run(run):
+    """
+    Returns the jobs of one run of the manifest as a list of dictionaries with
+    the engine name, the parameters, the values of the grid parameters, the
+    replicate index and the seed of the job
+
+    Unknown keys, engines and parameters, runs without jobs (an empty list
+    of grid values or seeds, or no replicates) and grid values of mixed types,
+    which collect could only store as pickled objects, raise an error before
+    anything is run.
+    """
+    unknown = set(run) - set(RUN_KEYS)
+    if unknown:
+        raise ValueError(f'unknown keys {sorted(unknown)} in run {run.get("name")!r}, expected some of {RUN_KEYS}')
+
+    engine = get_engine(run['engine'])
+    params = dict(run.get('params', {}))
+    grid = run.get('grid', {})
+
+    if not engine.stochastic:
+        seeds = [None]
+    elif 'seeds' in run:
+        seeds = list(run['seeds'])
+    else:
+        seeds = [run.get('seed', 0) + r for r in range(run.get('replicates', 1))]
+
+    empty = [name for name in sorted(grid) if len(grid[name]) == 0]
+    if empty:
+        raise ValueError(f'the grid of run {run.get("name")!r} has no values for {empty}')
+    if not seeds:
+        raise ValueError(f'run {run.get("name")!r} has no replicates')
+    for name in sorted(grid):
+        try:
+            column = np.asarray(grid[name])
+        except ValueError:
+            column = np.asarray(grid[name], dtype=object)
+        if column.dtype == object or len({isinstance(value, str) for value in grid[name]}) > 1:
+            raise ValueError(f'the grid of run {run.get("name")!r} mixes values of different types '
+                             f'for {name!r}: {grid[name]}')
+
+    names = sorted(grid)
+    jobs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        point = dict(zip(names, values))
+        job_params = dict(params, **point)
+        # Fails early on parameters the engine does not take
+        engine.normalize(job_params)
+        for replicate, seed in enumerate(seeds):
+            jobs.append({'engine': engine.name, 'params': job_params, 'point': point,
+                         'replicate': replicate, 'seed': seed,
+                         'key': result_key(engine, job_params, seed)})
+    return jobs
+
+
+def _run_job(job, directory):
+    """
+    Runs one job and writes its result to directory/<key>.npz
+    """
+    result = get_engine(job['engine']).run(job['params'], job['seed'])
+    save_npz(os.path.join(directory, job['key'] + '.npz'), result)
+    return job['key']
+
+
+def run_jobs(jobs, directory, workers=None):
+    """
+    Runs the jobs whose result is not in directory yet on a process pool
+    Input:
+        jobs(list): jobs of expand_run
+        directory(str): directory of the per job .npz results
+        workers(int): number of worker processes, 1 runs in this process (default os.cpu_count())
+
+    Return:
+        Number of jobs that were run
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    os.makedirs(directory, exist_ok=True)
+
+    done = {entry.name[:-len('.npz')] for entry in os.scandir(directory) if entry.name.endswith('.npz')}
+    pending = list({job['key']: job for job in jobs if job['key'] not in done}.values())
+
+    if workers == 1 or len(pending) <= 1:
+        for job in pending:
+            _run_job(job, directory)
+    else:
+        chunksize = max(1, len(pending) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_run_job, pending, itertools.repeat(directory), chunksize=chunksize))
+    return len(pending)
+
+
+def collect(jobs, directory, filename, run=None):
+    """
+    Collects the per job results of a run into one columnar .npz store
+
+    The store has one column 'params.<name>' per grid parameter, the columns 'replicate',
+    'seed' and 'key', and one column per output of the engine with one row per
+    job. Outputs whose shape differs between jobs (e.g. ODE runs that stop
+    early) are stored flat, with the rows of job j in
+    values[offsets[j]:offsets[j + 1]] of the columns <output> and <output>_offsets.
+    The run of the manifest is stored as JSON in the column 'run'.
+    """
+    columns = {}
+    for name in sorted(jobs[0]['point']):
+        columns['params.' + name] = np.asarray([job['point'][name] for job in jobs])
+    columns['replicate'] = np.asarray([job['replicate'] for job in jobs])
+    columns['seed'] = np.asarray([-1 if job['seed'] is None else job['seed'] for job in jobs])
+    columns['key'] = np.asarray([job['key'] for job in jobs])
+
+    results = []
+    for job in jobs:
+        with np.load(os.path.join(directory, job['key'] + '.npz')) as data:
+            results.append({name: data[name] for name in data.files})
+
+    for output in results[0]:
+        values = [result[output] for result in results]
+        if len({value.shape for value in values}) == 1:
+            columns[output] = np.stack(values)
+        else:
+            columns[output] = np.concatenate([value.ravel() for value in values])
+            columns[output + '_offsets'] = np.concatenate([[0], np.cumsum([value.size for value in values])])
+
+    if run is not None:
+        columns['run'] = np.asarray(json.dumps(run, sort_keys=True))
+    save_npz(filename, columns)
+    return columns
+
+
+def load_results(filename):
+    """
+    Reads a columnar store written by collect
+    Return:
+        Dictionary of column name to array; outputs stored flat are returned as
+        lists with one array per job, and the run of the manifest as a dictionary
+    """
+    with np.load(filename) as data:
+        columns = {name: data[name] for name in data.files}
+
+    for name in [name for name in columns if name + '_offsets' in columns]:
+        offsets = columns.pop(name + '_offsets')
+        columns[name] = [columns[name][start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+    if 'run' in columns:
+        columns['run'] = json.loads(str(columns['run']))
+    return columns
+
+
+def plan_manifest(manifest, only=None):
+    """
+    Expands every run of a manifest (a dictionary, see load_manifest) into its
+    jobs, so that a mistake in any run is found before anything is run
+    Input:
+        only(str): only keep the runs whose name contains this string
+
+    Return:
+        List of (run, jobs)
+    """
+    runs = []
+    for run in manifest['runs']:
+        run = dict(run, name=run.get('name', run.get('engine')))
+        if only is None or only in run['name']:
+            runs.append(run)
+    names = [run['name'] for run in runs]
+    if len(set(names)) != len(names):
+        raise ValueError(f'the names of the runs of a manifest must be unique, got {names}')
+    return [(run, expand_run(run)) for run in runs]
+
+
+def run_plan(plan, output='results', workers=None, log=print):
+    """
+    Runs the jobs of plan_manifest and collects every run into output/<run name>.npz
+    Input:
+        output(str): output directory
+        workers(int): number of worker processes (default os.cpu_count())
+        log: function called with one progress line per run
+
+    Return:
+        List of the columnar stores written
+    """
+    stores = []
+    for run, jobs in plan:
+        directory = os.path.join(output, run['name'], 'jobs')
+        ran = run_jobs(jobs, directory, workers)
+        filename = os.path.join(output, run['name'] + '.npz')
+        collect(jobs, directory, filename, run)
+        log(f"{run['name']}: {len(jobs)} jobs ({len(jobs) - ran} already done) -> {filename}")
+        stores.append(filename)
+    return stores
+
+
+def run_manifest(manifest, output=None, workers=None, only=None, log=print):
+    """
+    Runs a manifest; output and workers override its "output" (default
+    'results') and "workers", and only selects runs as in plan_manifest
+    """
+    return run_plan(plan_manifest(manifest, only), output or manifest.get('output', 'results'),
+                    workers or manifest.get('workers'), log)
+
+
+def list_engines(log=print):
+    """
+    Prints every registered engine with its parameters and outputs
+    """
+    for name, engine in ENGINES.items():
+        kind = 'stochastic' if engine.stochastic else 'deterministic'
+        log(f'{name} ({kind}): {engine.signature} -> {", ".join(engine.outputs)}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='sir', description='Run batch sweeps of the SIR simulation engines')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the sweeps of a manifest')
+    run_parser.add_argument('manifest', help='JSON or YAML manifest of runs')
+    run_parser.add_argument('--output', default=None, help='output directory (default the manifest\'s, or results)')
+    run_parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    run_parser.add_argument('--only', default=None, help='only run the runs whose name contains this string')
+
+    commands.add_parser('engines', help='list the registered engines')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'engines':
+        list_engines()
+        return 0
+
+    # Mistakes in the manifest are reported without a traceback; errors of the runs themselves are not caught
+    try:
+        manifest = load_manifest(args.manifest)
+        plan = plan_manifest(manifest, args.only)
+    except (OSError, ValueError, KeyError, TypeError, ImportError) as error:
+        print(f'sir: error: {error}', file=sys.stderr)
+        return 2
+
+    run_plan(plan, args.output or manifest.get('output', 'results'), args.workers or manifest.get('workers'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
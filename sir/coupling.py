@@ -0,0 +1,204 @@
+import numpy as np
+
+from sir.backend import get_backend
+from sir.discreteSim_spatial import array_step, initial_agents
+from sir.odeSim_spatial import odeSim_spatial
+
+
+def cell_index(positions, M):
+    """
+    Returns the flat index row * M + col of the grid cell of every position,
+    where row a holds x in [a / M, (a + 1) / M) as in sir.initial_conditions
+    """
+    cells = np.minimum((np.asarray(positions) * M).astype(np.int64), M - 1)
+    return cells[:, 0] * M + cells[:, 1]
+
+
+def bin_agents(positions, states, M, n=None):
+    """
+    Bins agents onto the M x M grid of odeSim_spatial with a single bincount
+
+    Every cell gets the number of its S, I and R agents divided by the expected
+    number of agents per cell n / M**2, so the fields are on the scale of the
+    PDE fractions: their means over the grid are S / n, I / n and R / n.
+    Input:
+        positions(array): (n, 2) positions in the unit square
+        states(array): integer state codes (see sir.population.STATE_CODES)
+        M(int): grid size
+        n(int): population size used for the scaling (default len(positions))
+
+    Return:
+        Array of shape (3, M, M) with the s, i, r fields
+    """
+    if n is None:
+        n = len(positions)
+    keys = np.asarray(states, dtype=np.int64) * (M * M) + cell_index(positions, M)
+    counts = np.bincount(keys, minlength=3 * M * M)
+    return (counts * (M * M / n)).reshape(3, M, M)
+
+
+def sample_agents(density, n):
+    """
+    Draws n agent positions from a density field on the M x M grid with a
+    vectorized inverse CDF: the cell of every agent is found by a binary search
+    of the cumulative density and the agent is placed uniformly inside it
+    Input:
+        density(array): (M, M) non-negative field, e.g. s + i + r
+        n(int): number of agents
+
+    Return:
+        Array of shape (n, 2) of positions and the flat cell index of every agent
+    """
+    M = density.shape[0]
+    cdf = np.cumsum(density, axis=None)
+    cells = np.searchsorted(cdf, np.random.rand(n) * cdf[-1], side='right')
+    cells = np.minimum(cells, M * M - 1)
+    rows, cols = np.divmod(cells, M)
+    positions = (np.stack([rows, cols], axis=1) + np.random.rand(n, 2)) / M
+    return positions, cells
+
+
+def sample_population(fields, n):
+    """
+    Draws n agents from the s, i, r fields of odeSim_spatial: positions follow
+    the total density s + i + r, and the state of every agent is drawn from the
+    fractions s : i : r of its cell
+    Input:
+        fields(array): (3, M, M) s, i, r fields
+
+    Return:
+        Array of shape (n, 2) of positions and the integer states
+    """
+    fields = np.asarray(fields)
+    total = fields.sum(axis=0)
+    positions, cells = sample_agents(total, n)
+
+    flat = fields.reshape(3, -1)
+    u = np.random.rand(n) * total.reshape(-1)[cells]
+    states = (u >= flat[0, cells]).astype(np.int8) + (u >= flat[0, cells] + flat[1, cells])
+    return positions, states.astype(np.int8)
+
+
+def field_diagnostics(fields):
+    """
+    Field level summary of an s, i, r grid, from the PDE or from binned agents
+    Input:
+        fields(array): (3, M, M) s, i, r fields
+
+    Return:
+        Dictionary with the means s, i, r, the centroid (x, y) of the infected
+        and their spread, the root mean square distance from the centroid
+    """
+    M = fields.shape[1]
+    s, i, r = fields.reshape(3, -1).mean(axis=1)
+    diagnostics = {'s': s, 'i': i, 'r': r, 'centroid': (np.nan, np.nan), 'spread': np.nan}
+
+    weight = fields[1].sum()
+    if weight > 0:
+        x = (np.arange(M) + 0.5) / M
+        cx = fields[1].sum(axis=1) @ x / weight
+        cy = fields[1].sum(axis=0) @ x / weight
+        spread = np.sqrt((fields[1].sum(axis=1) @ (x - cx)**2 + fields[1].sum(axis=0) @ (x - cy)**2) / weight)
+        diagnostics['centroid'] = (cx, cy)
+        diagnostics['spread'] = spread
+    return diagnostics
+
+
+def field_error(a, b):
+    """
+    Returns the mean absolute difference of every compartment of two (3, M, M) field stacks
+    """
+    return np.abs(np.asarray(a) - np.asarray(b)).reshape(3, -1).mean(axis=1)
+
+
+def pde_parameters(k, q, p, n, M):
+    """
+    Returns the b, k, p of odeSim_spatial that correspond to the agent model
+
+    b = n * pi * q**2 is the expected number of agents within the radius of
+    infection. A random walk with steps of length p per day has diffusion
+    coefficient p**2 / 4 on the unit square, and the laplacian of
+    odeSim_spatial is not scaled by the cell size, so its weight is M**2 * p**2 / 4.
+    """
+    return n * np.pi * q**2, k, M**2 * p**2 / 4
+
+
+def hybrid_simulation(k, q, p, n, t, M=50, position='Center', num_initial_infected=5,
+                      upper=0.5, lower=None, periodic=False, backend='numpy'):
+    """
+    Runs the spatial epidemic with agents in the cells of the grid where few
+    people are infected and with the PDE of odeSim_spatial where many are
+
+    The agents capture the randomness where the epidemic is sparse, e.g. at
+    its front and at the start and end, the PDE the bulk of it at a cost
+    independent of n. At the start of every day each cell whose infected
+    density (the i field of the agents binned with bin_agents plus the PDE
+    fields) reaches upper joins the PDE region, and each cell of the region
+    whose infected density falls below lower leaves it. Agents in the region
+    are binned into the PDE fields, and the fields outside the region are
+    turned into agents with sample_population. Then the agents take one step
+    and the PDE is solved for one day on the fields of the region. The two
+    regions are coupled by movement: agents that walk into the region and
+    mass that diffuses out of it change hands at the start of the next day.
+    Input:
+        k, q, p, n, t, position, num_initial_infected, periodic: as in discrete_spatial_simulation
+        M(int): grid size of the PDE
+        upper(float): infected density of a cell at which the PDE takes it over,
+            where 1 is the mean number of people per cell (default 0.5)
+        lower(float): infected density at which the agents take a cell back (default upper / 2)
+        backend(str): kernels of sir.backend for the agent steps
+
+    Return:
+        Lists of S, I, R at time t (the PDE fields scaled by n) and the list
+        of the fraction of the cells in the PDE region of every day
+    """
+    from scipy.integrate import solve_ivp
+    if lower is None:
+        lower = upper / 2
+    backend = get_backend(backend)
+    b_pde, k_pde, p_pde = pde_parameters(k, q, p, n, M)
+    model = odeSim_spatial(n=n, b=b_pde, k=k_pde, p=p_pde, t=t, M=M, periodic=periodic)
+
+    pos, states = initial_agents(n, position, num_initial_infected)
+    y = np.zeros((3, M, M))
+    region = np.zeros((M, M), dtype=bool)
+    # Field value of one agent in its cell
+    scale = M * M / n
+
+    def day_row():
+        counts = np.bincount(states, minlength=3) + y.reshape(3, -1).sum(axis=1) / scale
+        S.append(float(counts[0]))
+        I.append(float(counts[1]))
+        R.append(float(counts[2]))
+        used.append(float(region.mean()))
+
+    S, I, R, used = [], [], [], []
+    day_row()
+
+    for step in range(t):
+        infected = y[1] + bin_agents(pos, states, M, n)[1]
+        region = (infected >= upper) | (region & (infected >= lower))
+
+        # Agents in the region become part of the fields
+        inside = region.ravel()[cell_index(pos, M)]
+        y += bin_agents(pos[inside], states[inside], M, n)
+        pos, states = pos[~inside], states[~inside]
+
+        # The fields outside the region become agents, with the fractional agent rounded at random
+        outside = np.where(region, 0, y)
+        mass = outside.sum() / scale
+        count = int(mass) + (np.random.rand() < mass - int(mass))
+        if count > 0:
+            new_pos, new_states = sample_population(outside, count)
+            pos = np.concatenate([pos, new_pos])
+            states = np.concatenate([states, new_states])
+        y[:, ~region] = 0
+
+        if len(pos) > 0:
+            array_step(pos, states, k, q, p, periodic, backend)
+        if region.any():
+            y = solve_ivp(model.rhs_pdes, (0, 1), y.ravel()).y[:, -1].reshape(3, M, M)
+
+        day_row()
+
+    return S, I, R, used
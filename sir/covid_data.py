@@ -0,0 +1,202 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# The three JHU CSSE global time series
+FILES = {'confirmed': 'time_series_covid19_confirmed_global.csv',
+         'deaths': 'time_series_covid19_deaths_global.csv',
+         'recovered': 'time_series_covid19_recovered_global.csv'}
+
+# Columns of the wide CSV files that are not dates
+ID_COLUMNS = ['Province/State', 'Country/Region', 'Lat', 'Long']
+
+
+def clean_data(df, country):
+    """
+    Returns the daily series of one country as an array, summed over its provinces
+    Input:
+        df(DataFrame): one of the wide JHU time series
+        country(str): value of the 'Country/Region' column
+    """
+    dates = df.columns.drop(ID_COLUMNS, errors='ignore')
+    return df.loc[df['Country/Region'] == country, dates].to_numpy().sum(axis=0)
+
+
+class CovidStore():
+    """
+    Columnar store of the three JHU time series
+
+    The wide CSV files are converted once into one typed (countries, days) int64
+    matrix per series, summed over provinces, saved as .npy files next to a
+    country index and the dates. Opening the store memory maps the matrices, so
+    the series of one country are read in O(1) and all countries can be
+    processed at once as arrays.
+
+    Arguments:
+        path - Directory of a store written by CovidStore.build
+
+    Attributes:
+        countries - Sorted array of country names (the row index)
+        dates - datetime64[D] array of the days (the column index)
+        confirmed, deaths, recovered - (countries, days) arrays of cumulative counts
+    """
+
+    SERIES = tuple(FILES)
+
+    def __init__(self, path):
+        self.path = path
+        self.countries = np.load(os.path.join(path, 'countries.npy'))
+        self.dates = np.load(os.path.join(path, 'dates.npy'))
+        for name in self.SERIES:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+        self.index = {country: row for row, country in enumerate(self.countries)}
+
+    @classmethod
+    def build(cls, data_dir, path):
+        """
+        Converts the three CSV files in data_dir into a store at path and returns it
+        """
+        frames = {name: pd.read_csv(os.path.join(data_dir, csv)) for name, csv in FILES.items()}
+
+        date_columns = frames['confirmed'].columns.drop(ID_COLUMNS)
+        dates = pd.to_datetime(date_columns, format='%m/%d/%y').to_numpy().astype('datetime64[D]')
+        countries = np.array(sorted(set().union(*[df['Country/Region'] for df in frames.values()])))
+        country_index = pd.Index(countries)
+
+        # Write into a temporary directory first so that a store is never seen half written
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent)
+
+        np.save(os.path.join(tmp, 'countries.npy'), countries)
+        np.save(os.path.join(tmp, 'dates.npy'), dates)
+
+        for name, df in frames.items():
+            values = df.reindex(columns=date_columns, fill_value=0).to_numpy(dtype=np.int64)
+            rows = country_index.get_indexer(df['Country/Region'])
+            # Sum the provinces of every country in one scatter
+            table = np.zeros((len(countries), len(dates)), dtype=np.int64)
+            np.add.at(table, rows, values)
+            np.save(os.path.join(tmp, name + '.npy'), table)
+
+        # Only an old store is replaced, any other non-empty directory makes rmdir fail
+        if os.path.exists(os.path.join(path, 'countries.npy')):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.rmdir(path)
+        os.replace(tmp, path)
+
+        return cls(path)
+
+    @classmethod
+    def open(cls, data_dir, path):
+        """
+        Opens the store at path, building it from the CSV files in data_dir if it does not exist yet
+        """
+        if not os.path.exists(os.path.join(path, 'countries.npy')):
+            return cls.build(data_dir, path)
+        return cls(path)
+
+    def _columns(self, start, end):
+        """
+        Returns the slice of days from start to end (inclusive dates such as '2020-01-22' or '1/22/20')
+        """
+        first = 0 if start is None else np.searchsorted(self.dates, _to_day(start))
+        last = len(self.dates) if end is None else np.searchsorted(self.dates, _to_day(end), side='right')
+        return slice(first, last)
+
+    def series(self, country, start=None, end=None):
+        """
+        Returns the dates and the confirmed, deaths and recovered series of one country
+        Input:
+            country(str): value of the 'Country/Region' column
+            start, end: optional first and last date to return
+
+        Return:
+            Dictionary with the 'dates' and the 'confirmed', 'deaths' and 'recovered' arrays
+        """
+        row = self.index[country]
+        columns = self._columns(start, end)
+        series = {'dates': self.dates[columns]}
+        for name in self.SERIES:
+            series[name] = np.asarray(getattr(self, name)[row, columns])
+        return series
+
+    def sir_series(self, country, population, start=None, end=None):
+        """
+        Returns the S, I, R counts of one country as plotted in script/var1_covid.py:
+        I are the confirmed cases, R the recovered cases and S = N - I - D
+        """
+        series = self.series(country, start, end)
+        I = series['confirmed']
+        R = series['recovered']
+        S = population - I - series['deaths']
+        return S, I, R
+
+    def sir_all(self, populations, start=None, end=None):
+        """
+        Returns the S, I, R counts of every country at once, as (countries, days) arrays
+        Input:
+            populations(array): population of every country, in the order of countries
+        """
+        columns = self._columns(start, end)
+        I = np.asarray(self.confirmed[:, columns])
+        R = np.asarray(self.recovered[:, columns])
+        S = np.asarray(populations, dtype=float)[:, None] - I - self.deaths[:, columns]
+        return S, I, R
+
+
+def _to_day(date):
+    """
+    Converts a date such as '2020-01-22', '1/22/20' or a datetime to datetime64[D]
+    """
+    if isinstance(date, str) and '/' in date:
+        date = pd.to_datetime(date, format='%m/%d/%y')
+    return np.datetime64(pd.Timestamp(date), 'D')
+
+
+def country_series(data_dir, country, cache_dir=None):
+    """
+    Returns the cleaned confirmed, deaths and recovered series of one country
+    Input:
+        data_dir(str): directory holding the three JHU CSV files
+        country(str): value of the 'Country/Region' column
+        cache_dir(str): if given, a CovidStore of all countries is kept there
+            and the series are read from it on later calls
+
+    Return:
+        Dictionary with the 'dates' and the 'confirmed', 'deaths' and 'recovered' arrays
+    """
+    if cache_dir is not None:
+        return CovidStore.open(data_dir, cache_dir).series(country)
+
+    series = {}
+    for name, csv in FILES.items():
+        df = pd.read_csv(os.path.join(data_dir, csv))
+        dates = df.columns.drop(ID_COLUMNS)
+        series['dates'] = pd.to_datetime(dates, format='%m/%d/%y').to_numpy().astype('datetime64[D]')
+        series[name] = clean_data(df, country)
+
+    return series
+
+
+def sir_fractions(series, population):
+    """
+    Converts cumulative case counts to SIR fractions of the population
+    Infected are the active cases (confirmed - recovered - deaths) and removed
+    are the recovered and the deaths, so that s = 1 - i - r
+    Input:
+        series(dict): confirmed, deaths and recovered arrays, e.g. from country_series
+        population(float): population of the country
+
+    Return:
+        Arrays s, i, r
+    """
+    removed = np.asarray(series['recovered'], dtype=float) + series['deaths']
+    infected = series['confirmed'] - removed
+    i = infected / population
+    r = removed / population
+    return 1 - i - r, i, r
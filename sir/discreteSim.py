@@ -1,6 +1,9 @@
 import numpy as np
 from numpy import random
 
+from sir.population import PopulationState, STATE_CODES
+from sir.profiling import NULL_PROFILER
+
 class Person:
     """
     This class sets up each person in the simulation.
@@ -25,13 +28,26 @@ class Person:
         self.state = newState
 
 
-def simulateInteractions(people, b):
+def simulateInteractions(people, b, population=None):
     """
     This creates random interactions for each person.
     Each person can have b interactions with others.
     If a person with a state S has an interaction with
     a person with a state I, the person's state will change to I
+
+    If population (a sir.population.PopulationState) is given, only the
+    infected people are visited, in the same order as the loop over everyone,
+    and state changes go through it, so that the counts stay up to date
     """
+    if population is not None:
+        for i in population.scan("I"): #Loop through the infected people only
+            for num in range(b):
+                I2 = random.randint(0, people.size-1) #Generate a random index
+                if I2 == i or people[I2].state == "R":
+                    continue
+                population.set_state(I2, "I")
+        return
+
     for i in range(people.size): #Loop through each person in  people
         person = people[i]
         if person.state == "R" or person.state == "S": #Skip interaction if already infected or recovered
@@ -45,11 +61,20 @@ def simulateInteractions(people, b):
                 secondperson.changeState("I") #If either person in the interaction is infected, then they will both be infected
         
 
-def simulateRecoveries(people, k):
+def simulateRecoveries(people, k, population=None):
     """
     This function changes the state of a fraction k
     of people with state I to state R 
+
+    If population (a sir.population.PopulationState) is given, only the
+    infected people are visited and state changes go through it
     """
+    if population is not None:
+        for i in population.members("I"):
+            if random.random() <= k:
+                population.set_state(i, "R")
+        return
+
     for person in people:
         if person.state == "I": #If a person is infected 
             randValue = random.random() 
@@ -68,7 +93,53 @@ def returnCounts(people, state):
     return num
 
 
-def simulateSIR(n, b, k, t):
+def iter_simulateSIR(n, b, k, t=None, snapshot=False, profiler=None):
+    """
+    Generator version of simulateSIR that yields the counts of every day as
+    soon as it is simulated, so that memory does not grow with the number of days.
+    Parameters as in simulateSIR, and
+    t is the number of days to simulate, None to go on until the consumer stops
+    snapshot also yields the state of every person each day, as an int8 array
+        of STATE_CODES
+    Yields dictionaries {'day', 'S', 'I', 'R'} (and 'states'), starting at day 0.
+    The random numbers are drawn as in simulateSIR, so both give the same
+    counts for the same seed.
+    """
+    if profiler is None:
+        profiler = NULL_PROFILER
+    profiler.begin('discreteSim.simulateSIR', n=n, b=b, k=k, t=t)
+
+    people = np.zeros(n, dtype=Person) #Create a matrix of people with their state
+    for i in range(n):
+        people[i] = Person()
+
+    #Keep the counts and the infected people up to date as states change
+    population = PopulationState(people, ("S", "I", "R"))
+
+    #Create patient zero, the first person that is infected
+    population.set_state(0, "I")
+
+    try:
+        day = 0
+        while t is None or day < t:
+            if day > 0:
+                with profiler.phase('infection'):
+                    simulateInteractions(people, b, population)
+                with profiler.phase('recovery'):
+                    simulateRecoveries(people, k, population)
+            with profiler.phase('counting'):
+                row = {'day': day, 'S': population.count("S"), 'I': population.count("I"),
+                       'R': population.count("R")}
+            profiler.end_step(day, S=row['S'], I=row['I'], R=row['R'])
+            if snapshot:
+                row['states'] = np.array([STATE_CODES[person.state] for person in people], dtype=np.int8)
+            yield row
+            day += 1
+    finally:
+        profiler.end()
+
+
+def simulateSIR(n, b, k, t, profiler=None, stop_when_extinct=False):
     """
     Driver code for the discrete simulation.
     Uses simulaterecoveries and simulateinteractions to model
@@ -78,35 +149,25 @@ def simulateSIR(n, b, k, t):
     b is the number of interactions for a single person
     k is the portion of infected individuals who are removed each day, as a decimal
     t is the number of days to simulate
+    profiler is an optional sir.profiling.Profiler that receives per day timings
+    stop_when_extinct stops the simulation once no one is infected and fills
+        the remaining days with the final counts, which do not change anymore
+    See iter_simulateSIR for a version that yields the days one at a time.
     """
-    people = np.zeros(n, dtype=Person) #Create a matrix of people with their state
-
-
-    for i in range(n):
-        people[i] = Person()
-
     #Initialize the matrices S, I, R to keep track of number of people with that state each day 
     S = np.zeros(t)
     I = np.zeros(t)
     R = np.zeros(t)
 
-    #Create patient zero, the first person that is infected
-    patient0 = people[0]
-    patient0.changeState("I")
-    people[0] = patient0
-
-    #Collect the counts of each state for each day 
-    for day in range(t):
-        if day == 0:
-            S[day] = returnCounts(people, "S")
-            I[day] = returnCounts(people, "I")
-            R[day] = returnCounts(people, "R")
-        else:
-            simulateInteractions(people, b)
-            simulateRecoveries(people, k)
-            S[day] = returnCounts(people, "S")
-            I[day] = returnCounts(people, "I")
-            R[day] = returnCounts(people, "R")
+    days = iter_simulateSIR(n, b, k, t, profiler=profiler)
+    for row in days:
+        day = row['day']
+        S[day], I[day], R[day] = row['S'], row['I'], row['R']
 
-    return(S, I, R)
+        if stop_when_extinct and I[day] == 0:
+            S[day:] = S[day]
+            R[day:] = R[day]
+            break
+    days.close()
 
+    return(S, I, R)
@@ -1,21 +1,27 @@
 import numpy as np
-from scipy.spatial import KDTree
+
+from sir.backend import get_backend
+from sir.population import PopulationState, STATE_CODES
+from sir.profiling import NULL_PROFILER
 
 class Person(object):
     """
     This class describe all agents in the grid to implement 
     the SIR model with spatial position and movement of agents.
     """
-    def __init__(self, p):
+    def __init__(self, p, periodic=False):
         """
         Initiate an agent:
         p: the step of length p in a random direction each individual takes 
             at each time step
+        periodic: if True the unit square is a torus and steps that leave
+            the domain wrap around to the opposite side
         """
 
         self.pos = np.random.rand(2)
         self.state = 'S'
         self.p = p
+        self.periodic = periodic
     
     def initial_position(self, position):
         """
@@ -55,14 +61,29 @@ class Person(object):
         x = self.pos[0] + dpos[0]*self.p
         y = self.pos[1] + dpos[1]*self.p
 
+        # On a torus every move succeeds
+        if self.periodic:
+            self.pos = tuple(wrap_positions(np.array([x, y])))
         # A successful move
-        if 0 <= x <= 1 and 0 <= y <= 1:
+        elif 0 <= x <= 1 and 0 <= y <= 1:
             self.pos = (x, y)
         else:
             # remain in the same domain
             self.pos = self.pos
 
 
+def wrap_positions(pos):
+    """
+    Map positions back onto the periodic unit square [0, 1)
+    Input:
+        pos(array): positions of shape (2,) or (n, 2)
+    """
+    pos = np.mod(pos, 1.0)
+    # np.mod can round tiny negative values up to exactly 1.0
+    pos[pos >= 1.0] = 0.0
+    return pos
+
+
 def returnCounts(population, state):
     """
     This function provides the number of people with a particular state 
@@ -75,13 +96,123 @@ def returnCounts(population, state):
             num += 1
     return num    
 
+def contact_pairs(positions, infected, susceptible, q, boxsize=None, profiler=None):
+    """
+    Collects every infected-susceptible contact of a time step in one bulk query
+    Input:
+        positions(array): (n, 2) positions of all agents
+        infected(array): indices of the infected agents
+        susceptible(array): indices of the susceptible agents
+        q(float): radius of infection
+        boxsize(float): domain size for periodic domains, None otherwise
+        profiler(Profiler): optional profiler that times the 'index' and 'query' phases
+
+    Return:
+        Arrays (infector, infectee) of agent indices, one entry per contact
+    """
+    from scipy.spatial import KDTree
+    if profiler is None:
+        profiler = NULL_PROFILER
+    infected = np.asarray(infected, dtype=np.intp)
+    susceptible = np.asarray(susceptible, dtype=np.intp)
+
+    if len(infected) == 0 or len(susceptible) == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    with profiler.phase('index'):
+        tree_I = KDTree(positions[infected], boxsize=boxsize)
+        tree_S = KDTree(positions[susceptible], boxsize=boxsize)
+    with profiler.phase('query'):
+        pairs = tree_I.sparse_distance_matrix(tree_S, q, output_type='ndarray')
+
+    return infected[pairs['i']], susceptible[pairs['j']]
+
+
+def infect_synchronous(positions, states, q, k, boxsize=None, profiler=None):
+    """
+    Synchronous infection and recovery step on arrays
+    Every susceptible agent within distance q of an agent that is infected at
+    the start of the step becomes infected, then every agent that was infected
+    at the start of the step recovers with probability k. Agents infected
+    during the step neither infect others nor recover until the next step.
+    Input:
+        positions(array): (n, 2) positions of all agents
+        states(array): integer state codes (see STATE_CODES), updated in place
+        q(float): radius of infection
+        k(float): rate of recovery
+        boxsize(float): domain size for periodic domains, None otherwise
+        profiler(Profiler): optional profiler that times the 'index', 'query', 'infection' and 'recovery' phases
+
+    Return:
+        Arrays of the newly infected and the newly recovered agent indices
+    """
+    if profiler is None:
+        profiler = NULL_PROFILER
+    infected = np.flatnonzero(states == STATE_CODES['I'])
+    susceptible = np.flatnonzero(states == STATE_CODES['S'])
+
+    _, infectee = contact_pairs(positions, infected, susceptible, q, boxsize, profiler)
+
+    # Vectorized scatter of the transitions
+    with profiler.phase('infection'):
+        new_infected = np.unique(infectee)
+        states[new_infected] = STATE_CODES['I']
+    with profiler.phase('recovery'):
+        recovered = infected[np.random.rand(len(infected)) < k]
+        states[recovered] = STATE_CODES['R']
+
+    return new_infected, recovered
+
+
+def infect_sequential(population, position, q, k, boxsize=None, profiler=None, pop_state=None):
+    """
+    Sequential infection and recovery step on Person objects
+    Agents are visited in order and transitions apply immediately, so agents
+    infected earlier in the step can infect others in the same step.
+    Input:
+        population(list): Person objects
+        position(list): positions of all agents after moving
+        q(float): radius of infection
+        k(float): rate of recovery
+        boxsize(float): domain size for periodic domains, None otherwise
+        profiler(Profiler): optional profiler that times the 'index' and 'infection' phases
+        pop_state(PopulationState): if given, state changes go through it
+            so that its counts stay up to date
+    """
+    from scipy.spatial import KDTree
+    if profiler is None:
+        profiler = NULL_PROFILER
+    with profiler.phase('index'):
+        tree = KDTree(position, boxsize=boxsize)
+    with profiler.phase('infection'):
+        for i in range(len(population)):
+            if population[i].state == 'I':
+                inds = tree.query_ball_point(position[i], q)
+                for ind in inds:
+                    if population[ind].state == 'S':
+                        if pop_state is not None:
+                            pop_state.set_state(ind, 'I')
+                        else:
+                            population[ind].change_state()
+                if np.random.rand() < k:
+                    if pop_state is not None:
+                        pop_state.set_state(i, 'R')
+                    else:
+                        population[i].change_state()
+
+
 def discrete_spatial_simulation(k, 
                                 q, 
                                 p, 
                                 n, 
                                 t, 
                                 position='Center', 
-                                num_initial_infected=5):
+                                num_initial_infected=5,
+                                periodic=False,
+                                sequential=False,
+                                profiler=None,
+                                backend=None,
+                                workers=None):
     """
     Input:
     k(float): rate of recovery
@@ -91,49 +222,220 @@ def discrete_spatial_simulation(k,
     t(int): the number of time iteration
     position(str): the start of infection, ['Center', "Corner', 'Random']
     num_initial_infected(int): the number of initial infection
+    periodic(bool): use a periodic (toroidal) unit square instead of 
+        rejecting moves that leave the domain
+    sequential(bool): apply infections agent by agent in order, as in the 
+        original implementation, instead of synchronously for all contacts
+    profiler(Profiler): optional sir.profiling.Profiler that receives per step timings
+    backend(str): run on position and state arrays with the kernels of
+        sir.backend ('numpy', 'numba' or 'auto') instead of Person objects.
+        Gives the same result as the Person path for the same seed.
+    workers(int): split the unit square into strips simulated by this many
+        processes with shared memory (see sir.domain.decomposed_simulation)
 
     Return:
         List of S, I, R at time t
+    See iter_discrete_spatial_simulation for a version that yields the steps one at a time.
     """
-    population = [Person(p) for i in range(n)] 
+    if workers is not None and workers > 1:
+        if profiler is None:
+            profiler = NULL_PROFILER
+        profiler.begin('discreteSim_spatial.discrete_spatial_simulation', k=k, q=q, p=p, n=n, t=t,
+                       position=position, num_initial_infected=num_initial_infected,
+                       periodic=periodic, sequential=sequential, backend=backend, workers=workers)
+        if sequential:
+            raise ValueError('sequential infection cannot be split over workers')
+        from sir.domain import decomposed_simulation
+        return decomposed_simulation(k, q, p, n, t, position, num_initial_infected, periodic,
+                                     workers, backend or 'auto', profiler)
 
-    if position == 'Center':
-        pos = np.array([0.5, 0.5])
-        for i in range(num_initial_infected):
-            population[i].initial_position(pos)
-            population[i].change_state()
+    S, I, R = [], [], []
+    for row in iter_discrete_spatial_simulation(k, q, p, n, t, position, num_initial_infected, periodic,
+                                                sequential, backend=backend, profiler=profiler):
+        S.append(row['S'])
+        I.append(row['I'])
+        R.append(row['R'])
+
+    return S, I, R
 
+
+def iter_discrete_spatial_simulation(k, q, p, n, t=None, position='Center', num_initial_infected=5,
+                                     periodic=False, sequential=False, backend=None, snapshot=False,
+                                     profiler=None):
+    """
+    Generator version of discrete_spatial_simulation that yields the counts of
+    every step as soon as it is simulated, so that memory does not grow with
+    the number of steps
+    Input:
+        t(int): the number of time iterations, None to go on until the consumer stops
+        snapshot(bool): also yield the state codes (int8) and positions (float32) of all agents
+        Other arguments as in discrete_spatial_simulation (workers is not supported)
+
+    Yields:
+        Dictionaries {'day', 'S', 'I', 'R'} (and 'states', 'positions'), from
+        the initial counts at day 0. The random numbers are drawn as in
+        discrete_spatial_simulation, so both give the same counts for a seed.
+    """
+    if profiler is None:
+        profiler = NULL_PROFILER
+    profiler.begin('discreteSim_spatial.discrete_spatial_simulation', k=k, q=q, p=p, n=n, t=t,
+                   position=position, num_initial_infected=num_initial_infected,
+                   periodic=periodic, sequential=sequential, backend=backend, workers=None)
+
+    try:
+        if backend is not None:
+            yield from iter_array_simulation(k, q, p, n, t, position, num_initial_infected, periodic,
+                                             get_backend(backend), profiler, snapshot, sequential)
+            return
+
+        population = [Person(p, periodic) for i in range(n)] 
+
+        # Neighbour queries wrap around the torus when the domain is periodic
+        boxsize = 1.0 if periodic else None
+
+        if position == 'Center':
+            pos = np.array([0.5, 0.5])
+            for i in range(num_initial_infected):
+                population[i].initial_position(pos)
+                population[i].change_state()
+
+        elif position == 'Corner':
+            pos = np.array([0.0, 0.0])
+            for i in range(num_initial_infected):
+                population[i].initial_position(pos)
+                population[i].change_state()
+
+        elif position == 'Random':
+            for i in range(num_initial_infected):
+                population[i].change_state()
+
+        # Keeps the S, I, R counts up to date as transitions happen
+        pop_state = PopulationState(population, ('S', 'I', 'R'))
+
+        states = np.array([STATE_CODES[person.state] for person in population])
+
+        def day_row(day):
+            row = {'day': day, 'S': pop_state.count('S'), 'I': pop_state.count('I'), 'R': pop_state.count('R')}
+            if snapshot:
+                row['states'] = np.array([STATE_CODES[person.state] for person in population], dtype=np.int8)
+                row['positions'] = np.array([person.pos for person in population], dtype=np.float32)
+            return row
+
+        yield day_row(0)
+
+        step = 0
+        while t is None or step < t:
+            with profiler.phase('move'):
+                position = []
+                for person in population:
+                    person.move()
+                    position.append(person.pos)
+
+            if sequential:
+                infect_sequential(population, position, q, k, boxsize, profiler, pop_state)
+            else:
+                new_infected, recovered = infect_synchronous(np.array(position), states, q, k, boxsize, profiler)
+                # Only the agents that changed state need to be updated
+                with profiler.phase('infection'):
+                    pop_state.set_states(new_infected, 'I')
+                with profiler.phase('recovery'):
+                    pop_state.set_states(recovered, 'R')
+
+            step += 1
+            with profiler.phase('counting'):
+                row = day_row(step)
+            profiler.end_step(step, S=row['S'], I=row['I'], R=row['R'])
+            yield row
+    finally:
+        profiler.end()
+
+
+def initial_agents(n, position, num_initial_infected):
+    """
+    Returns the positions and integer states of the agents of the array path,
+    drawn in the same order as the Person objects draw them
+    Input:
+        Arguments as in discrete_spatial_simulation
+
+    Return:
+        Arrays pos of shape (n, 2) and states of shape (n,)
+    """
+    pos = np.random.rand(n, 2)
+    states = np.full(n, STATE_CODES['S'], dtype=np.int8)
+    states[:num_initial_infected] = STATE_CODES['I']
+    if position == 'Center':
+        pos[:num_initial_infected] = 0.5
     elif position == 'Corner':
-        pos = np.array([0.0, 0.0])
-        for i in range(num_initial_infected):
-            population[i].initial_position(pos)
-            population[i].change_state()
-
-    elif position == 'Random':
-        for i in range(num_initial_infected):
-            population[i].change_state()
-
-    S = [returnCounts(population, 'S')]
-    I = [returnCounts(population, 'I')]
-    R = [returnCounts(population, 'R')]
-
-    for t in range(t):
-        position = []
-        for p in population:
-            p.move()
-            position.append(p.pos)
-        tree = KDTree(position)
-        for i in range(n):
-            if population[i].state == 'I':
-                inds = tree.query_ball_point(position[i], q)
-                for ind in inds:
-                    if population[ind].state == 'S':
-                        population[ind].change_state()
-                if np.random.rand() < k:
-                    population[i].change_state()
+        pos[:num_initial_infected] = 0.0
+    return pos, states
 
-        S.append(returnCounts(population, 'S'))
-        I.append(returnCounts(population, 'I'))
-        R.append(returnCounts(population, 'R'))
 
-    return S, I, R
+def array_step(pos, states, k, q, p, periodic, backend, profiler=None, sequential=False):
+    """
+    Advances the agent arrays by one step: every agent moves, then the
+    synchronous (or sequential) infection and recovery are applied by the
+    kernels of backend
+    Input:
+        pos(array): (n, 2) positions, updated in place
+        states(array): integer state codes, updated in place
+        backend: object returned by sir.backend.get_backend
+        Other arguments as in discrete_spatial_simulation
+
+    Return:
+        Arrays of the newly infected and the newly recovered agent indices
+    """
+    if profiler is None:
+        profiler = NULL_PROFILER
+    with profiler.phase('move'):
+        directions = np.random.randn(len(pos), 2)
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        backend.move(pos, directions, p, periodic)
+
+    if sequential:
+        # Every visited agent draws for recovery after its infections, so the draws
+        # can follow the whole step
+        with profiler.phase('infection'):
+            new_infected, infected = backend.infect_sequential(pos, states, q, periodic)
+    else:
+        infected = np.flatnonzero(states == STATE_CODES['I'])
+        with profiler.phase('infection'):
+            new_infected = backend.infect(pos, states, q, periodic)
+    with profiler.phase('recovery'):
+        recovered = backend.recover(states, infected, np.random.rand(len(infected)), k)
+
+    return new_infected, recovered
+
+
+def iter_array_simulation(k, q, p, n, t, position, num_initial_infected, periodic, backend, profiler,
+                          snapshot=False, sequential=False):
+    """
+    The iter_discrete_spatial_simulation on arrays of positions and
+    states, with movement, infection and recovery done by the kernels of
+    backend (see sir.backend). The random numbers are drawn in the same order
+    as the Person objects draw them, so both paths agree for the same seed.
+    Input:
+        backend: object returned by sir.backend.get_backend
+        Other arguments as in iter_discrete_spatial_simulation
+    """
+    pos, states = initial_agents(n, position, num_initial_infected)
+    counts = np.bincount(states, minlength=3)
+
+    def day_row(day):
+        row = {'day': day, 'S': int(counts[0]), 'I': int(counts[1]), 'R': int(counts[2])}
+        if snapshot:
+            row['states'] = states.copy()
+            row['positions'] = pos.astype(np.float32)
+        return row
+
+    yield day_row(0)
+
+    step = 0
+    while t is None or step < t:
+        new_infected, recovered = array_step(pos, states, k, q, p, periodic, backend, profiler, sequential)
+
+        step += 1
+        with profiler.phase('counting'):
+            counts += [-len(new_infected), len(new_infected) - len(recovered), len(recovered)]
+            row = day_row(step)
+        profiler.end_step(step, S=row['S'], I=row['I'], R=row['R'])
+        yield row
@@ -0,0 +1,187 @@
+import multiprocessing
+import multiprocessing.connection
+
+import numpy as np
+
+from sir.backend import get_backend
+from sir.discreteSim_spatial import STATE_CODES, initial_agents
+from sir.profiling import NULL_PROFILER
+from sir.transport import SharedArrays
+
+
+def strip_of(x, strips):
+    """
+    Returns the strip 0 <= j < strips of the unit square [j / strips, (j + 1) / strips) holding x
+    """
+    return np.minimum((x * strips).astype(np.int64), strips - 1)
+
+
+def halo_strips(j, strips, q, periodic):
+    """
+    Returns the strips other than j that hold agents within distance q of strip j
+    """
+    reach = int(np.ceil(q * strips))
+    neighbours = np.arange(j - reach, j + reach + 1)
+    if periodic:
+        neighbours %= strips
+    else:
+        neighbours = neighbours[(neighbours >= 0) & (neighbours < strips)]
+    neighbours = np.unique(neighbours)
+    return neighbours[neighbours != j]
+
+
+def _strip_worker(w, workers, spec, n, t, k, q, p, periodic, backend, seed, barrier):
+    """
+    Runs one worker of decomposed_simulation
+
+    Worker w moves the w-th contiguous chunk of the agent indices and owns
+    the strip w of the unit square for infection and recovery.
+    """
+    shared = SharedArrays.attach(spec)
+    pos, states, strip_counts, order, deltas = [shared[name] for name in shared.keys()]
+
+    try:
+        rng = np.random.default_rng(seed)
+        backend = get_backend(backend)
+        chunk = np.array_split(np.arange(n), workers)[w]
+        lo, hi = w / workers, (w + 1) / workers
+        neighbours = halo_strips(w, workers, q, periodic)
+
+        for step in range(t):
+            # Movement of the agents of the index chunk
+            directions = rng.standard_normal((len(chunk), 2))
+            directions /= np.linalg.norm(directions, axis=1)[:, None]
+            moved = pos[chunk]
+            backend.move(moved, directions, p, periodic)
+            pos[chunk] = moved
+            barrier.wait()
+
+            # Parallel counting sort of all agents by strip: count, then scatter
+            strips = strip_of(pos[chunk, 0], workers)
+            strip_counts[w] = np.bincount(strips, minlength=workers)
+            barrier.wait()
+
+            totals = strip_counts.sum(axis=0)
+            start = np.concatenate([[0], np.cumsum(totals)])
+            offset = start[:-1] + strip_counts[:w].sum(axis=0)
+            sorted_chunk = chunk[np.argsort(strips, kind='stable')]
+            within = np.arange(len(chunk)) - np.repeat(np.cumsum(strip_counts[w]) - strip_counts[w], strip_counts[w])
+            order[np.repeat(offset, strip_counts[w]) + within] = sorted_chunk
+            barrier.wait()
+
+            # Snapshot of the owned strip and of the infected agents of the halo of width q
+            owned = order[start[w]:start[w + 1]].copy()
+            halo = np.concatenate([order[start[j]:start[j + 1]] for j in neighbours] + [np.empty(0, dtype=order.dtype)])
+            halo = halo[states[halo] == STATE_CODES['I']]
+            x = pos[halo, 0]
+            if periodic:
+                distance = np.minimum((lo - x) % 1.0, (x - hi) % 1.0)
+            else:
+                distance = np.maximum(lo - x, x - hi)
+            halo = halo[distance <= q]
+
+            local = np.concatenate([owned, halo])
+            local_pos = pos[local]
+            local_states = states[local].copy()
+            barrier.wait()
+
+            # Transitions of the owned agents, from the snapshot taken at the start of the step
+            infected = np.flatnonzero(local_states[:len(owned)] == STATE_CODES['I'])
+            new_infected = local[backend.infect(local_pos, local_states, q, periodic)]
+            recovered = owned[backend.recover(local_states, infected, rng.random(len(infected)), k)]
+            states[new_infected] = STATE_CODES['I']
+            states[recovered] = STATE_CODES['R']
+            deltas[step, w] = [-len(new_infected), len(new_infected) - len(recovered), len(recovered)]
+            barrier.wait()
+    except BaseException:
+        # Release the other workers from the barrier instead of leaving them waiting for this one
+        barrier.abort()
+        raise
+    finally:
+        # The views must be released before the blocks can be closed
+        del pos, states, strip_counts, order, deltas
+        shared.close()
+
+
+def decomposed_simulation(k, q, p, n, t, position='Center', num_initial_infected=5,
+                          periodic=False, workers=2, backend='auto', profiler=None, timeout=600):
+    """
+    The array based discrete_spatial_simulation split over worker processes
+
+    The unit square is cut into one vertical strip per worker. Positions and
+    states live in shared memory; each worker moves a fixed chunk of the agents,
+    the agents are sorted by strip with a parallel counting sort, and every
+    worker applies the infections and recoveries of the agents in its strip,
+    reading only the infected agents within distance q of its strip from its
+    neighbours. Barriers separate the phases of every step, so the update is
+    synchronous as in the single process engine. The random numbers are drawn
+    from per worker streams seeded from np.random, so runs are reproducible
+    for a seed but differ from the single process engine, which they match
+    statistically.
+
+    A worker that fails aborts the barrier, so the others stop too, and a
+    worker that is killed is noticed by this process, which then stops the
+    others; either way RuntimeError is raised instead of waiting forever.
+    Input:
+        workers(int): the number of worker processes (and strips)
+        backend(str): kernels of sir.backend used by the workers
+        timeout(float): longest time in seconds a worker waits for the others
+            at a barrier before giving up
+        Other arguments as in discrete_spatial_simulation
+
+    Return:
+        List of S, I, R at time t
+    """
+    if profiler is None:
+        profiler = NULL_PROFILER
+
+    # Initial state drawn as by the single process array path
+    initial_pos, initial_states = initial_agents(n, position, num_initial_infected)
+    seeds = np.random.SeedSequence(np.random.randint(2**31)).spawn(workers)
+
+    shared = SharedArrays({'pos': ((n, 2), np.float64),
+                           'states': ((n,), np.int8),
+                           'strip_counts': ((workers, workers), np.int64),
+                           'order': ((n,), np.int64),
+                           'deltas': ((t, workers, 3), np.int64)})
+    shared['pos'][:] = initial_pos
+    shared['states'][:] = initial_states
+
+    context = multiprocessing.get_context()
+    barrier = context.Barrier(workers, timeout=timeout)
+    processes = [context.Process(target=_strip_worker,
+                                 args=(w, workers, shared.spec, n, t, k, q, p, periodic, backend, seeds[w], barrier))
+                 for w in range(workers)]
+    try:
+        with profiler.phase('parallel'):
+            for process in processes:
+                process.start()
+            # Wait for the workers to exit, and stop the others as soon as one fails
+            running = list(processes)
+            while running:
+                multiprocessing.connection.wait([process.sentinel for process in running])
+                running = [process for process in running if process.exitcode is None]
+                if any(process.exitcode not in (None, 0) for process in processes):
+                    barrier.abort()
+                    break
+        failed = [w for w, process in enumerate(processes) if process.exitcode not in (None, 0)]
+        if failed:
+            raise RuntimeError(f'worker {failed[0]} of the domain decomposed simulation failed '
+                               f'with exit code {processes[failed[0]].exitcode}')
+
+        initial_counts = np.bincount(initial_states, minlength=3)
+        counts = np.concatenate([initial_counts[None], initial_counts + np.cumsum(shared['deltas'].sum(axis=1), axis=0)])
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            if process.pid is not None:
+                process.join()
+        shared.close()
+        shared.unlink()
+
+    for step in range(1, t + 1):
+        profiler.end_step(step, S=counts[step, 0], I=counts[step, 1], R=counts[step, 2])
+    profiler.end()
+
+    return [int(c) for c in counts[:, 0]], [int(c) for c in counts[:, 1]], [int(c) for c in counts[:, 2]]
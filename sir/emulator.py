@@ -0,0 +1,291 @@
+"""
+Gaussian process emulators of the simulation engines
+
+An Emulator is trained on full runs of an engine at a space filling design of
+parameter values, e.g. of odeSim_spatial over p and b, and then answers
+queries such as the final recovered fraction at p = 0.4, b = 1.2 in
+microseconds, with the standard deviation of the prediction. A query whose
+standard deviation is larger than max_std runs the engine instead, and the run
+is added to the training set.
+
+Example:
+    emulator = Emulator('odeSim_spatial', {'p': (0.1, 1.0), 'b': (0.5, 3.0)},
+                        params={'M': 50, 't': 200}, output='attack_rate', max_std=0.01)
+    emulator.train(32)
+    value, std = emulator.query({'p': 0.4, 'b': 1.2})
+"""
+import numpy as np
+
+from sir.cache import save_npz
+from sir.sensitivity import evaluate, integer_flags, scale
+
+# Bounds of the log hyperparameters of GaussianProcess on inputs scaled to the
+# unit cube and standardized outputs: length scales, signal variance, noise variance
+LOG_BOUNDS = {'length_scale': (np.log(1e-2), np.log(1e2)),
+              'signal': (np.log(1e-2), np.log(1e2)),
+              'noise': (np.log(1e-10), np.log(1.0))}
+
+
+class GaussianProcess():
+    """
+    Gaussian process regression with a squared exponential kernel with one
+    length scale per input (automatic relevance determination) and a noise
+    term, whose hyperparameters maximize the marginal likelihood
+
+    Inputs are expected in the unit cube; the outputs are standardized internally.
+
+    Optional Arguments:
+        restarts - Number of starting points of the hyperparameter optimization (default 3)
+        seed - Seed of the random starting points (default 0)
+    """
+
+    def __init__(self, restarts=3, seed=0):
+        self.restarts = restarts
+        self.seed = seed
+        self.theta = None
+        self.X = None
+
+    def _kernel(self, X1, X2, theta):
+        length = np.exp(theta[:-2])
+        d2 = (((X1[:, None, :] - X2[None, :, :]) / length)**2)
+        return np.exp(theta[-2]) * np.exp(-0.5 * d2.sum(axis=2)), d2
+
+    def _nll(self, theta, X, y):
+        """
+        Negative log marginal likelihood and its gradient with respect to the log hyperparameters
+        """
+        from scipy.linalg import cho_factor, cho_solve
+        Kf, d2 = self._kernel(X, X, theta)
+        K = Kf + (np.exp(theta[-1]) + 1e-10) * np.eye(len(X))
+        try:
+            factor = cho_factor(K, lower=True)
+        except np.linalg.LinAlgError:
+            return np.inf, np.zeros_like(theta)
+        alpha = cho_solve(factor, y)
+        nll = 0.5 * y @ alpha + np.log(np.diag(factor[0])).sum() + 0.5 * len(X) * np.log(2 * np.pi)
+
+        W = np.outer(alpha, alpha) - cho_solve(factor, np.eye(len(X)))
+        grad = np.empty_like(theta)
+        grad[:-2] = -0.5 * np.einsum('ij,ij,ijd->d', W, Kf, d2)
+        grad[-2] = -0.5 * np.sum(W * Kf)
+        grad[-1] = -0.5 * np.exp(theta[-1]) * np.trace(W)
+        return nll, grad
+
+    def fit(self, X, y, optimize=True):
+        """
+        Fits the process to the points X (m, D) in the unit cube and outputs y (m,).
+        With optimize=False the hyperparameters of the previous fit are kept, and
+        when X extends the points of the previous fit its Cholesky factor is
+        extended by the new rows in O(m**2) per point instead of refactorized.
+        """
+        from scipy.linalg import cho_factor, cho_solve
+        from scipy.optimize import minimize
+        X = np.asarray(X, dtype=float)
+        extend = (not optimize and self.X is not None and self.theta is not None
+                  and len(X) > len(self.X) and np.array_equal(X[:len(self.X)], self.X))
+        previous = self.X
+        self.X = X
+        y = np.asarray(y, dtype=float)
+        self.mean = y.mean()
+        self.std = y.std() if y.std() > 0 else 1.0
+        z = (y - self.mean) / self.std
+        D = self.X.shape[1]
+
+        if optimize or self.theta is None:
+            bounds = [LOG_BOUNDS['length_scale']] * D + [LOG_BOUNDS['signal'], LOG_BOUNDS['noise']]
+            rng = np.random.default_rng(self.seed)
+            starts = [np.concatenate([np.full(D, np.log(0.3)), [0.0, np.log(1e-4)]])]
+            if self.theta is not None:
+                starts.append(self.theta)
+            starts += [np.array([rng.uniform(low, high) for low, high in bounds]) for i in range(self.restarts - 1)]
+
+            best = None
+            for start in starts:
+                fit = minimize(self._nll, start, args=(self.X, z), jac=True, method='L-BFGS-B', bounds=bounds)
+                if best is None or fit.fun < best.fun:
+                    best = fit
+            self.theta = best.x
+
+        if extend:
+            self.factor = (self._extend_factor(previous, self.X[len(previous):]), True)
+        else:
+            K = self._kernel(self.X, self.X, self.theta)[0] + (np.exp(self.theta[-1]) + 1e-10) * np.eye(len(self.X))
+            self.factor = cho_factor(K, lower=True)
+        self.alpha = cho_solve(self.factor, z)
+        self.inverse_length = np.exp(-self.theta[:-2])
+        self.signal = np.exp(self.theta[-2])
+        return self
+
+    def _extend_factor(self, X1, X2):
+        """
+        Returns the lower Cholesky factor of the kernel matrix of the points X1
+        followed by X2 from the factor of X1: with K = [[K11, K12], [K21, K22]]
+        and K11 = L11 L11^T, the new rows are L21 = (L11^-1 K12)^T and
+        L22 = chol(K22 - L21 L21^T)
+        """
+        from scipy.linalg import cholesky, solve_triangular
+        m, r = len(X1), len(X2)
+        noise = (np.exp(self.theta[-1]) + 1e-10) * np.eye(r)
+        L11 = np.tril(self.factor[0])
+        L21 = solve_triangular(L11, self._kernel(X1, X2, self.theta)[0], lower=True).T
+        L22 = cholesky(self._kernel(X2, X2, self.theta)[0] + noise - L21 @ L21.T, lower=True)
+        L = np.zeros((m + r, m + r))
+        L[:m, :m] = L11
+        L[m:, :m] = L21
+        L[m:, m:] = L22
+        return L
+
+    def predict(self, X):
+        """
+        Returns the mean and standard deviation of the predictions at the points X (m, D)
+        """
+        from scipy.linalg import solve_triangular
+        if self.X is None:
+            raise RuntimeError('the Gaussian process is not fitted yet, call fit first')
+        X = np.atleast_2d(X)
+        d = (X[:, None, :] - self.X[None, :, :]) * self.inverse_length
+        k = self.signal * np.exp(-0.5 * np.einsum('ijd,ijd->ij', d, d))
+        v = solve_triangular(self.factor[0], k.T, lower=True)
+        var = np.maximum(self.signal - np.einsum('ij,ij->j', v, v), 0)
+        return self.mean + self.std * (k @ self.alpha), self.std * np.sqrt(var)
+
+
+class Emulator():
+    """
+    Surrogate of one output of an engine as a function of some of its parameters
+
+    Arguments:
+        model - Name of a registered engine, or a batched function of an (m, D)
+            array of parameter values (see sir.sensitivity.evaluate)
+        bounds - Dictionary of parameter name to (low, high) of the emulated parameters
+
+    Optional Arguments:
+        params - Fixed keyword arguments of the engine (default None)
+        output - Summary of a run that is emulated, one of sir.sensitivity.OUTPUTS (default 'attack_rate')
+        max_std - Queries whose standard deviation exceeds this run the engine (default None, never)
+        refit_every - Runs added by queries between full hyperparameter optimizations;
+            in between the Cholesky factor is only extended by the new runs (default 10)
+        seed - Seed of the runs and of the design (default 0)
+        cache - sir.cache.ResultCache of the runs of the design (default None)
+        workers - Worker processes for the runs of the design (default os.cpu_count())
+    """
+
+    def __init__(self, model, bounds, params=None, output='attack_rate', max_std=None, refit_every=10,
+                 seed=0, cache=None, workers=None):
+        self.model = model
+        self.bounds = dict(bounds)
+        self.names = list(bounds)
+        self.params = params
+        self.output = output
+        self.max_std = max_std
+        self.refit_every = refit_every
+        self.seed = seed
+        self.cache = cache
+        self.workers = workers
+        self.low = np.array([low for low, high in self.bounds.values()], dtype=float)
+        self.high = np.array([high for low, high in self.bounds.values()], dtype=float)
+        self.X = np.empty((0, len(self.names)))
+        self.y = np.empty(0)
+        self.added = 0
+        self.runs = 0
+        self.gp = GaussianProcess(seed=seed)
+
+    def _unit(self, X):
+        return (np.asarray(X, dtype=float) - self.low) / (self.high - self.low)
+
+    def _points(self, query):
+        """
+        Returns an (m, D) array of parameter values from a dictionary, a sequence or an array
+        """
+        if isinstance(query, dict):
+            return np.array([[query[name] for name in self.names]], dtype=float)
+        return np.atleast_2d(np.asarray(query, dtype=float))
+
+    def run(self, X):
+        """
+        Runs the full model at the points X (m, D) and returns the outputs
+        """
+        self.runs += len(X)
+        return evaluate(self.model, X, self.names, self.params, self.seed, self.output, self.workers, self.cache,
+                        integer=integer_flags(self.bounds))
+
+    def train(self, N, X=None):
+        """
+        Runs the model at N points of a scrambled Sobol sequence (or at the
+        given points X) and fits the Gaussian process to all runs so far
+        """
+        if X is None:
+            from scipy.stats import qmc
+            X = scale(qmc.Sobol(d=len(self.names), scramble=True, seed=self.seed).random(N), self.bounds)
+        self.add(X, self.run(X), optimize=True)
+        return self
+
+    def add(self, X, y, optimize=True):
+        """
+        Adds runs to the training set and refits
+        """
+        self.X = np.concatenate([self.X, self._points(X)])
+        self.y = np.concatenate([self.y, np.atleast_1d(y)])
+        self.gp.fit(self._unit(self.X), self.y, optimize=optimize)
+
+    def predict(self, query):
+        """
+        Returns the emulated mean and standard deviation at the query points,
+        a dictionary of parameter values or an (m, D) array
+        """
+        if len(self.X) == 0:
+            raise RuntimeError('the emulator has no training runs yet, call train or load first')
+        return self.gp.predict(self._unit(self._points(query)))
+
+    def query(self, query, max_std=None):
+        """
+        Answers a query with the emulator, or with the full model where the
+        standard deviation of the emulator exceeds max_std (default
+        self.max_std); those runs are added to the training set
+        Return:
+            Arrays of the values and of their standard deviations, 0 for runs
+            of the full model; scalars for a dictionary query
+        """
+        if max_std is None:
+            max_std = self.max_std
+        X = self._points(query)
+        mean, std = self.predict(X)
+
+        if max_std is not None and np.any(std > max_std):
+            uncertain = std > max_std
+            y = self.run(X[uncertain])
+            mean[uncertain] = y
+            std[uncertain] = 0
+            self.added += len(y)
+            optimize = self.added >= self.refit_every
+            if optimize:
+                self.added = 0
+            self.add(X[uncertain], y, optimize=optimize)
+
+        if isinstance(query, dict):
+            return mean[0], std[0]
+        return mean, std
+
+    def save(self, filename):
+        """
+        Writes the training set and hyperparameters (once fitted) to an .npz file
+        """
+        arrays = {'names': np.array(self.names), 'X': self.X, 'y': self.y}
+        if self.gp.theta is not None:
+            arrays['theta'] = self.gp.theta
+        save_npz(filename, arrays)
+
+    def load(self, filename):
+        """
+        Reads a training set written by save and refits with its hyperparameters,
+        or optimizes them when the file was saved before the first fit
+        """
+        with np.load(filename) as data:
+            if list(data['names']) != self.names:
+                raise ValueError(f'{filename} emulates {list(data["names"])}, not {self.names}')
+            self.X, self.y = data['X'], data['y']
+            self.gp = GaussianProcess(seed=self.seed)
+            self.gp.theta = data['theta'] if 'theta' in data.files else None
+        if len(self.X) > 0:
+            self.gp.fit(self._unit(self.X), self.y, optimize=False)
+        return self
@@ -0,0 +1,119 @@
+import inspect
+
+import numpy as np
+
+from sir.odeSim import odeSim
+from sir import discreteSim
+from sir import discreteSim_spatial
+from sir import variation_2
+from sir import varsim_tori
+from sir.odeSim_spatial import odeSim_spatial
+
+# Arguments of the entry points that do not change the result of a run
+RUN_OPTIONS = ('profiler',)
+
+
+class Engine():
+    """
+    Describes one simulation entry point so that it can be run by name
+
+    Arguments:
+        name - Name of the engine, e.g. 'discreteSim'
+        fn - Function running one simulation and returning a tuple of arrays
+        outputs - Names of the arrays returned by fn
+
+    Optional Arguments:
+        stochastic - Whether the result depends on the random seed (default True)
+        version - Bumped whenever a change to the engine changes its results (default 1)
+    """
+
+    def __init__(self, name, fn, outputs, stochastic=True, version=1):
+        self.name = name
+        self.fn = fn
+        self.outputs = tuple(outputs)
+        self.stochastic = stochastic
+        self.version = version
+        self.signature = inspect.signature(fn)
+
+    def normalize(self, params):
+        """
+        Returns params with every default filled in and the run options removed,
+        so that equal runs have equal parameters however they were called
+        """
+        bound = self.signature.bind(**params)
+        bound.apply_defaults()
+        return {key: value for key, value in bound.arguments.items() if key not in RUN_OPTIONS}
+
+    def run(self, params, seed=None):
+        """
+        Runs the engine and returns a dictionary of output name to array
+        """
+        if seed is not None:
+            np.random.seed(seed)
+        result = self.fn(**params)
+        return {name: np.asarray(value) for name, value in zip(self.outputs, result)}
+
+
+def _solve_odes(n, b=1/2, k=1/3, t=500, profiler=None):
+    """
+    odeSim.solve_odes returning the time points and the s, i, r fractions
+    """
+    sol = odeSim(n, b, k, t).solve_odes(profiler=profiler)
+    return sol.t, sol.y[0], sol.y[1], sol.y[2]
+
+
+def _solve_pdes(n=100, b=3, k=0.1, p=1, t=400, M=200, initial_position=None, periodic=False, profiler=None):
+    """
+    odeSim_spatial.solve_pdes returning the time points and the mean s, i, r fractions
+    """
+    model = odeSim_spatial(n=n, b=b, k=k, p=p, t=t, M=M, initial_position=initial_position, periodic=periodic)
+    return model.solve_pdes(profiler=profiler)
+
+
+ENGINES = {}
+
+
+def register(engine):
+    """
+    Adds an Engine to the registry so that it can be run by name
+    """
+    ENGINES[engine.name] = engine
+    return engine
+
+
+register(Engine('odeSim', _solve_odes, ('t', 's', 'i', 'r'), stochastic=False))
+register(Engine('discreteSim', discreteSim.simulateSIR, ('S', 'I', 'R')))
+register(Engine('discreteSim_spatial', discreteSim_spatial.discrete_spatial_simulation, ('S', 'I', 'R')))
+# Version 2: the lockdown neighbour indices map to the right people
+register(Engine('variation_2', variation_2.runSimulation, ('S', 'I', 'R'), version=2))
+register(Engine('varsim_tori', varsim_tori.simulateSIR, ('S', 'I_A', 'I_S', 'R')))
+register(Engine('odeSim_spatial', _solve_pdes, ('t', 's', 'i', 'r')))
+
+
+def get_engine(name):
+    """
+    Returns the registered Engine called name
+    """
+    if name not in ENGINES:
+        raise KeyError(f'unknown engine {name!r}, expected one of {sorted(ENGINES)}')
+    return ENGINES[name]
+
+
+def run_engine(name, params, seed=None, cache=None):
+    """
+    Runs the engine called name with the keyword arguments in params
+
+    Arguments:
+        name - Name of a registered engine, e.g. 'odeSim_spatial'
+        params - Dictionary of keyword arguments of the engine's entry point
+
+    Optional Arguments:
+        seed - Seed of numpy's global random generator for this run (default None)
+        cache - sir.cache.ResultCache the run goes through (default None)
+
+    Returns a dictionary of output name to array
+    """
+    engine = get_engine(name)
+    if cache is not None:
+        return cache.run(engine, params, seed)
+    return engine.run(params, seed)
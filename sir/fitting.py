@@ -0,0 +1,264 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def segment_index(n_days, knots):
+    """
+    Returns for every day d < n_days the index of the segment of b(t) that holds on [d, d + 1)
+
+    b(t) is piecewise constant and changes value at the days listed in knots
+    """
+    return np.searchsorted(np.asarray(knots), np.arange(n_days), side='right')
+
+
+def simulate_sensitivities(b, k, y0, n_days, knots=(), substeps=4):
+    """
+    Integrates the odeSim equations together with their forward sensitivities,
+    vectorized over a batch of parameter sets
+
+    s'(t) = -b(t) * s(t) * i(t)
+    i'(t) = b(t) * s(t) * i(t) - k * i(t)
+    r'(t) = k * i(t)
+
+    The sensitivities dy/dtheta of y = (s, i, r) with respect to the parameters
+    theta = (b_0, ..., b_m, k) follow dS/dt = J S + df/dtheta, where J is the
+    Jacobian of the right hand side. Both systems are advanced with a classical
+    fourth order Runge-Kutta method with substeps steps per day.
+
+    Arguments:
+        b - (R, m + 1) values of b(t) on each segment, for R parameter sets
+        k - (R,) recovery rates
+        y0 - (R, 3) initial fractions s, i, r
+        n_days - Number of days to output, starting at day 0
+
+    Optional Arguments:
+        knots - Days at which b(t) changes segment (default (), i.e. constant b)
+        substeps - Runge-Kutta steps per day (default 4)
+
+    Returns y of shape (R, n_days, 3) and the sensitivities of shape (R, n_days, 3, m + 2)
+    """
+    b = np.atleast_2d(np.asarray(b, dtype=float))
+    k = np.asarray(k, dtype=float).reshape(-1)
+    R, Pb = b.shape
+    P = Pb + 1
+
+    y = np.array(y0, dtype=float).reshape(R, 3)
+    S = np.zeros((R, 3, P))
+
+    ys = np.empty((R, n_days, 3))
+    sens = np.empty((R, n_days, 3, P))
+    ys[:, 0] = y
+    sens[:, 0] = S
+
+    def rhs(y, S, bj, j):
+        s = y[:, 0]
+        i = y[:, 1]
+        infection = bj * s * i
+        recovery = k * i
+        dy = np.stack([-infection, infection - recovery, recovery], axis=1)
+
+        # J @ S written out for the sparse 3 x 3 Jacobian J of the right hand side
+        dS_s = -(bj * i)[:, None] * S[:, 0] - (bj * s)[:, None] * S[:, 1]
+        dS_r = k[:, None] * S[:, 1]
+        dS = np.stack([dS_s, -dS_s - dS_r, dS_r], axis=1)
+
+        # Direct dependence of the right hand side on b_j and k
+        dS[:, 0, j] -= s * i
+        dS[:, 1, j] += s * i
+        dS[:, 1, Pb] -= i
+        dS[:, 2, Pb] += i
+        return dy, dS
+
+    h = 1 / substeps
+    segments = segment_index(n_days - 1, knots)
+    for day in range(n_days - 1):
+        j = segments[day]
+        bj = b[:, j]
+        for step in range(substeps):
+            k1y, k1S = rhs(y, S, bj, j)
+            k2y, k2S = rhs(y + h / 2 * k1y, S + h / 2 * k1S, bj, j)
+            k3y, k3S = rhs(y + h / 2 * k2y, S + h / 2 * k2S, bj, j)
+            k4y, k4S = rhs(y + h * k3y, S + h * k3S, bj, j)
+            y = y + h / 6 * (k1y + 2 * k2y + 2 * k3y + k4y)
+            S = S + h / 6 * (k1S + 2 * k2S + 2 * k3S + k4S)
+        ys[:, day + 1] = y
+        sens[:, day + 1] = S
+
+    return ys, sens
+
+
+def _least_squares_batch(i_obs, r_obs, y0, knots, theta, max_iter=100, substeps=4, tol=1e-10):
+    """
+    Batched Levenberg-Marquardt fit of log(b_0, ..., b_m, k) to the observed i and r fractions
+
+    Every row of the batch is an independent least squares problem; all rows
+    are advanced together so that the cost is a handful of vectorized ODE solves.
+    Missing observations (NaN) do not contribute to the residuals.
+
+    Returns the fitted log parameters (R, P) and the sums of squared residuals (R,)
+    """
+    R, T = i_obs.shape
+    observed = np.concatenate([~np.isnan(i_obs), ~np.isnan(r_obs)], axis=1)
+    obs = np.nan_to_num(np.concatenate([i_obs, r_obs], axis=1))
+
+    def evaluate(theta, rows):
+        params = np.exp(theta)
+        y, sens = simulate_sensitivities(params[:, :-1], params[:, -1], y0[rows], T, knots, substeps)
+        res = np.concatenate([y[:, :, 1], y[:, :, 2]], axis=1) - obs[rows]
+        res[~observed[rows]] = 0
+        # Chain rule for the log parametrization, which keeps b and k positive
+        J = np.concatenate([sens[:, :, 1, :], sens[:, :, 2, :]], axis=1) * params[:, None, :]
+        J[~observed[rows]] = 0
+        sse = np.sum(res**2, axis=1)
+        return res, J, np.where(np.isfinite(sse), sse, np.inf)
+
+    rows = np.arange(R)
+    res, J, sse = evaluate(theta, rows)
+    damping = np.full(R, 1e-3)
+    active = np.ones(R, dtype=bool)
+
+    for iteration in range(max_iter):
+        # Only the rows that have not converged yet are advanced
+        rows = np.flatnonzero(active)
+        A = np.einsum('rmp,rmq->rpq', J[rows], J[rows])
+        g = np.einsum('rmp,rm->rp', J[rows], res[rows])
+        diag = np.einsum('rpp->rp', A) + 1e-12
+        A_damped = A + damping[rows, None, None] * np.einsum('rp,pq->rpq', diag, np.eye(A.shape[1]))
+        step = -np.linalg.solve(A_damped, g[:, :, None])[:, :, 0]
+        step = np.clip(step, -2, 2)
+
+        with np.errstate(over='ignore', invalid='ignore'):
+            trial = theta[rows] + step
+            res_trial, J_trial, sse_trial = evaluate(trial, rows)
+
+        better = sse_trial < sse[rows]
+        converged = better & (sse[rows] - sse_trial <= tol * np.maximum(sse[rows], 1e-300))
+
+        accepted = rows[better]
+        theta[accepted] = trial[better]
+        res[accepted] = res_trial[better]
+        J[accepted] = J_trial[better]
+        sse[accepted] = sse_trial[better]
+        damping[rows] = np.where(better, damping[rows] / 3, damping[rows] * 4)
+
+        active[rows[converged]] = False
+        active &= damping < 1e10
+        if not np.any(active):
+            break
+
+    return theta, sse
+
+
+def _fit_chunk(args):
+    """
+    Fits one chunk of regions with several starting points per region
+    """
+    i_obs, r_obs, knots, starts, b_range, k_range, seed, max_iter, substeps = args
+    R, T = i_obs.shape
+    Pb = len(knots) + 1
+    rng = np.random.default_rng(seed)
+
+    # Log-uniform starting points, starts per region
+    log_b = rng.uniform(np.log(b_range[0]), np.log(b_range[1]), size=(R * starts, Pb))
+    log_k = rng.uniform(np.log(k_range[0]), np.log(k_range[1]), size=(R * starts, 1))
+    theta = np.concatenate([log_b, log_k], axis=1)
+
+    i_rep = np.repeat(i_obs, starts, axis=0)
+    r_rep = np.repeat(r_obs, starts, axis=0)
+    y0 = np.stack([1 - i_rep[:, 0] - r_rep[:, 0], i_rep[:, 0], r_rep[:, 0]], axis=1)
+
+    theta, sse = _least_squares_batch(i_rep, r_rep, y0, knots, theta, max_iter, substeps)
+
+    # Keep the best start of every region
+    sse = sse.reshape(R, starts)
+    best = np.argmin(sse, axis=1)
+    theta = theta.reshape(R, starts, -1)[np.arange(R), best]
+    return np.exp(theta), sse[np.arange(R), best]
+
+
+class FitResult():
+    """
+    Result of fit_odeSim
+
+    Attributes:
+        b - (R, m + 1) fitted values of b(t) on each segment (one column without knots)
+        k - (R,) fitted recovery rates
+        sse - (R,) sums of squared residuals of the i and r fractions
+        knots - Days at which b(t) changes segment
+        y0 - (R, 3) initial fractions taken from the first observation
+    """
+
+    def __init__(self, b, k, sse, knots, y0):
+        self.b = b
+        self.k = k
+        self.sse = sse
+        self.knots = tuple(knots)
+        self.y0 = y0
+
+    def predict(self, n_days, substeps=4):
+        """
+        Returns the fitted s, i, r fractions, each of shape (R, n_days)
+        """
+        y, sens = simulate_sensitivities(self.b, self.k, self.y0, n_days, self.knots, substeps)
+        return y[:, :, 0], y[:, :, 1], y[:, :, 2]
+
+
+def fit_odeSim(i_obs, r_obs, knots=(), starts=8, b_range=(0.01, 2), k_range=(0.01, 1),
+               workers=1, seed=None, max_iter=100, substeps=4):
+    """
+    Estimates b (or a piecewise constant b(t)) and k of the odeSim model from observed curves
+
+    The i and r fractions of every region are fitted by least squares, using
+    forward sensitivities for the exact Jacobian. Each region is fitted from
+    several random starting points at once and the best fit is kept. Regions
+    are processed as vectorized batches, split over worker processes.
+
+    Arguments:
+        i_obs - Observed infected fractions, shape (T,) for one region or (R, T);
+            missing days are NaN, except day 0, which gives the initial state
+        r_obs - Observed removed fractions, same shape as i_obs
+
+    Optional Arguments:
+        knots - Days at which b(t) changes value (default (), i.e. constant b)
+        starts - Number of starting points per region (default 8)
+        b_range - Range of the starting values of b (default (0.01, 2))
+        k_range - Range of the starting values of k (default (0.01, 1))
+        workers - Number of worker processes, 1 fits in this process (default 1)
+        seed - Seed of the starting points (default None)
+        max_iter - Maximum number of Levenberg-Marquardt iterations (default 100)
+        substeps - Runge-Kutta steps per day (default 4)
+
+    Returns a FitResult with one row per region
+    """
+    i_obs = np.atleast_2d(np.asarray(i_obs, dtype=float))
+    r_obs = np.atleast_2d(np.asarray(r_obs, dtype=float))
+    knots = tuple(knots)
+
+    # Day 0 seeds the initial state of every fit, so a NaN there would make the whole fit NaN
+    missing = np.flatnonzero(np.isnan(i_obs[:, 0]) | np.isnan(r_obs[:, 0]))
+    if len(missing) > 0:
+        raise ValueError('The observations of day 0 give the initial state and must not be NaN, '
+                         'but they are for the regions {}'.format(missing.tolist()))
+
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(1, min(workers, len(i_obs)))
+
+    chunks = np.array_split(np.arange(len(i_obs)), workers)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    tasks = [(i_obs[chunk], r_obs[chunk], knots, starts, b_range, k_range, chunk_seed, max_iter, substeps)
+             for chunk, chunk_seed in zip(chunks, seeds)]
+
+    if workers == 1:
+        results = [_fit_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_fit_chunk, tasks))
+
+    params = np.concatenate([result[0] for result in results])
+    sse = np.concatenate([result[1] for result in results])
+    y0 = np.stack([1 - i_obs[:, 0] - r_obs[:, 0], i_obs[:, 0], r_obs[:, 0]], axis=1)
+
+    return FitResult(params[:, :-1], params[:, -1], sse, knots, y0)
@@ -0,0 +1,559 @@
+"""
+Likelihood free inference for the stochastic engines
+
+The per person loops of discreteSim and varsim_tori are far too slow for the
+millions of runs that inference needs, so this module simulates them with
+count based chain binomial kernels instead: the state of a particle is its
+row of compartment counts, and thousands of particles are advanced at once as
+one (particles, compartments) array per day.
+
+Each infected person makes b contacts with random other people, and the
+infected are visited in index order, so someone infected by a person with a
+lower index spreads on the same day. The kernels follow this with a sweep
+over SWEEP_BLOCKS blocks of indices: the infected of the start of the day are
+spread uniformly over the blocks, and the people infected in a block join the
+infected of the blocks ahead, or of the same block with probability one half.
+Patient zero has index 0, so everyone it infects first spreads on that day.
+The contacts of the infected of a block hit Binomial(b * I, S / (n - 1))
+susceptibles, and the new infections are the susceptibles hit at least once:
+the hits less a binomial number of repeated hits, with the mean of the
+occupancy problem, so that the exactly b contacts per person are kept and
+early extinction is as likely as in the per person model. Everyone infected
+at the end of the day then recovers with probability k. A non integer b * I
+is rounded up or down at random.
+
+Example:
+    data = {'I': I_obs, 'R': R_obs}                           # e.g. from discreteSim.simulateSIR
+    posterior = abc_smc('discreteSim', data, 1000, {'b': (0.5, 5), 'k': (0.05, 0.5)})
+    posterior.mean()                                           # {'b': ..., 'k': ...}
+    bootstrap_filter('discreteSim', data, 1000, {'b': 2, 'k': 0.3})['log_likelihood']
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from sir.profiling import NULL_PROFILER
+
+# Blocks of indices of the sweep over the infected of a day, see _sweep
+SWEEP_BLOCKS = 8
+
+
+def _contacts(expected, rng):
+    """
+    Rounds the expected numbers of contacts up or down at random, keeping their mean
+    """
+    whole = np.floor(expected)
+    return (whole + (rng.random(len(expected)) < expected - whole)).astype(np.int64)
+
+
+def _infections(S, hits, rng):
+    """
+    Number of distinct people among hits random hits of S susceptibles
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distinct = np.where(hits > 0, -S * np.expm1(hits * np.log1p(-1 / np.maximum(S, 1))), 0)
+        repeats = rng.binomial(hits, np.clip(1 - distinct / np.maximum(hits, 1), 0, 1))
+    return np.minimum(hits - repeats, S)
+
+
+def _sweep(S, infected, rates, b, n, rng, blocks=SWEEP_BLOCKS):
+    """
+    Returns the new infections of a day in every infected compartment, for the
+    infected visited in index order in blocks
+    Input:
+        S(array): susceptibles of the P particles
+        infected(list): the P counts of every infected compartment
+        rates(list): probability that a contact of each infected compartment infects a susceptible
+        b(array): contacts per infected person of the P particles
+        n(int): population size
+        rng: numpy.random.Generator or numpy.random
+        blocks(int): number of blocks of indices
+    """
+    S = S.copy()
+    ahead = [I.copy() for I in infected]
+    new = [np.zeros_like(S) for I in infected]
+    rates = [np.broadcast_to(np.asarray(rate, dtype=float), S.shape) for rate in rates]
+
+    # While nobody else was ever infected, the only infected is patient zero with index 0
+    first = S == n - 1
+    for j in range(blocks):
+        spreaders = [rng.binomial(pool, 1 / (blocks - j)) for pool in ahead]
+        if j == 0:
+            spreaders = [np.where(first, pool, spread) for pool, spread in zip(ahead, spreaders)]
+        for pool, spread in zip(ahead, spreaders):
+            pool -= spread
+        same = np.where(first, 1.0, 0.5) if j == 0 else np.full(len(S), 0.5)
+
+        # New infections in later blocks wait for their block, those ahead in this
+        # block spread now, which only involves the particles that still have spreaders
+        active = np.flatnonzero(sum(spreaders))
+        spreaders = [spread[active] for spread in spreaders]
+        while len(active):
+            hits = sum(rng.binomial(_contacts(b[active] * spread, rng), rate[active] * S[active] / (n - 1))
+                       for spread, rate in zip(spreaders, rates))
+            infections = _infections(S[active], hits, rng)
+            S[active] -= infections
+            if len(infected) == 1:
+                kinds = [infections]
+            else:
+                asymptomatic = rng.binomial(infections, 0.5)
+                kinds = [asymptomatic, infections - asymptomatic]
+
+            spreaders = []
+            for pool, total, kind in zip(ahead, new, kinds):
+                total[active] += kind
+                later = rng.binomial(kind, (blocks - 1 - j) / blocks)
+                pool[active] += later
+                spreaders.append(rng.binomial(kind - later, same[active] / (j + 1)))
+            same[active] = 0.5
+            keep = np.flatnonzero(sum(spreaders))
+            active = active[keep]
+            spreaders = [spread[keep] for spread in spreaders]
+    return new
+
+
+def sir_step(X, theta, n, rng=np.random):
+    """
+    Advances the (P, 3) counts S, I, R of discreteSim by one day in place
+    Input:
+        X(array): integer counts of the P particles
+        theta(array): (P, 2) values of b and k of every particle
+        n(int): population size
+        rng: numpy.random.Generator, or the global numpy.random (default)
+
+    Return:
+        X
+    """
+    b, k = theta[:, 0], theta[:, 1]
+    S, I = X[:, 0], X[:, 1]
+    new, = _sweep(S, [I], [1.0], b, n, rng)
+    recovered = rng.binomial(I + new, k)
+    X[:, 0] -= new
+    X[:, 1] += new - recovered
+    X[:, 2] += recovered
+    return X
+
+
+def tori_step(X, theta, n, rng=np.random):
+    """
+    Advances the (P, 4) counts S, I_A, I_S, R of varsim_tori by one day in place
+
+    A contact of an asymptomatic person infects with probability a and one of a
+    symptomatic person with probability c; half of the new infections are
+    asymptomatic on average, and both kinds of infected recover with probability k.
+    Input:
+        X(array): integer counts of the P particles
+        theta(array): (P, 4) values of b, k, a and c of every particle
+        n(int): population size
+        rng: numpy.random.Generator, or the global numpy.random (default)
+
+    Return:
+        X
+    """
+    b, k, a, c = theta[:, 0], theta[:, 1], theta[:, 2], theta[:, 3]
+    S, I_A, I_S = X[:, 0], X[:, 1], X[:, 2]
+    new_A, new_S = _sweep(S, [I_A, I_S], [a, c], b, n, rng)
+    recovered_A = rng.binomial(I_A + new_A, k)
+    recovered_S = rng.binomial(I_S + new_S, k)
+    X[:, 0] -= new_A + new_S
+    X[:, 1] += new_A - recovered_A
+    X[:, 2] += new_S - recovered_S
+    X[:, 3] += recovered_A + recovered_S
+    return X
+
+
+class CountModel():
+    """
+    Count based kernel of a stochastic engine
+
+    Arguments:
+        name - Name of the engine the kernel approximates
+        compartments - Names of the columns of the counts
+        params - Names of the columns of the parameter values, in order
+        step - Function (X, theta, n, rng) advancing the counts one day in place
+        infected - Compartments of the infected, summed for an observed series 'I'
+    """
+
+    def __init__(self, name, compartments, params, step, infected):
+        self.name = name
+        self.compartments = tuple(compartments)
+        self.params = tuple(params)
+        self.step = step
+        self.infected = tuple(infected)
+
+    def initial_state(self, n, P):
+        """
+        Returns the (P, compartments) counts of day 0: one infected, as in the engine
+        """
+        X = np.zeros((P, len(self.compartments)), dtype=np.int64)
+        X[:, 0] = n - 1
+        X[:, self.compartments.index(self.infected[0])] = 1
+        return X
+
+    def observe(self, X, names):
+        """
+        Returns the observed series names of the counts X (..., compartments)
+        as an array (..., len(names))
+        """
+        columns = []
+        for name in names:
+            if name in self.compartments:
+                columns.append(X[..., self.compartments.index(name)])
+            elif name == 'I':
+                columns.append(sum(X[..., self.compartments.index(c)] for c in self.infected))
+            else:
+                raise ValueError(f'{self.name} has no series {name!r}, expected one of '
+                                 f'{self.compartments + ("I",)}')
+        return np.stack(columns, axis=-1)
+
+
+MODELS = {
+    'discreteSim': CountModel('discreteSim', ('S', 'I', 'R'), ('b', 'k'), sir_step, ('I',)),
+    'varsim_tori': CountModel('varsim_tori', ('S', 'I_A', 'I_S', 'R'), ('b', 'k', 'a', 'c'), tori_step,
+                              ('I_A', 'I_S')),
+}
+
+
+def get_model(name):
+    """
+    Returns the CountModel of the engine called name (or name itself if it is a CountModel)
+    """
+    if isinstance(name, CountModel):
+        return name
+    if name not in MODELS:
+        raise KeyError(f'no count model of {name!r}, expected one of {sorted(MODELS)}')
+    return MODELS[name]
+
+
+def _theta(model, values, P):
+    """
+    Returns the (P, params) array of parameter values from a dictionary of
+    scalars or per particle arrays
+    """
+    missing = [name for name in model.params if name not in values]
+    if missing:
+        raise ValueError(f'missing values of {missing} for {model.name}')
+    return np.stack([np.broadcast_to(np.asarray(values[name], dtype=float), (P,)) for name in model.params],
+                    axis=1)
+
+
+def simulate_counts(model, params, n, t, particles=1, seed=None):
+    """
+    Runs the count kernel of a model for a number of particles at once
+    Input:
+        model(str): 'discreteSim' or 'varsim_tori'
+        params(dict): parameter name to a value or an array of one value per particle
+        n(int): population size
+        t(int): number of days, starting at day 0
+        particles(int): number of particles
+        seed: seed of a numpy.random.Generator, None for the global numpy.random
+
+    Return:
+        Array of the counts of shape (particles, t, compartments)
+    """
+    model = get_model(model)
+    rng = np.random if seed is None else np.random.default_rng(seed)
+    theta = _theta(model, params, particles)
+    X = model.initial_state(n, particles)
+    counts = np.empty((particles, t, X.shape[1]), dtype=np.int64)
+    for day in range(t):
+        if day > 0:
+            model.step(X, theta, n, rng)
+        counts[:, day] = X
+    return counts
+
+
+def _observations(data):
+    """
+    Returns the names of the observed series and an array (t, series) of their values
+    """
+    names = list(data)
+    return names, np.stack([np.asarray(data[name], dtype=float) for name in names], axis=1)
+
+
+def _distance_chunk(args):
+    """
+    Simulates one chunk of particles and returns the root mean square
+    difference of their observed series to the data, per person
+    """
+    model, theta, n, names, Y, seed = args
+    rng = np.random.default_rng(seed)
+    X = model.initial_state(n, len(theta))
+    squared = np.zeros(len(theta))
+    for day in range(len(Y)):
+        if day > 0:
+            model.step(X, theta, n, rng)
+        squared += ((model.observe(X, names) - Y[day])**2).sum(axis=1)
+    return np.sqrt(squared / Y.size) / n
+
+
+class ABCResult():
+    """
+    Result of abc_smc
+
+    Attributes:
+        names - Names of the inferred parameters
+        particles - (N, D) parameter values of the last generation
+        weights - (N,) normalized importance weights of the particles
+        distances - (N,) distances of the particles to the data
+        epsilons - Tolerance of every generation, inf for the prior
+        acceptance - Fraction of accepted proposals of every generation
+        simulations - Total number of simulated particles
+    """
+
+    def __init__(self, names, particles, weights, distances, epsilons, acceptance, simulations):
+        self.names = list(names)
+        self.particles = particles
+        self.weights = weights
+        self.distances = distances
+        self.epsilons = epsilons
+        self.acceptance = acceptance
+        self.simulations = simulations
+
+    def mean(self):
+        """
+        Returns the posterior mean of every parameter as a dictionary
+        """
+        return dict(zip(self.names, self.weights @ self.particles))
+
+    def std(self):
+        """
+        Returns the posterior standard deviation of every parameter as a dictionary
+        """
+        mean = self.weights @ self.particles
+        return dict(zip(self.names, np.sqrt(self.weights @ (self.particles - mean)**2)))
+
+
+def _perturbation_log_density(new, old, weights, L):
+    """
+    Log of the mixture sum_j w_j N(new_i; old_j, L L^T) up to a constant, for every new point
+    """
+    from scipy.linalg import solve_triangular
+    from scipy.spatial.distance import cdist
+    from scipy.special import logsumexp
+    white_new = solve_triangular(L, new.T, lower=True).T
+    white_old = solve_triangular(L, old.T, lower=True).T
+    d2 = cdist(white_new, white_old, 'sqeuclidean')
+    return logsumexp(-0.5 * d2 + np.log(weights), axis=1)
+
+
+def abc_smc(model, data, n, bounds, params=None, particles=1000, generations=10, quantile=0.5, epsilon=0.0,
+            min_acceptance=0.01, max_simulations=None, seed=0, workers=None, chunk=1000):
+    """
+    Approximate Bayesian computation with sequential Monte Carlo (Beaumont et al. 2009)
+
+    The first generation samples the uniform prior over bounds. Every further
+    generation uses the quantile of the distances of the previous one as its
+    tolerance, proposes particles of the previous generation by weight,
+    perturbed with a Gaussian kernel of twice their weighted covariance, keeps
+    the proposals within the tolerance and reweights them by the prior over the
+    kernel mixture. The proposals are simulated in chunks of particles with the
+    count kernels, on worker processes.
+    Input:
+        model(str): 'discreteSim' or 'varsim_tori'
+        data(dict): observed series name to its counts on days 0, 1, ..., e.g.
+            {'I': ..., 'R': ...}; 'I' is I_A + I_S for varsim_tori
+        n(int): population size
+        bounds(dict): parameter name to (low, high) of its uniform prior
+        params(dict): fixed values of the other parameters of the model
+        particles(int): particles per generation
+        generations(int): maximum number of generations
+        quantile(float): quantile of the distances that is the next tolerance
+        epsilon(float): stop once the tolerance is at most epsilon
+        min_acceptance(float): stop when a generation accepts fewer proposals
+        max_simulations(int): stop after this many simulated particles
+        seed(int): seed of the proposals and of the simulations
+        workers(int): worker processes, 1 runs in this process (default os.cpu_count())
+        chunk(int): particles per simulated chunk; the results do not depend on workers
+
+    Return:
+        ABCResult of the last complete generation
+    """
+    model = get_model(model)
+    names = list(bounds)
+    fixed = dict(params or {})
+    low = np.array([bounds[name][0] for name in names], dtype=float)
+    high = np.array([bounds[name][1] for name in names], dtype=float)
+    observed, Y = _observations(data)
+    if workers is None:
+        workers = os.cpu_count()
+
+    seeds = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seeds.spawn(1)[0])
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def distances(points):
+        if len(points) == 0:
+            return np.empty(0)
+        theta = _theta(model, dict(fixed, **dict(zip(names, points.T))), len(points))
+        starts = range(0, len(points), chunk)
+        tasks = [(model, theta[start:start + chunk], n, observed, Y, chunk_seed)
+                 for start, chunk_seed in zip(starts, seeds.spawn(len(starts)))]
+        if executor is None:
+            return np.concatenate([_distance_chunk(task) for task in tasks])
+        return np.concatenate(list(executor.map(_distance_chunk, tasks)))
+
+    try:
+        current = low + rng.random((particles, len(names))) * (high - low)
+        current_distances = distances(current)
+        weights = np.full(particles, 1 / particles)
+        epsilons, acceptance = [np.inf], [1.0]
+        simulations = particles
+
+        for generation in range(1, generations):
+            tolerance = max(np.quantile(current_distances, quantile), epsilon)
+            covariance = 2 * np.atleast_2d(np.cov(current.T, aweights=weights))
+            L = np.linalg.cholesky(covariance + 1e-12 * np.diag(np.diag(covariance) + 1))
+
+            accepted, accepted_distances, proposed = [], [], 0
+            count, rate = 0, max(acceptance[-1] * quantile, min_acceptance)
+            while count < particles:
+                if proposed * min_acceptance > particles or (
+                        max_simulations is not None and simulations >= max_simulations):
+                    break
+                size = int(np.ceil((particles - count) / rate * 1.2))
+                points = current[rng.choice(particles, size=size, p=weights)]
+                points += rng.standard_normal(points.shape) @ L.T
+                points = points[np.all((points >= low) & (points <= high), axis=1)]
+                d = distances(points)
+                proposed += size
+                simulations += len(points)
+                keep = d <= tolerance
+                accepted.append(points[keep])
+                accepted_distances.append(d[keep])
+                count += keep.sum()
+                rate = max(count / proposed, min_acceptance)
+
+            if count < particles:
+                break
+            new = np.concatenate(accepted)[:particles]
+            log_weights = -_perturbation_log_density(new, current, weights, L)
+            weights = np.exp(log_weights - log_weights.max())
+            weights /= weights.sum()
+            current = new
+            current_distances = np.concatenate(accepted_distances)[:particles]
+            epsilons.append(tolerance)
+            acceptance.append(particles / proposed)
+            if tolerance <= epsilon:
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return ABCResult(names, current, weights, current_distances, epsilons, acceptance, simulations)
+
+
+def systematic_resample(weights, rng=np.random):
+    """
+    Returns the indices of a systematic resample of the normalized weights
+    """
+    P = len(weights)
+    positions = (rng.random() + np.arange(P)) / P
+    cumulative = np.cumsum(weights)
+    cumulative[-1] = 1.0
+    return np.searchsorted(cumulative, positions)
+
+
+def bootstrap_filter(model, data, n, params, particles=1000, reporting=1.0, resample_threshold=0.5,
+                     seed=None, profiler=None):
+    """
+    Bootstrap particle filter of the count kernel of a model
+
+    The (particles, compartments) counts are advanced one day at a time and
+    weighted by the Poisson likelihood of the observed series, with mean the
+    reporting fraction of the simulated series (plus 0.5 so that no count is
+    impossible). The particles are resampled in place, systematically,
+    whenever the effective sample size falls below resample_threshold of them.
+    Input:
+        model(str): 'discreteSim' or 'varsim_tori'
+        data(dict): observed series name to its counts on days 0, 1, ..., as in abc_smc
+        n(int): population size
+        params(dict): parameter name to value, for every parameter of the model
+        particles(int): number of particles
+        reporting(float): expected fraction of the counts that is observed
+        resample_threshold(float): fraction of the particles below which the
+            effective sample size triggers resampling
+        seed: seed of a numpy.random.Generator, None for the global numpy.random
+        profiler(Profiler): receives the effective sample size of every day
+
+    Return:
+        Dictionary with the estimate of the log likelihood 'log_likelihood',
+        the filtered mean counts 'mean' of shape (t, compartments) and the
+        effective sample size of every day 'ess'
+    """
+    from scipy.special import gammaln, logsumexp
+    if profiler is None:
+        profiler = NULL_PROFILER
+    model = get_model(model)
+    profiler.begin('inference.bootstrap_filter', model=model.name, n=n, particles=particles, **params)
+    rng = np.random if seed is None else np.random.default_rng(seed)
+    observed, Y = _observations(data)
+    t = len(Y)
+
+    theta = _theta(model, params, particles)
+    X = model.initial_state(n, particles)
+    log_weights = np.full(particles, -np.log(particles))
+    log_likelihood = 0.0
+    mean = np.empty((t, X.shape[1]))
+    ess = np.empty(t)
+    constant = gammaln(Y + 1).sum(axis=1)
+
+    for day in range(t):
+        if day > 0:
+            with profiler.phase('step'):
+                model.step(X, theta, n, rng)
+        with profiler.phase('weights'):
+            rate = reporting * model.observe(X, observed) + 0.5
+            log_weights += (Y[day] * np.log(rate) - rate).sum(axis=1) - constant[day]
+            total = logsumexp(log_weights)
+            log_likelihood += total
+            log_weights -= total
+            weights = np.exp(log_weights)
+            mean[day] = weights @ X
+            ess[day] = 1 / np.sum(weights**2)
+        profiler.end_step(day, ess=ess[day])
+
+        if ess[day] < resample_threshold * particles and day < t - 1:
+            with profiler.phase('resample'):
+                index = systematic_resample(weights, rng)
+                np.take(X, index, axis=0, out=X)
+                log_weights[:] = -np.log(particles)
+
+    profiler.end()
+    return {'log_likelihood': log_likelihood, 'mean': mean, 'ess': ess}
+
+
+def _filter_task(args):
+    model, data, n, params, particles, reporting, seed = args
+    return bootstrap_filter(model, data, n, params, particles, reporting, seed=seed)['log_likelihood']
+
+
+def particle_log_likelihood(model, data, n, X, names, params=None, particles=1000, reporting=1.0, seed=0,
+                            workers=None):
+    """
+    Estimates the log likelihood at every point of a design with one
+    bootstrap filter per point, on worker processes
+    Input:
+        X(array): (m, D) parameter values
+        names(list): the D parameter names of the columns of X
+        params(dict): fixed values of the other parameters of the model
+        model, data, n, particles, reporting: as in bootstrap_filter
+        seed(int): seed of the filters, each point gets its own stream
+        workers(int): worker processes, 1 runs in this process (default os.cpu_count())
+
+    Return:
+        Array of the m log likelihood estimates
+    """
+    model = get_model(model)
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    if workers is None:
+        workers = os.cpu_count()
+    tasks = [(model, data, n, dict(params or {}, **dict(zip(names, point))), particles, reporting,
+              point_seed)
+             for point, point_seed in zip(X, np.random.SeedSequence(seed).spawn(len(X)))]
+
+    if workers == 1:
+        return np.array([_filter_task(task) for task in tasks])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return np.array(list(executor.map(_filter_task, tasks)))
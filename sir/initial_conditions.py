@@ -0,0 +1,173 @@
+import numpy as np
+
+# Fraction of the population of a seeded grid cell that is infected
+SEED_LEVEL = 0.001
+
+
+def empty_state(M):
+    """
+    Returns the flattened state [s, i, r] of an (M, M) grid with s = 1 and i = r = 0
+
+    This is the single 3 * M**2 vector that the solvers integrate; the seeding
+    functions below write into it in place through fields(y, M).
+    """
+    y = np.zeros(3 * M * M)
+    y[:M * M] = 1
+    return y
+
+
+def fields(y, M):
+    """
+    Returns the (3, M, M) view of the s, i, r fields of the flattened state y
+    """
+    return y.reshape(3, M, M)
+
+
+def fill_susceptible(y, M):
+    """
+    Sets s = 1 - i - r in place, without (M, M) temporaries
+    """
+    u = fields(y, M)
+    u[0] = 1
+    u[0] -= u[1]
+    u[0] -= u[2]
+
+
+def seed_cells(y, M, rows, cols, level=SEED_LEVEL):
+    """
+    Sets i = level and s = 1 - level - r in the cells (rows[a], cols[a]) with one scatter
+    """
+    u = fields(y, M)
+    u[1, rows, cols] = level
+    u[0, rows, cols] = 1 - level - u[2, rows, cols]
+
+
+def seed_box(y, M, low, high, draws, p=0.1, level=SEED_LEVEL):
+    """
+    Draws cells uniformly in the square [low, high) x [low, high) of grid
+    indices and seeds each of them with probability p
+
+    This is how odeSim_spatial seeds its 'center' and 'corner' starts: the
+    random numbers are drawn in the same order as the original loop (all
+    rows, all columns, then one uniform number per cell), so a seed gives the
+    same initial state.
+    """
+    rows = np.random.randint(low, high, size=draws)
+    cols = np.random.randint(low, high, size=draws)
+    keep = np.random.random(draws) <= p
+    seed_cells(y, M, rows[keep], cols[keep], level)
+
+
+def seed_center(y, M, level=SEED_LEVEL):
+    """
+    Seeds about M / 40 random cells in the central fifth of the grid
+    """
+    seed_box(y, M, M * 2 / 5, M * 3 / 5, int(M / 4), level=level)
+
+
+def seed_corner(y, M, level=SEED_LEVEL):
+    """
+    Seeds about M / 40 random cells in the fifth of the grid at the origin
+    """
+    seed_box(y, M, 0, M / 5, int(M / 4), level=level)
+
+
+def seed_random(y, M, level=SEED_LEVEL):
+    """
+    Seeds one cell anywhere on the grid
+    """
+    row = np.random.randint(0, M)
+    col = np.random.randint(0, M)
+    seed_cells(y, M, row, col, level)
+
+
+def seed_mask(y, M, mask, level=SEED_LEVEL):
+    """
+    Seeds the cells of a user mask
+    Input:
+        mask(array): (M, M) boolean mask of the cells to seed with level, or
+            an (M, M) array of infected fractions
+    """
+    mask = np.asarray(mask)
+    if mask.dtype == bool:
+        rows, cols = np.nonzero(mask)
+        seed_cells(y, M, rows, cols, level)
+    else:
+        fields(y, M)[1] = mask
+        fill_susceptible(y, M)
+
+
+def seed_gaussian(y, M, center=(0.5, 0.5), width=0.05, amplitude=SEED_LEVEL):
+    """
+    Sets i to a Gaussian blob on the unit square and s = 1 - i - r
+
+    The blob is the outer product of two one dimensional Gaussians, so it is
+    written into the i field without (M, M) temporaries. Row a of the grid
+    holds x in [a / M, (a + 1) / M), as in seed_agents.
+    Input:
+        center(tuple): (x, y) position of the peak
+        width(float): standard deviation of the blob
+        amplitude(float): infected fraction at the peak
+    """
+    u = fields(y, M)
+    x = (np.arange(M) + 0.5) / M
+    gx = amplitude * np.exp(-(x - center[0])**2 / (2 * width**2))
+    gy = np.exp(-(x - center[1])**2 / (2 * width**2))
+    np.multiply.outer(gx, gy, out=u[1])
+    fill_susceptible(y, M)
+
+
+def seed_agents(y, M, positions, n):
+    """
+    Seeds the grid from the positions of infected agents of an agent based run
+
+    The infected fraction of a cell is the number of infected agents in it
+    divided by the expected number of agents per cell n / M**2, at most 1.
+    Input:
+        positions(array): (k, 2) positions in the unit square of the infected agents
+        n(int): total number of agents
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    cells = np.minimum((positions * M).astype(np.int64), M - 1)
+    counts = np.bincount(cells[:, 0] * M + cells[:, 1], minlength=M * M)
+
+    i = fields(y, M)[1].reshape(-1)
+    np.multiply(counts, M * M / n, out=i)
+    np.minimum(i, 1, out=i)
+    fill_susceptible(y, M)
+
+
+# Seeding patterns that are selected by name
+PATTERNS = {'center': seed_center,
+            'corner': seed_corner,
+            'random': seed_random,
+            'gaussian': seed_gaussian}
+
+
+def initial_state(M, position='random', n=None):
+    """
+    Returns the flattened initial state [s, i, r] of an (M, M) grid
+    Input:
+        position: name of a pattern ('center', 'corner', 'random', 'gaussian'),
+            an (M, M) mask or array of infected fractions (see seed_mask),
+            a (k, 2) array of infected agent positions (see seed_agents), or
+            a function f(y, M) that seeds y in place
+        n(int): total number of agents when seeding from agent positions
+    """
+    y = empty_state(M)
+
+    if callable(position):
+        position(y, M)
+    elif isinstance(position, str):
+        # Any other name seeds one random cell, as odeSim_spatial always did
+        PATTERNS.get(position, seed_random)(y, M)
+    else:
+        position = np.asarray(position)
+        if position.shape == (M, M):
+            seed_mask(y, M, position)
+        elif position.ndim == 2 and position.shape[1] == 2:
+            seed_agents(y, M, position, n if n is not None else len(position))
+        else:
+            raise ValueError(f'initial position of shape {position.shape} is neither an (M, M) mask nor (k, 2) positions')
+
+    return y
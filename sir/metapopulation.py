@@ -0,0 +1,239 @@
+import numpy as np
+
+from sir.profiling import NULL_PROFILER
+
+
+def load_sizes(path):
+    """
+    Loads the patch populations from a .npy file or a text file with one value per line
+    """
+    if path.endswith('.npy'):
+        return np.load(path)
+    return np.loadtxt(path, delimiter=',', ndmin=1)
+
+
+def load_mobility(path, K):
+    """
+    Loads a (K, K) mobility matrix
+
+    path is either a scipy sparse .npz file (sparse.save_npz) or a text edge
+    list with one 'origin,destination,rate' line per edge and 0-based patch indices
+    """
+    import scipy.sparse as sparse
+    if path.endswith('.npz'):
+        return sparse.load_npz(path).tocsr()
+    edges = np.loadtxt(path, delimiter=',', ndmin=2)
+    return sparse.coo_matrix((edges[:, 2], (edges[:, 0].astype(int), edges[:, 1].astype(int))),
+                             shape=(K, K)).tocsr()
+
+
+def multinomial_rows(counts, indptr, probs):
+    """
+    Splits counts[k] over the nonzero entries of row k of a CSR matrix with a
+    multinomial draw per row, vectorized over rows
+
+    The draws use conditional binomials: the j-th entry of every row is drawn
+    in the same vectorized step, so the number of steps is the largest number
+    of nonzeros in a row rather than the number of rows. Rows with nothing
+    left to split are skipped and the last entry of a row takes the rest.
+
+    Arguments:
+        counts - (K,) or (C, K) integer number of items to split in every row
+        indptr - CSR row pointer of the matrix
+        probs - probabilities of every nonzero entry, summing to 1 in every row with entries
+
+    Returns the number of items assigned to every nonzero entry, of shape (nnz,) or (C, nnz)
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    remaining = np.atleast_2d(counts).copy()
+    C, K = remaining.shape
+    out = np.zeros((C, len(probs)), dtype=np.int64)
+    degree = np.diff(indptr)
+    last = indptr[1:] - 1
+
+    # Rows without entries keep their items, rows with one entry need no draw
+    remaining[:, degree == 0] = 0
+    mass = np.ones(K)
+
+    for j in range(degree.max(initial=0)):
+        c, rows = np.nonzero((remaining > 0) & (degree > j))
+        entries = indptr[rows] + j
+
+        draw = remaining[c, rows]
+        drawn = entries != last[rows]
+        p = np.clip(probs[entries[drawn]] / np.maximum(mass[rows[drawn]], 1e-300), 0, 1)
+        draw[drawn] = np.random.binomial(draw[drawn], p)
+
+        out[c, entries] = draw
+        remaining[c, rows] -= draw
+
+        # Probability mass of the entries of every row that are still to be drawn
+        open_rows = np.flatnonzero(degree > j)
+        mass[open_rows] -= probs[indptr[open_rows] + j]
+
+    return out.reshape(counts.shape[:-1] + (len(probs),))
+
+
+class metapopSim():
+    """
+    A class that simulates the SIR model on K well-mixed patches coupled by mobility
+
+    Within a patch the model is odeSim; people move between patches at the rates
+    of a sparse mobility matrix. In the deterministic mode the counts follow
+
+    S_k' = -b * S_k * I_k / N_k + p * sum_l (W[l, k] * S_l - W[k, l] * S_k)
+    I_k' = b * S_k * I_k / N_k - k * I_k + p * sum_l (W[l, k] * I_l - W[k, l] * I_k)
+    R_k' = k * I_k + p * sum_l (W[l, k] * R_l - W[k, l] * R_k)
+
+    and the stochastic mode advances integer counts with tau-leaping.
+
+    Arguments:
+        sizes - (K,) population of every patch (array, or path of a .npy/.csv file)
+        mobility - (K, K) matrix; W[k, l] is the rate per day at which people in patch k
+            move to patch l (sparse matrix, dense array, or path of a .npz/.csv edge list file)
+
+    Optional Arguments:
+        b - Number of contacts per day that are sufficient to spread the disease (default b = 1/2)
+        k - Fraction of the infected group of individuals that will recover during any given day (default k = 1/3)
+        p - Weight of the mobility term (default p = 1)
+        t - Amount of time the simulation will run for (default t = 100 days)
+        infected - (K,) initially infected people per patch (default 0.1% of patch 0)
+    """
+
+    def __init__(self, sizes, mobility, b=1/2, k=1/3, p=1, t=100, infected=None):
+
+        import scipy.sparse as sparse
+        if isinstance(sizes, str):
+            sizes = load_sizes(sizes)
+        self.sizes = np.asarray(sizes, dtype=float)
+        self.K = len(self.sizes)
+
+        if isinstance(mobility, str):
+            mobility = load_mobility(mobility, self.K)
+        W = sparse.csr_matrix(mobility, dtype=float)
+        W.setdiag(0)
+        W.eliminate_zeros()
+        self.W = W
+
+        self.b = b
+        self.k = k
+        self.p = p
+        self.t = t
+
+        if infected is None:
+            infected = np.zeros(self.K)
+            infected[0] = 0.001 * self.sizes[0]
+        self.infected = np.asarray(infected, dtype=float)
+
+        # Total rate of leaving every patch and the operator W^T - diag(out) of the flux
+        self.out_rate = np.asarray(W.sum(axis=1)).ravel()
+        self.flux = (W.T - sparse.diags(self.out_rate)).tocsr()
+
+
+    def initial_conditions(self):
+        """
+        Returns the (K, 3) array of initial S, I, R counts
+        """
+        return np.stack([self.sizes - self.infected, self.infected, np.zeros(self.K)], axis=1)
+
+
+    def rhs(self, t, y):
+        """
+        Right hand side of the deterministic model for the flattened (K, 3) state y
+        """
+        X = y.reshape(self.K, 3)
+        S, I, R = X[:, 0], X[:, 1], X[:, 2]
+        N = np.maximum(S + I + R, 1e-12)
+
+        infection = self.b * S * I / N
+        recovery = self.k * I
+
+        # One sparse matvec moves all three compartments
+        dX = self.p * (self.flux @ X)
+        dX[:, 0] -= infection
+        dX[:, 1] += infection - recovery
+        dX[:, 2] += recovery
+
+        return dX.ravel()
+
+
+    def solve(self, profiler=None):
+        """
+        Solves the deterministic model and returns the time points and the
+        S, I, R counts, each of shape (K, number of time points)
+        """
+        from scipy.integrate import solve_ivp
+        if profiler is None:
+            profiler = NULL_PROFILER
+        profiler.begin('metapopSim.solve', K=self.K, b=self.b, k=self.k, p=self.p, t=self.t)
+
+        t_eval = np.arange(0, self.t, 1)
+        with profiler.phase('solve'):
+            sol = solve_ivp(profiler.wrap_rhs(self.rhs), (0, self.t), self.initial_conditions().ravel(),
+                            t_eval=t_eval, dense_output=profiler.enabled)
+
+        y = sol.y.reshape(self.K, 3, -1)
+
+        profiler.solver_stats(sol)
+        profiler.end()
+
+        return sol.t, y[:, 0], y[:, 1], y[:, 2]
+
+
+    def simulate(self, dt=1, profiler=None):
+        """
+        Simulates the stochastic model with tau-leaping and returns the time
+        points and the integer S, I, R counts, each of shape (K, number of days)
+
+        Every day is split into round(1 / dt) steps of length h, so h is dt
+        rounded to a whole fraction of a day. In every step, infections and
+        recoveries in patch k are binomial draws with probabilities
+        1 - exp(-b I_k / N_k h) and 1 - exp(-k h), then the people leaving patch
+        k are a binomial draw with probability 1 - exp(-p out_k h) that is split
+        over the destinations with a multinomial draw in proportion to the rates W[k, :].
+        """
+        if profiler is None:
+            profiler = NULL_PROFILER
+        profiler.begin('metapopSim.simulate', K=self.K, b=self.b, k=self.k, p=self.p, t=self.t, dt=dt)
+
+        X = np.round(self.initial_conditions()).astype(np.int64)
+
+        indptr, indices = self.W.indptr, self.W.indices
+        rows = np.repeat(np.arange(self.K), np.diff(indptr))
+        probs = self.W.data / np.maximum(self.out_rate[rows], 1e-300)
+        # The steps of a day must add up to one day
+        steps_per_day = max(1, int(round(1 / dt)))
+        h = 1 / steps_per_day
+        p_leave = 1 - np.exp(-self.p * self.out_rate * h)
+        p_recover = 1 - np.exp(-self.k * h)
+
+        time = np.arange(0, self.t, 1)
+        S = np.empty((self.K, len(time)), dtype=np.int64)
+        I = np.empty((self.K, len(time)), dtype=np.int64)
+        R = np.empty((self.K, len(time)), dtype=np.int64)
+
+        for day in range(len(time)):
+            with profiler.phase('counting'):
+                S[:, day], I[:, day], R[:, day] = X[:, 0], X[:, 1], X[:, 2]
+
+            for step in range(steps_per_day):
+                with profiler.phase('infection'):
+                    N = np.maximum(X.sum(axis=1), 1)
+                    new_infected = np.random.binomial(X[:, 0], 1 - np.exp(-self.b * X[:, 1] / N * h))
+                with profiler.phase('recovery'):
+                    new_recovered = np.random.binomial(X[:, 1], p_recover)
+                X[:, 0] -= new_infected
+                X[:, 1] += new_infected - new_recovered
+                X[:, 2] += new_recovered
+
+                with profiler.phase('move'):
+                    leaving = np.random.binomial(X.T, p_leave)
+                    moves = multinomial_rows(leaving, indptr, probs)
+                    for c in range(3):
+                        X[:, c] += np.bincount(indices, weights=moves[c], minlength=self.K).astype(np.int64) - leaving[c]
+
+            profiler.end_step(day, S=S[:, day].sum(), I=I[:, day].sum(), R=R[:, day].sum())
+
+        profiler.end()
+
+        return time, S, I, R
@@ -0,0 +1,203 @@
+import numpy as np
+
+from sir.discreteSim_spatial import STATE_CODES
+from sir.profiling import NULL_PROFILER
+
+
+class Graph():
+    """
+    Undirected contact graph stored in compressed sparse row (CSR) format
+
+    The neighbours of node i are indices[indptr[i]:indptr[i + 1]]. Node
+    indices are stored as int32, so a graph with 10^7 edges (2 * 10^7
+    directed entries) takes about 80 MB plus 8 bytes per node.
+
+    Arguments:
+        indptr - (n + 1,) int64 row pointer
+        indices - int32 neighbour indices, sorted within every row
+    """
+
+    def __init__(self, indptr, indices):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.n = len(self.indptr) - 1
+
+    @classmethod
+    def from_edges(cls, n, u, v):
+        """
+        Builds the graph with n nodes and the undirected edges (u[j], v[j])
+        Self loops and repeated edges are dropped
+        """
+        # int64 so that u * n cannot overflow, e.g. for int32 node indices
+        u = np.asarray(u, dtype=np.int64)
+        v = np.asarray(v, dtype=np.int64)
+        keep = u != v
+        u, v = u[keep], v[keep]
+        m = len(u)
+
+        # Both directions of every edge as one sorted int64 key per entry,
+        # written in place to keep the peak memory close to the size of the keys
+        keys = np.empty(2 * m, dtype=np.int64)
+        np.multiply(u, n, out=keys[:m])
+        keys[:m] += v
+        np.multiply(v, n, out=keys[m:])
+        keys[m:] += u
+        del u, v, keep
+        keys.sort()
+        if m > 0:
+            keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+
+        indptr = np.searchsorted(keys, np.arange(n + 1, dtype=np.int64) * n)
+        keys %= n
+        return cls(indptr, keys.astype(np.int32))
+
+    def degree(self):
+        """
+        Returns the number of neighbours of every node
+        """
+        return np.diff(self.indptr)
+
+    def num_edges(self):
+        """
+        Returns the number of undirected edges
+        """
+        return len(self.indices) // 2
+
+    def neighbours(self, nodes):
+        """
+        Returns the concatenated neighbour lists of nodes (with repetitions)
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        starts = self.indptr[nodes]
+        lengths = self.indptr[nodes + 1] - starts
+        # Position of every gathered entry in indices, without a Python loop over nodes
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return self.indices[offsets + np.arange(len(offsets))]
+
+
+def erdos_renyi(n, mean_degree):
+    """
+    Returns an Erdős–Rényi random graph with n nodes and the given expected mean degree
+
+    The number of edges is drawn as in G(n, p) with p = mean_degree / (n - 1)
+    and the edges are drawn uniformly; the few repeated pairs of a sparse graph are dropped.
+    """
+    pairs = n * (n - 1) // 2
+    m = np.random.binomial(pairs, min(1, mean_degree / max(n - 1, 1)))
+    u = np.random.randint(0, n, size=m)
+    v = np.random.randint(0, n, size=m)
+    return Graph.from_edges(n, u, v)
+
+
+def watts_strogatz(n, degree, beta):
+    """
+    Returns a Watts–Strogatz small world graph
+
+    Every node is joined to its degree // 2 nearest neighbours on each side of
+    a ring, then the far end of every edge is rewired to a uniformly random node
+    with probability beta.
+    """
+    half = degree // 2
+    u = np.repeat(np.arange(n), half)
+    v = (u + np.tile(np.arange(1, half + 1), n)) % n
+    rewire = np.random.rand(len(v)) < beta
+    v[rewire] = np.random.randint(0, n, size=rewire.sum())
+    return Graph.from_edges(n, u, v)
+
+
+def barabasi_albert(n, m):
+    """
+    Returns a Barabási–Albert preferential attachment graph where every new node brings m edges
+
+    Uses the algorithm of Batagelj and Brandes: edge e = v * m + i of node v
+    links to the endpoint at a uniformly random earlier position r <= 2 e of the
+    list of all edge endpoints, so nodes are chosen in proportion to their
+    degree. Endpoints at even positions are known nodes and endpoints at odd
+    positions are copies of earlier targets, which are resolved for all edges
+    at once by pointer jumping.
+    """
+    edges = n * m
+    source = np.repeat(np.arange(n, dtype=np.int64), m)
+    pointer = (np.random.rand(edges) * (2 * np.arange(edges) + 1)).astype(np.int64)
+
+    odd = np.flatnonzero(pointer % 2 == 1)
+    while len(odd) > 0:
+        pointer[odd] = pointer[(pointer[odd] - 1) // 2]
+        odd = odd[pointer[odd] % 2 == 1]
+
+    target = source[pointer // 2]
+    return Graph.from_edges(n, source, target)
+
+
+def spatial_graph(positions, q, periodic=False):
+    """
+    Returns the graph joining the agents within distance q of each other, the
+    contacts of discreteSim_spatial for agents that do not move
+    Input:
+        positions(array): (n, 2) positions in the unit square, e.g. np.random.rand(n, 2)
+        q(float): radius of infection
+        periodic(bool): measure distances on the periodic unit square
+    """
+    from scipy.spatial import KDTree
+    positions = np.asarray(positions, dtype=float)
+    tree = KDTree(positions, boxsize=1.0 if periodic else None)
+    pairs = tree.query_pairs(q, output_type='ndarray')
+    return Graph.from_edges(len(positions), pairs[:, 0], pairs[:, 1])
+
+
+def network_simulation(graph, beta, k, t, num_initial_infected=1, profiler=None):
+    """
+    SIR simulation on a contact graph
+    Every day each infected person infects each susceptible neighbour with
+    probability beta, then recovers with probability k. The update is
+    synchronous as in discreteSim_spatial.infect_synchronous: people infected
+    during a day neither infect others nor recover until the next day.
+
+    Only the adjacency of the infected set is visited, so a day costs
+    O(sum of the degrees of the infected) rather than O(n).
+    Input:
+        graph(Graph): contact graph
+        beta(float): probability of transmission along an edge per day
+        k(float): rate of recovery
+        t(int): the number of days to simulate
+        num_initial_infected(int): the number of initially infected people, chosen at random
+        profiler(Profiler): optional sir.profiling.Profiler that receives per day timings
+
+    Return:
+        Arrays S, I, R with the counts of every day
+    """
+    if profiler is None:
+        profiler = NULL_PROFILER
+    profiler.begin('network.network_simulation', n=graph.n, edges=graph.num_edges(),
+                   beta=beta, k=k, t=t, num_initial_infected=num_initial_infected)
+
+    states = np.full(graph.n, STATE_CODES['S'], dtype=np.int8)
+    infected = np.random.choice(graph.n, num_initial_infected, replace=False)
+    states[infected] = STATE_CODES['I']
+
+    S = np.zeros(t)
+    I = np.zeros(t)
+    R = np.zeros(t)
+    counts = np.array([graph.n - len(infected), len(infected), 0])
+
+    for day in range(t):
+        if day > 0:
+            with profiler.phase('infection'):
+                contacts = graph.neighbours(infected)
+                contacts = contacts[states[contacts] == STATE_CODES['S']]
+                new_infected = np.unique(contacts[np.random.rand(len(contacts)) < beta])
+                states[new_infected] = STATE_CODES['I']
+            with profiler.phase('recovery'):
+                recovers = np.random.rand(len(infected)) < k
+                states[infected[recovers]] = STATE_CODES['R']
+                # The infected set is kept as an index array instead of scanning all states
+                infected = np.concatenate([infected[~recovers], new_infected])
+            counts += [-len(new_infected), len(new_infected) - recovers.sum(), recovers.sum()]
+
+        with profiler.phase('counting'):
+            S[day], I[day], R[day] = counts
+        profiler.end_step(day, S=S[day], I=I[day], R=R[day])
+
+    profiler.end()
+
+    return S, I, R
@@ -1,5 +1,6 @@
 import numpy as np
-from scipy.integrate import solve_ivp
+
+from sir.profiling import NULL_PROFILER
 
 # Instructions on how to import this class
 # from odeSim import odeSim
@@ -44,10 +45,17 @@ class odeSim():
         self.t = t
 
 
-    def solve_odes(self):
+    def solve_odes(self, profiler=None):
         """
         Defines the initial conditions then solves the initial value problem with our system of odes
+
+        profiler is an optional sir.profiling.Profiler that records right hand side
+        evaluations and step sizes of the solver
         """
+        from scipy.integrate import solve_ivp
+        if profiler is None:
+            profiler = NULL_PROFILER
+        profiler.begin('odeSim.solve_odes', n=self.n, b=self.b, k=self.k, t=self.t)
 
         # S is the number of susceptible individuals
         # I is the number of infected individuals
@@ -83,7 +91,12 @@ class odeSim():
 
         
         # Solve the system of ODEs with initial conditions
-        sol = solve_ivp(f, t_span, ics, t_eval=t_eval, events=ReachZero)
+        # Step sizes are only available from the dense output, so only ask for it when profiling
+        sol = solve_ivp(profiler.wrap_rhs(f), t_span, ics, t_eval=t_eval, events=ReachZero,
+                        dense_output=profiler.enabled)
+
+        profiler.solver_stats(sol)
+        profiler.end()
 
         return sol
     
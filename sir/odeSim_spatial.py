@@ -1,12 +1,17 @@
 import numpy as np
-from scipy.integrate import solve_ivp
-import scipy.sparse as sparse
 
+from sir.initial_conditions import initial_state
+from sir.profiling import NULL_PROFILER
 
-def forward_diff_matrix(n):
+
+def forward_diff_matrix(n, periodic=False):
     """
     Generates a forward difference matrix to calculate derivatives
+
+    If periodic is True the last row wraps around to the first entry,
+    which makes the matrix circulant
     """
+    import scipy.sparse as sparse
     data = []
     i = []
     j = []
@@ -19,13 +24,22 @@ def forward_diff_matrix(n):
         j.append(k+1)
         data.append(1)
 
+    if periodic:
+        i.extend([n - 1, n - 1])
+        j.extend([n - 1, 0])
+        data.extend([-1, 1])
+
     return sparse.coo_matrix((data, (i,j)), shape=(n, n)).tocsr()
     
-def laplacian(n):
+def laplacian(n, periodic=False):
     """
     Returns two dimensional laplacian
+
+    If periodic is True the laplacian is built on a torus and is
+    diagonalized by the two dimensional FFT (see laplacian_eigenvalues)
     """ 
-    D = forward_diff_matrix(n)
+    import scipy.sparse as sparse
+    D = forward_diff_matrix(n, periodic)
     
     # Diffusion operator (from lecture notebooks)
     DD = -D.T @ D
@@ -44,6 +58,53 @@ def laplacian(n):
     return L
 
 
+def laplacian_eigenvalues(n):
+    """
+    Returns the (n, n) array of eigenvalues of laplacian(n, periodic=True)
+
+    Entry [a, b] is the eigenvalue belonging to the 2D Fourier mode (a, b),
+    so that L @ u.flatten() == ifft2(laplacian_eigenvalues(n) * fft2(u))
+    for any (n, n) array u
+    """
+    # Eigenvalues of the one dimensional circulant operator -D.T @ D
+    mu = -(2 - 2 * np.cos(2 * np.pi * np.arange(n) / n))
+
+    return mu[:, None] + mu[None, :]
+
+
+def fft_diffuse(u, lam, dt):
+    """
+    Advances u' = lam * u exactly by dt in Fourier space
+
+    u - (n, n) array or stack of (..., n, n) arrays on a periodic grid
+    lam - eigenvalues of the diffusion operator, e.g. p * laplacian_eigenvalues(n)
+    dt - time step
+    """
+    return np.real(np.fft.ifft2(np.fft.fft2(u) * np.exp(lam * dt)))
+
+
+def dilate_blocks(blocks, halo, periodic=False):
+    """
+    Returns the boolean (nb, nb) block mask grown by halo blocks in every
+    direction, diagonals included, wrapping around if periodic is True
+    """
+    # A 3 x 3 dilation is a dilation along the rows followed by one along the columns
+    for axis in (0, 1):
+        for step in range(halo):
+            if periodic:
+                blocks = blocks | np.roll(blocks, 1, axis=axis) | np.roll(blocks, -1, axis=axis)
+            else:
+                grown = blocks.copy()
+                if axis == 0:
+                    grown[1:] |= blocks[:-1]
+                    grown[:-1] |= blocks[1:]
+                else:
+                    grown[:, 1:] |= blocks[:, :-1]
+                    grown[:, :-1] |= blocks[:, 1:]
+                blocks = grown
+    return blocks
+
+
 class odeSim_spatial():
     """
     A class that solves ordinary differential equations for the SIR model
@@ -55,11 +116,13 @@ class odeSim_spatial():
         p - Weight of the diffusion term (default p = 1)
         t - Amount of time the simulation will run for (default t = 400 days)
         M - Size of the unit square grid where population resides (default M = 200)
-        initial_position - Starting position of infected individuals (default = 'random')
+        initial_position - Starting position of infected individuals: 'center', 'corner', 'random',
+            'gaussian', an (M, M) mask or (k, 2) agent positions (see sir.initial_conditions) (default = 'random')
+        periodic - Use periodic boundaries on the unit square (default = False)
         
     """
     
-    def __init__(self, n=100, b=3, k=0.1, p=1, t=400, M=200, initial_position=None):
+    def __init__(self, n=100, b=3, k=0.1, p=1, t=400, M=200, initial_position=None, periodic=False):
         
         # Storing the class attributes
         self.n = n
@@ -74,9 +137,10 @@ class odeSim_spatial():
             initial_position = 'random'
             
         self.pos = initial_position
+        self.periodic = periodic
         
         # Calculating laplacian from pre-defined function
-        self.L = laplacian(self.M)
+        self.L = laplacian(self.M, self.periodic)
         
         # Defining ranges of s, i, and r values in the solution y
         self.s_idx = np.arange(self.M * self.M)
@@ -84,63 +148,22 @@ class odeSim_spatial():
         self.r_idx = np.arange(2 * self.M * self.M, 3 * self.M * self.M)
                 
 
+    def initial_state(self):
+        """
+        Returns the flattened initial state [s0, i0, r0] as one preallocated array
+        built by sir.initial_conditions from initial_position
+        """
+        return initial_state(self.M, self.pos, self.n)
+
+
     def initial_conditions(self):
         """
         Returns the flattened arrays s0, i0, and r0 according to the problem's initial conditions
+        (views of one initial_state array)
         """
-        
-        # Initializing arrays
-        i0 = np.zeros((self.M,self.M))
-        s0 = np.ones((self.M,self.M))
-        r0 = np.zeros((self.M,self.M))
-        
-        # According to the initial_position, the location of the initially infected individuals changes
-        if self.pos == 'center':
-            
-            # Generate random integers in the center of the grid
-            i = np.random.randint(self.M*2/5, self.M*3/5, size=int(self.M/4))
-            j = np.random.randint(self.M*2/5, self.M*3/5, size=int(self.M/4))
-            
-            # Stack the arrays to easily access each coordinate
-            entries = np.stack((i,j), axis=1) # Each element in entries is [i,j] such that entries[0] = [i[0], j[0]]
-            
-            for entry in entries:
-                # With a probability of 0.1, change elements in i0 and s0 to be infected
-                if np.random.random() <= 0.1:
-                
-                    i0[entry[0], entry[1]] = 0.001  # 0.1% of population
-                    s0[entry[0], entry[1]] = 1 - 0.001
-            
-            
-        elif self.pos == 'corner':
-            
-            # Generate random integers in the corner of the grid
-            i = np.random.randint(0, self.M/5, size=int(self.M/4))
-            j = np.random.randint(0, self.M/5, size=int(self.M/4))
-            
-            entries = np.stack((i,j), axis=1)
-            
-            for entry in entries:
-                
-                if np.random.random() <= 0.1:
-                
-                    i0[entry[0], entry[1]] = 0.001 
-                    s0[entry[0], entry[1]] = 1 - 0.001
-
-        else: 
-            # Generate random integers anywhere on the grid
-            i = np.random.randint(0, self.M)
-            j = np.random.randint(0, self.M)
-                
-            i0[i,j] = 0.001
-            s0[i,j] = 1 - 0.001
-        
-        # Flatten all initial condition arrays
-        s0 = s0.flatten()
-        i0 = i0.flatten()
-        r0 = r0.flatten()
-            
-        return s0, i0, r0
+        y = self.initial_state()
+        MM = self.M * self.M
+        return y[:MM], y[MM:2 * MM], y[2 * MM:]
     
     
     def rhs_pdes(self, t, y):
@@ -159,25 +182,219 @@ class odeSim_spatial():
         return np.array([s, i, r]).flatten()
         
         
-    def solve_pdes(self):
+    def _params(self):
+        """
+        Returns the model parameters reported to profilers
+        """
+        return dict(n=self.n, b=self.b, k=self.k, p=self.p, t=self.t, M=self.M,
+                    initial_position=self.pos, periodic=self.periodic)
+
+
+    def solve_pdes(self, profiler=None):
         """
         Solves the initial value problem and returns the solution of s(x,t), i(x,t), and r(x,t)
+
+        profiler is an optional sir.profiling.Profiler that records right hand side
+        evaluations and step sizes of the solver
         """
+        from scipy.integrate import solve_ivp
+        if profiler is None:
+            profiler = NULL_PROFILER
+        profiler.begin('odeSim_spatial.solve_pdes', **self._params())
         
         # Initial conditions array
-        s0, i0, r0 = self.initial_conditions()    
-        self.ics = np.array([s0, i0, r0]).flatten()
+        with profiler.phase('initial_conditions'):
+            self.ics = self.initial_state()
         
         # Time interval
         t_span = (0, self.t)
         t_eval = np.arange(0, self.t, 1)
 
         # Solution
-        sol = solve_ivp(fun=self.rhs_pdes, t_span=t_span, y0=self.ics, t_eval=t_eval, dense_output=True)
+        with profiler.phase('solve'):
+            sol = solve_ivp(fun=profiler.wrap_rhs(self.rhs_pdes), t_span=t_span, y0=self.ics, t_eval=t_eval, dense_output=True)
         
-        time = sol.t
-        s_xt = np.mean(sol.y[self.s_idx],axis=0)
-        i_xt = np.mean(sol.y[self.i_idx],axis=0)
-        r_xt = np.mean(sol.y[self.r_idx],axis=0)
+        with profiler.phase('counting'):
+            time = sol.t
+            s_xt = np.mean(sol.y[self.s_idx],axis=0)
+            i_xt = np.mean(sol.y[self.i_idx],axis=0)
+            r_xt = np.mean(sol.y[self.r_idx],axis=0)
+
+        profiler.solver_stats(sol)
+        profiler.end()
+
+        return time, s_xt, i_xt, r_xt
+
+
+    def active_cells(self, u, block=10, threshold=1e-6, halo=1):
+        """
+        Returns the flat indices of the grid cells that need to be evolved and the block mask
+
+        The grid is split into block x block blocks. A block is active when i or
+        the magnitude of its forward differences exceeds threshold anywhere in
+        the block; the active blocks are grown by halo blocks so that the
+        infection front cannot leave them before the next regrid.
+
+        u - (3, M * M) array of the flattened s, i, r
+        """
+        M = self.M
+        i = u[1].reshape(M, M)
+
+        indicator = i.copy()
+        gx = np.abs(np.diff(i, axis=0))
+        gy = np.abs(np.diff(i, axis=1))
+        indicator[:-1] = np.maximum(indicator[:-1], gx)
+        indicator[1:] = np.maximum(indicator[1:], gx)
+        indicator[:, :-1] = np.maximum(indicator[:, :-1], gy)
+        indicator[:, 1:] = np.maximum(indicator[:, 1:], gy)
+
+        # Maximum over every block, padding the last blocks if block does not divide M
+        nb = -(-M // block)
+        padded = np.zeros((nb * block, nb * block))
+        padded[:M, :M] = indicator
+        blocks = padded.reshape(nb, block, nb, block).max(axis=(1, 3)) > threshold
+        blocks = dilate_blocks(blocks, halo, self.periodic)
+
+        cells = np.repeat(np.repeat(blocks, block, axis=0), block, axis=1)[:M, :M]
+        return np.flatnonzero(cells), blocks
+
+
+    def solve_pdes_adaptive(self, block=10, threshold=1e-6, halo=1, regrid=1, profiler=None):
+        """
+        Solves the problem of solve_pdes on the active blocks only and returns the same tuple
+
+        Away from the infection the grid is flat (s = 1 - r, i = 0) and does not
+        change, so only the blocks found by active_cells are evolved, with the
+        rows and columns of the laplacian that belong to their cells. The cells
+        outside the active blocks are held at their values and enter the
+        laplacian of the active cells as fixed boundary data. Every regrid days
+        the active blocks are recomputed from the current solution, so the
+        evolved region follows the front.
+
+        Optional Arguments:
+            block - Side of the square blocks in grid cells (default 10)
+            threshold - Level of i and |grad i| above which a block is active (default 1e-6)
+            halo - Number of blocks added around the active blocks (default 1)
+            regrid - Number of days between updates of the active blocks (default 1)
+            profiler - Optional sir.profiling.Profiler; every regrid interval is a
+                step that reports the fraction of active cells
+        """
+        from scipy.integrate import solve_ivp
+        if profiler is None:
+            profiler = NULL_PROFILER
+        profiler.begin('odeSim_spatial.solve_pdes_adaptive', block=block, threshold=threshold,
+                       halo=halo, regrid=regrid, **self._params())
+
+        with profiler.phase('initial_conditions'):
+            self.ics = self.initial_state()
+        u = self.ics.reshape(3, self.M * self.M).copy()
+
+        time = np.arange(0, self.t, 1)
+        means = np.empty((3, len(time)))
+
+        for start in range(0, self.t, regrid):
+            stop = min(start + regrid, self.t)
+            days = np.arange(start, stop)
+
+            with profiler.phase('regrid'):
+                idx, blocks = self.active_cells(u, block, threshold, halo)
+                frozen = np.ones(self.M * self.M, dtype=bool)
+                frozen[idx] = False
+                frozen_sum = u[:, frozen].sum(axis=1)
+
+                L_rows = self.L[idx]
+                L_active = L_rows[:, idx]
+                # Flux from the held cells into the active cells
+                boundary = L_rows @ np.where(frozen, u, 0).T
+
+            if len(idx) == 0:
+                means[:, days] = (frozen_sum / self.M**2)[:, None]
+                profiler.end_step(start, active=0.0)
+                continue
+
+            def rhs(t, y):
+                v = y.reshape(3, -1)
+                infection = self.b * v[0] * v[1]
+                recovery = self.k * v[1]
+                diffusion = self.p * (L_active @ v.T + boundary).T
+                return (np.array([-infection, infection - recovery, recovery]) + diffusion).ravel()
+
+            with profiler.phase('solve'):
+                sol = solve_ivp(fun=profiler.wrap_rhs(rhs), t_span=(start, stop), y0=u[:, idx].ravel(),
+                                t_eval=np.append(days, stop))
+
+            with profiler.phase('counting'):
+                y = sol.y.reshape(3, len(idx), -1)
+                means[:, days] = (frozen_sum[:, None] + y[:, :, :len(days)].sum(axis=1)) / self.M**2
+                u[:, idx] = y[:, :, -1]
+
+            profiler.end_step(start, active=len(idx) / self.M**2)
+
+        profiler.end()
+
+        return time, means[0], means[1], means[2]
+
+
+    def solve_pdes_fft(self, dt=0.1, profiler=None):
+        """
+        Solves the periodic problem with Strang splitting and returns the same
+        tuple as solve_pdes
+
+        The diffusion half steps are done exactly with the FFT, so the time step
+        is only limited by the (non-stiff) local reaction terms which are
+        advanced with a classical fourth order Runge-Kutta step.
+        Requires periodic=True.
+
+        profiler is an optional sir.profiling.Profiler that receives per day
+        'diffusion' and 'reaction' timings
+        """
+        if not self.periodic:
+            raise ValueError('solve_pdes_fft requires periodic=True')
+
+        if profiler is None:
+            profiler = NULL_PROFILER
+        profiler.begin('odeSim_spatial.solve_pdes_fft', dt=dt, **self._params())
+
+        # Initial conditions array as a (3, M, M) stack of s, i, r
+        self.ics = self.initial_state()
+        u = self.ics.reshape(3, self.M, self.M)
+
+        lam = self.p * laplacian_eigenvalues(self.M)
+
+        def reaction(v):
+            infection = self.b * v[0] * v[1]
+            recovery = self.k * v[1]
+            return np.array([-infection, infection - recovery, recovery])
+
+        # Output once a day like solve_pdes
+        time = np.arange(0, self.t, 1)
+        steps_per_day = max(1, int(round(1 / dt)))
+        h = 1 / steps_per_day
+
+        s_xt = np.empty(len(time))
+        i_xt = np.empty(len(time))
+        r_xt = np.empty(len(time))
+
+        for day in range(len(time)):
+            with profiler.phase('counting'):
+                s_xt[day], i_xt[day], r_xt[day] = u.mean(axis=(1, 2))
+
+            for step in range(steps_per_day):
+                with profiler.phase('diffusion'):
+                    u = fft_diffuse(u, lam, h / 2)
+
+                with profiler.phase('reaction'):
+                    k1 = reaction(u)
+                    k2 = reaction(u + h / 2 * k1)
+                    k3 = reaction(u + h / 2 * k2)
+                    k4 = reaction(u + h * k3)
+                    u = u + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+                with profiler.phase('diffusion'):
+                    u = fft_diffuse(u, lam, h / 2)
+
+            profiler.end_step(day, s=s_xt[day], i=i_xt[day], r=r_xt[day])
+
+        profiler.end()
 
         return time, s_xt, i_xt, r_xt
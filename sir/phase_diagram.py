@@ -0,0 +1,146 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from sir.discreteSim import simulateSIR
+
+
+def task_seed(seed, b, k, replicate):
+    """
+    Returns the seed of one replicate of the (b, k) cell
+
+    The seed only depends on the cell and the replicate number, so cells added
+    by refinement do not change the random streams of the other cells
+    """
+    entropy = [seed, replicate, int(round(b * 1e6)), int(round(k * 1e6))]
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+
+def _final_state(task):
+    """
+    Runs one replicate of the discrete model and returns the final fraction of susceptible people
+    """
+    n, b, k, t, seed = task
+    np.random.seed(seed)
+    S, I, R = simulateSIR(n, b, k, t, stop_when_extinct=True)
+    return S[-1] / n
+
+
+class PhaseDiagram():
+    """
+    Mean and variance over replicates of the final fraction of susceptible
+    people on a (k, b) grid
+
+    Attributes:
+        b - Sorted b values (columns)
+        k - Sorted k values (rows), including the values added by refinement
+        mean - (len(k), len(b)) array of means, NaN where a cell was not evaluated
+        var - (len(k), len(b)) array of variances, NaN where a cell was not evaluated
+        replicates - (len(k), len(b)) array of the number of replicates per cell
+    """
+
+    def __init__(self, results):
+        self.b = np.array(sorted(set(b for b, k in results)))
+        self.k = np.array(sorted(set(k for b, k in results)))
+        self.mean = np.full((len(self.k), len(self.b)), np.nan)
+        self.var = np.full((len(self.k), len(self.b)), np.nan)
+        self.replicates = np.zeros((len(self.k), len(self.b)), dtype=int)
+
+        for (b, k), finals in results.items():
+            row = np.searchsorted(self.k, k)
+            col = np.searchsorted(self.b, b)
+            self.mean[row, col] = np.mean(finals)
+            self.var[row, col] = np.var(finals)
+            self.replicates[row, col] = len(finals)
+
+    def filled(self, values=None):
+        """
+        Returns values (default mean) with the cells that were not evaluated
+        filled by linear interpolation along k, e.g. for plotting with imshow
+        """
+        if values is None:
+            values = self.mean
+        values = values.copy()
+        for col in range(len(self.b)):
+            known = ~np.isnan(values[:, col])
+            values[~known, col] = np.interp(self.k[~known], self.k[known], values[known, col])
+        return values
+
+
+def phase_diagram_discrete(b_values, k_values, n=2000, t=500, replicates=5, workers=None,
+                           refine=0, tol=0.1, seed=None):
+    """
+    Computes the phase diagram of the final state of the discrete model over a (b, k) grid
+
+    Every cell is simulated replicates times with simulateSIR, spread over a pool
+    of worker processes. Each replicate stops as soon as the infection dies out.
+
+    After the uniform grid, up to refine rounds of refinement add the midpoint
+    between neighbouring k values of the same b wherever b/k crosses the epidemic
+    threshold 1 or the mean final state changes by more than tol, so that the
+    transition is resolved without running a dense uniform grid.
+
+    Arguments:
+        b_values - Numbers of interactions per day (non-negative integers)
+        k_values - Recovery rates (positive)
+
+    Optional Arguments:
+        n - Population size (default 2000)
+        t - Number of days to simulate (default 500)
+        replicates - Number of replicates per cell (default 5)
+        workers - Number of worker processes, 1 runs in this process (default os.cpu_count())
+        refine - Number of refinement rounds (default 0)
+        tol - Change of the mean final state between neighbouring cells that triggers refinement (default 0.1)
+        seed - Base seed of the replicates (default None, i.e. fresh entropy)
+
+    Returns a PhaseDiagram
+    """
+    # Checked up front, since a bad value would otherwise only fail in a worker or during refinement
+    if any(b != int(b) or b < 0 for b in b_values):
+        raise ValueError(f'b values must be non-negative integers, got {list(b_values)}')
+    if any(k <= 0 for k in k_values):
+        raise ValueError(f'k values must be positive, got {list(k_values)}')
+    b_values = [int(b) for b in b_values]
+
+    if workers is None:
+        workers = os.cpu_count()
+    if seed is None:
+        seed = np.random.SeedSequence().entropy % 2**32
+
+    results = {}
+
+    def evaluate(points, executor):
+        tasks = [(n, b, k, t, task_seed(seed, b, k, r)) for b, k in points for r in range(replicates)]
+        if executor is None:
+            finals = [_final_state(task) for task in tasks]
+        else:
+            chunksize = max(1, len(tasks) // (4 * workers))
+            finals = list(executor.map(_final_state, tasks, chunksize=chunksize))
+        for i, point in enumerate(points):
+            results[point] = np.array(finals[i * replicates:(i + 1) * replicates])
+
+    def refinement_points():
+        points = []
+        for b in b_values:
+            column = sorted(k for bb, k in results if bb == b)
+            for k0, k1 in zip(column[:-1], column[1:]):
+                crosses = (b / k0 - 1) * (b / k1 - 1) <= 0
+                jump = abs(np.mean(results[(b, k1)]) - np.mean(results[(b, k0)])) > tol
+                if crosses or jump:
+                    points.append((b, (k0 + k1) / 2))
+        return points
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        evaluate([(b, k) for b in b_values for k in k_values], executor)
+        for level in range(refine):
+            points = refinement_points()
+            if len(points) == 0:
+                break
+            evaluate(points, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return PhaseDiagram(results)
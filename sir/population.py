@@ -0,0 +1,105 @@
+import heapq
+
+# Integer codes of the states in snapshots and in the array based kernels
+STATE_CODES = {'S': 0, 'I': 1, 'R': 2}
+
+
+class PopulationState():
+    """
+    Keeps the number of agents in every state up to date as transitions happen,
+    together with an index of the agents in the tracked (infected) states, so
+    that engines neither rescan the population to count it nor to find the
+    infected agents.
+
+    All state changes of the wrapped agents must go through set_state.
+
+    Arguments:
+        people - sequence of agents, each with a state attribute
+
+    Optional Arguments:
+        states - names of all possible states (default ('S', 'I', 'R'))
+        tracked - states whose members are indexed (default every state starting with 'I')
+    """
+
+    def __init__(self, people, states=('S', 'I', 'R'), tracked=None):
+
+        if tracked is None:
+            tracked = [state for state in states if state.startswith('I')]
+
+        self.people = people
+        self.states = tuple(states)
+        self.counts = {state: 0 for state in self.states}
+        self._members = {state: set() for state in tracked}
+        # Heaps of the scans in progress, which also receive the agents that join a tracked state
+        self._scans = []
+
+        # One scan to initialize the counters, every later update is O(1)
+        for index in range(len(people)):
+            state = people[index].state
+            self.counts[state] += 1
+            if state in self._members:
+                self._members[state].add(index)
+
+    def count(self, state):
+        """
+        Returns the number of agents in state
+        """
+        return self.counts[state]
+
+    def members(self, *states):
+        """
+        Returns the indices of the agents in the given tracked states in increasing order
+
+        The result is a snapshot, so it is safe to change states while iterating over it
+        """
+        if len(states) == 1:
+            return sorted(self._members[states[0]])
+        return sorted(set().union(*[self._members[state] for state in states]))
+
+    def scan(self, *states):
+        """
+        Yields the indices of the agents in the given tracked states in increasing
+        order, like a loop over all agents that checks the state of every agent
+        when it reaches it: agents that enter these states during the scan are
+        visited too if they are still ahead, and agents that leave them before
+        they are reached are skipped
+        """
+        heap = self.members(*states)  # A sorted list is a heap
+        self._scans.append(heap)
+        try:
+            last = -1
+            while heap:
+                index = heapq.heappop(heap)
+                if index <= last or self.people[index].state not in states:
+                    continue
+                last = index
+                yield index
+        finally:
+            self._scans = [scan for scan in self._scans if scan is not heap]
+
+    def set_state(self, index, new_state):
+        """
+        Changes the state of agent index to new_state and updates the counters
+        """
+        person = self.people[index]
+        old_state = person.state
+        if old_state == new_state:
+            return
+
+        person.state = new_state
+        self.counts[old_state] -= 1
+        self.counts[new_state] += 1
+
+        if old_state in self._members:
+            self._members[old_state].discard(index)
+        if new_state in self._members:
+            self._members[new_state].add(index)
+            for heap in self._scans:
+                heapq.heappush(heap, index)
+
+    def set_states(self, indices, new_state):
+        """
+        Changes the state of every agent in indices to new_state
+        """
+        for index in indices:
+            self.set_state(int(index), new_state)
@@ -0,0 +1,233 @@
+import json
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # resource is not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process in kilobytes,
+    or None if it cannot be determined on this platform
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux and the BSDs
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def import_times(modules, preload=('numpy',)):
+    """
+    Measures the import of modules in a fresh interpreter with python -X importtime
+    Input:
+        modules(list): names of the modules to import, e.g. ['sir.engines']
+        preload(tuple): modules imported first, whose time is then not counted
+            for the modules that use them (default numpy)
+
+    Return:
+        Dictionary of module name to cumulative import time in seconds of
+        every imported module other than the preloaded ones themselves
+    """
+    import subprocess
+
+    statement = '; '.join(f'import {name}' for name in list(preload) + list(modules))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                          capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_us, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) / 1e6
+    for name in preload:
+        times.pop(name, None)
+    return times
+
+
+class _Phase():
+    """
+    Context manager that adds the time spent inside it to one phase of the current step
+    """
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.timings[self.name] = self.timings.get(self.name, 0.0) + elapsed
+        return False
+
+
+class _NullPhase():
+    """
+    Context manager that does nothing, shared by every disabled phase
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class NullProfiler():
+    """
+    Profiler used when instrumentation is disabled. Every hook is a no-op
+    so that engines can report unconditionally at almost no cost.
+    """
+    enabled = False
+
+    def begin(self, engine, **params):
+        pass
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def end_step(self, step, **counts):
+        pass
+
+    def wrap_rhs(self, fun):
+        return fun
+
+    def solver_stats(self, sol):
+        pass
+
+    def end(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class Profiler(NullProfiler):
+    """
+    Collects per step phase timings, ODE solver statistics and peak memory
+    for the simulation engines.
+
+    Every engine accepts a profiler argument and reports through the same hooks:
+        begin(engine, **params) - start of a run
+        phase(name) - context manager timing one phase of the current step,
+            e.g. 'move', 'index', 'query', 'infection', 'recovery', 'counting'
+        end_step(step, **counts) - end of a step with the compartment counts
+        wrap_rhs(fun) - counts right hand side evaluations of an ODE solver
+        solver_stats(sol) - records step sizes of a solve_ivp solution
+        end() - end of a run, writes the summary record
+
+    Optional Arguments:
+        path - JSON-lines file that the records of each run are appended to (default None)
+        steps - Keep one record per step, not only the run summary (default True)
+
+    After a run, records holds a list of dictionaries: one 'step' record per
+    step followed by a 'run' record with the totals.
+    """
+    enabled = True
+
+    def __init__(self, path=None, steps=True):
+        self.path = path
+        self.steps = steps
+        self.records = []
+        self._timings = {}
+        self._totals = {}
+
+    def begin(self, engine, **params):
+        self.engine = engine
+        self.params = params
+        self.rhs_calls = 0
+        self.step_sizes = None
+        self._first = len(self.records)
+        self._timings = {}
+        self._totals = {}
+        self._start = time.perf_counter()
+
+    def phase(self, name):
+        return _Phase(self._timings, name)
+
+    def end_step(self, step, **counts):
+        for name, elapsed in self._timings.items():
+            self._totals[name] = self._totals.get(name, 0.0) + elapsed
+
+        if self.steps:
+            self.records.append({'record': 'step',
+                                 'engine': self.engine,
+                                 'step': int(step),
+                                 'phases': self._timings,
+                                 'counts': {key: _jsonable(value) for key, value in counts.items()}})
+        self._timings = {}
+
+    def wrap_rhs(self, fun):
+        """
+        Returns fun wrapped so that every call increments rhs_calls
+        """
+        def counted(t, y):
+            self.rhs_calls += 1
+            return fun(t, y)
+
+        return counted
+
+    def solver_stats(self, sol):
+        """
+        Stores the accepted step sizes of a solve_ivp solution, which are only
+        available when it was computed with dense_output=True
+        """
+        if getattr(sol, 'sol', None) is not None:
+            self.step_sizes = np.diff(sol.sol.ts)
+
+    def end(self):
+        # Phases timed after the last end_step (or in engines without steps)
+        for name, elapsed in self._timings.items():
+            self._totals[name] = self._totals.get(name, 0.0) + elapsed
+        self._timings = {}
+
+        record = {'record': 'run',
+                  'engine': self.engine,
+                  'params': {key: _jsonable(value) for key, value in self.params.items()},
+                  'wall_time': time.perf_counter() - self._start,
+                  'phases': self._totals,
+                  'rhs_calls': self.rhs_calls,
+                  'peak_rss_kb': peak_rss()}
+
+        if self.step_sizes is not None and len(self.step_sizes) > 0:
+            record['n_steps'] = len(self.step_sizes)
+            record['min_step'] = float(np.min(self.step_sizes))
+            record['mean_step'] = float(np.mean(self.step_sizes))
+            record['max_step'] = float(np.max(self.step_sizes))
+
+        self.records.append(record)
+
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                for rec in self.records[self._first:]:
+                    f.write(json.dumps(rec) + '\n')
+
+    def summary(self):
+        """
+        Returns the 'run' record of the most recent run
+        """
+        for record in reversed(self.records):
+            if record['record'] == 'run':
+                return record
+
+
+def _jsonable(value):
+    """
+    Converts numpy scalars and other values so that they can be written as JSON
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (int, float, str, bool)) or value is None:
+        return value
+    return repr(value)
@@ -0,0 +1,280 @@
+"""
+Global sensitivity analysis of the simulation engines
+
+Sobol indices are estimated from a Saltelli design: two matrices A and B of N
+points of a scrambled Sobol sequence, and for every parameter i the matrix
+AB_i, which is A with column i taken from B. This gives N * (D + 2) model
+evaluations for D parameters. The Morris method needs r * (D + 1) evaluations
+and screens for the parameters whose elementary effects are large.
+
+Example:
+    bounds = {'k': (0.05, 0.5), 'q': (0.01, 0.05), 's': (0, 1), 'a': (0, 1), 'L': (0, 60)}
+    indices = sobol_analysis('variation_2', bounds, 256, params={'n': 1000, 't': 100})
+    indices['ST']                            # total effect of every parameter
+"""
+import functools
+import hashlib
+import json
+import numbers
+
+import numpy as np
+
+from sir.cache import result_key
+from sir.engines import get_engine
+from sir.transport import run_engine_sweep
+
+# Summaries of a run that can be analysed, see outcome
+OUTPUTS = ('peak_infected', 'peak_day', 'final_recovered', 'attack_rate')
+
+
+def integer_flags(bounds):
+    """
+    Returns for every parameter of bounds whether it takes integer values,
+    i.e. whether its low and high bounds are both ints, e.g. L; NumPy integers count as ints
+    """
+    return [isinstance(low, numbers.Integral) and isinstance(high, numbers.Integral) for low, high in bounds.values()]
+
+
+def scale(U, bounds):
+    """
+    Maps points of the unit cube to the bounds of the parameters
+    Input:
+        U(array): (m, D) points in [0, 1]**D
+        bounds(dict): parameter name to (low, high); parameters whose bounds
+            are both ints, e.g. L, take integer values
+
+    Return:
+        Array of shape (m, D)
+    """
+    low = np.array([low for low, high in bounds.values()], dtype=float)
+    high = np.array([high for low, high in bounds.values()], dtype=float)
+    X = low + U * (high - low)
+    for j, integer in enumerate(integer_flags(bounds)):
+        if integer:
+            X[:, j] = np.round(X[:, j])
+    return X
+
+
+def saltelli_sample(bounds, N, seed=None):
+    """
+    Returns the Saltelli design of N base points as an (N * (D + 2), D) array
+    of parameter values, with the blocks A, B, AB_1, ..., AB_D stacked in this order
+
+    N should be a power of 2 to keep the balance properties of the Sobol sequence.
+    """
+    from scipy.stats import qmc
+    D = len(bounds)
+    base = qmc.Sobol(d=2 * D, scramble=True, seed=seed).random(N)
+    A, B = base[:, :D], base[:, D:]
+
+    AB = np.repeat(A[None], D, axis=0)
+    AB[np.arange(D), :, np.arange(D)] = B.T
+    return scale(np.concatenate([A, B, AB.reshape(D * N, D)]), bounds)
+
+
+def _sobol_estimates(fA, fB, fAB):
+    """
+    First order (Saltelli 2010) and total (Jansen) indices of the last axis of
+    fAB, for every leading index of a batch of resamples
+    """
+    var = np.var(np.concatenate([fA, fB], axis=-1), axis=-1)[..., None]
+    S1 = np.mean(fB[..., None] * (fAB - fA[..., None]), axis=-2) / var
+    ST = 0.5 * np.mean((fA[..., None] - fAB)**2, axis=-2) / var
+    return S1, ST
+
+
+def sobol_analyze(Y, D, num_resamples=200, confidence=0.95, seed=None, batch_bytes=2**26):
+    """
+    Estimates the Sobol indices from the outputs of a Saltelli design
+    Input:
+        Y(array): the N * (D + 2) outputs of the points of saltelli_sample
+        D(int): number of parameters
+        num_resamples(int): bootstrap resamples for the confidence intervals
+        confidence(float): level of the confidence intervals
+        batch_bytes(int): memory bound of one batch of bootstrap resamples
+
+    Return:
+        Dictionary with the first order indices S1 and the total indices ST of
+        shape (D,), and S1_conf and ST_conf of shape (2, D), the percentile
+        bootstrap confidence intervals
+    """
+    Y = np.asarray(Y, dtype=float)
+    N = len(Y) // (D + 2)
+    fA, fB = Y[:N], Y[N:2 * N]
+    fAB = Y[2 * N:].reshape(D, N).T
+    S1, ST = _sobol_estimates(fA, fB, fAB)
+
+    rng = np.random.default_rng(seed)
+    batch = max(1, batch_bytes // (8 * N * (D + 2)))
+    S1_boot, ST_boot = [], []
+    for start in range(0, num_resamples, batch):
+        idx = rng.integers(0, N, size=(min(batch, num_resamples - start), N))
+        s1, st = _sobol_estimates(fA[idx], fB[idx], fAB[idx])
+        S1_boot.append(s1)
+        ST_boot.append(st)
+
+    q = 100 * np.array([(1 - confidence) / 2, (1 + confidence) / 2])
+    return {'S1': S1, 'ST': ST,
+            'S1_conf': np.percentile(np.concatenate(S1_boot), q, axis=0),
+            'ST_conf': np.percentile(np.concatenate(ST_boot), q, axis=0)}
+
+
+def morris_sample(bounds, r, levels=4, seed=None):
+    """
+    Returns r Morris trajectories as an (r * (D + 1), D) array of parameter
+    values; consecutive points of a trajectory differ in one parameter by
+    delta = levels / (2 * (levels - 1)) of its range
+    """
+    rng = np.random.default_rng(seed)
+    D = len(bounds)
+    delta = levels / (2 * (levels - 1))
+
+    # Random base points on the grid, far enough from 1 to take a step of delta
+    start = rng.integers(0, int(round((1 - delta) * (levels - 1))) + 1, size=(r, 1, D)) / (levels - 1)
+    steps = np.tril(np.ones((D + 1, D)), -1)
+    signs = rng.choice([-1, 1], size=(r, 1, D))
+    U = start + delta / 2 * ((2 * steps - 1) * signs + 1)
+
+    # Random order in which the parameters change along every trajectory
+    order = np.argsort(rng.random((r, 1, D)), axis=2)
+    U = np.take_along_axis(U, np.broadcast_to(order, U.shape), axis=2)
+    return scale(U.reshape(r * (D + 1), D), bounds)
+
+
+def morris_analyze(X, Y, bounds):
+    """
+    Elementary effects of the outputs Y of the points X of morris_sample
+    Return:
+        Dictionary with mu, the mean elementary effect, mu_star, the mean
+        absolute effect, and sigma, their standard deviation, of shape (D,).
+        The effects are per unit range of every parameter.
+    """
+    D = len(bounds)
+    low = np.array([low for low, high in bounds.values()], dtype=float)
+    high = np.array([high for low, high in bounds.values()], dtype=float)
+    U = ((np.asarray(X, dtype=float) - low) / (high - low)).reshape(-1, D + 1, D)
+    Y = np.asarray(Y, dtype=float).reshape(-1, D + 1)
+
+    dU = np.diff(U, axis=1)
+    changed = np.argmax(np.abs(dU), axis=2)
+    step = np.take_along_axis(dU, changed[..., None], axis=2)[..., 0]
+    effects = np.zeros((len(U), D))
+    np.put_along_axis(effects, changed, np.diff(Y, axis=1) / step, axis=1)
+
+    return {'mu': effects.mean(axis=0), 'mu_star': np.abs(effects).mean(axis=0),
+            'sigma': effects.std(axis=0, ddof=1) if len(U) > 1 else np.zeros(D)}
+
+
+def outcome(result, output='peak_infected'):
+    """
+    Summarizes the result of an engine (a dictionary of output name to array)
+    by one of OUTPUTS; the counts I, R or fractions i, r of any engine are used,
+    with I_A + I_S for varsim_tori
+    """
+    if 'I' in result:
+        I, R, total = result['I'], result['R'], result['S'][0] + result['I'][0] + result['R'][0]
+    elif 'I_A' in result:
+        I = result['I_A'] + result['I_S']
+        R, total = result['R'], result['S'][0] + I[0] + result['R'][0]
+    else:
+        I, R, total = result['i'], result['r'], result['s'][0] + result['i'][0] + result['r'][0]
+
+    if output == 'peak_infected':
+        return {'y': np.max(I)}
+    if output == 'peak_day':
+        return {'y': np.argmax(I)}
+    if output == 'final_recovered':
+        return {'y': R[-1]}
+    if output == 'attack_rate':
+        return {'y': R[-1] / total}
+    raise ValueError(f'unknown output {output!r}, expected one of {OUTPUTS}')
+
+
+def evaluate(model, X, names, params=None, seed=0, output='peak_infected', workers=None, cache=None, chunk=1000,
+             integer=None):
+    """
+    Evaluates the model at every point of a design
+    Input:
+        model: name of a registered engine, or a function of the (m, D) array
+            of points returning the m outputs at once (a batched model)
+        X(array): (m, D) parameter values, e.g. of saltelli_sample
+        names(list): the D parameter names of the columns of X
+        params(dict): fixed keyword arguments of the engine
+        seed(int): seed of every run, so that all points share the random
+            numbers as far as the engine allows (common random numbers)
+        output(str): summary of every run, one of OUTPUTS
+        workers(int): worker processes of sir.transport.run_engine_sweep
+        cache(ResultCache): the outputs of every chunk of points are cached, so
+            an interrupted or repeated analysis only runs the missing chunks
+        chunk(int): number of runs per chunk
+        integer(list): for every column whether the engine gets it as an int,
+            e.g. integer_flags(bounds) (default None, all floats)
+
+    Return:
+        Array of the m outputs
+    """
+    X = np.asarray(X)
+    if callable(model):
+        return np.asarray(model(X), dtype=float)
+
+    engine = get_engine(model)
+    params = dict(params or {})
+    if integer is None:
+        integer = [False] * len(names)
+    tasks = [dict(params, **{name: (int(value) if integer[j] else float(value))
+                             for j, (name, value) in enumerate(zip(names, point))})
+             for point in X]
+
+    Y = np.empty(len(tasks))
+    for start in range(0, len(tasks), chunk):
+        part = tasks[start:start + chunk]
+        key = None
+        if cache is not None:
+            keys = [result_key(engine, task, seed) for task in part]
+            key = hashlib.sha256(json.dumps(['sensitivity', output] + keys).encode()).hexdigest()
+            cached = cache.get(key)
+            if cached is not None:
+                Y[start:start + len(part)] = cached['y']
+                continue
+
+        results = run_engine_sweep(engine.name, part, [seed] * len(part),
+                                   reduce=functools.partial(outcome, output=output), workers=workers)
+        Y[start:start + len(part)] = results['y']
+        results.close()
+        if key is not None:
+            cache.put(key, {'y': Y[start:start + len(part)]})
+    return Y
+
+
+def sobol_analysis(model, bounds, N, params=None, output='peak_infected', seed=0, num_resamples=200,
+                   confidence=0.95, workers=None, cache=None):
+    """
+    Sobol indices of the parameters in bounds for an engine or batched model,
+    from a Saltelli design of N base points (N * (D + 2) runs)
+
+    Arguments as in saltelli_sample, evaluate and sobol_analyze. Returns the
+    dictionary of sobol_analyze, with the parameter names under 'names'.
+    """
+    names = list(bounds)
+    X = saltelli_sample(bounds, N, seed)
+    Y = evaluate(model, X, names, params, seed, output, workers, cache, integer=integer_flags(bounds))
+    indices = sobol_analyze(Y, len(names), num_resamples, confidence, seed)
+    indices['names'] = names
+    return indices
+
+
+def morris_analysis(model, bounds, r, params=None, output='peak_infected', levels=4, seed=0,
+                    workers=None, cache=None):
+    """
+    Morris elementary effects of the parameters in bounds for an engine or
+    batched model, from r trajectories (r * (D + 1) runs)
+
+    Arguments as in morris_sample and evaluate. Returns the dictionary of
+    morris_analyze, with the parameter names under 'names'.
+    """
+    names = list(bounds)
+    X = morris_sample(bounds, r, levels, seed)
+    Y = evaluate(model, X, names, params, seed, output, workers, cache, integer=integer_flags(bounds))
+    effects = morris_analyze(X, Y, bounds)
+    effects['names'] = names
+    return effects
@@ -0,0 +1,411 @@
+import asyncio
+import atexit
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from sir.cache import result_key
+from sir.engines import get_engine
+from sir.profiling import NullProfiler
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a worker process to stop a run that was cancelled
+    """
+
+
+class StreamingProfiler(NullProfiler):
+    """
+    Profiler that sends the counts of every step of a run to the service and
+    stops the run when it is cancelled
+
+    Engines with steps report their daily counts through end_step; ODE engines
+    are checked for cancellation every check_every right hand side evaluations.
+
+    Arguments:
+        queue - Queue the (job id, step, counts) of every step are put on
+        job_id - Id of the job of the run
+        cancel - Event that is set when the run is cancelled
+
+    Optional Arguments:
+        check_every - Right hand side evaluations between cancellation checks (default 200)
+    """
+
+    def __init__(self, queue, job_id, cancel, check_every=200):
+        self.queue = queue
+        self.job_id = job_id
+        self.cancel = cancel
+        self.check_every = check_every
+
+    def end_step(self, step, **counts):
+        if self.cancel.is_set():
+            raise Cancelled()
+        self.queue.put((self.job_id, step, {name: float(value) for name, value in counts.items()}))
+
+    def wrap_rhs(self, fun):
+        calls = itertools.count(1)
+
+        def checked(t, y):
+            if next(calls) % self.check_every == 0 and self.cancel.is_set():
+                raise Cancelled()
+            return fun(t, y)
+        return checked
+
+
+def _run_job(name, params, seed, job_id, queue, cancel):
+    """
+    Runs one job in a worker process; returns None when it was cancelled
+    """
+    engine = get_engine(name)
+    profiler = StreamingProfiler(queue, job_id, cancel)
+    try:
+        if cancel.is_set():
+            return None
+        return engine.run(dict(params, profiler=profiler), seed)
+    except Cancelled:
+        return None
+    finally:
+        # Marks the end of the rows of the job, which may arrive after the result
+        queue.put((job_id, None, None))
+
+
+def _call_soon(loop, callback, *args):
+    """
+    Hands a callback to the event loop from another thread; once the loop is
+    closed nobody waits for it anymore, so it is dropped
+    """
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        pass
+
+
+def result_rows(result):
+    """
+    Splits a result into daily rows: row j holds the j-th entry of every
+    output that has one entry per time point, e.g. t, s, i, r of odeSim
+    """
+    length = max([len(value) for value in result.values() if value.ndim == 1] + [0])
+    names = [name for name, value in result.items() if value.ndim == 1 and len(value) == length]
+    return [dict({'step': j}, **{name: float(result[name][j]) for name in names}) for j in range(length)]
+
+
+class Job():
+    """
+    One run submitted to a SimulationService
+
+    A job is awaitable, giving the result of the run as a dictionary of
+    output name to array, and asynchronously iterable, giving the rows of
+    counts {'step': ..., 'S': ..., ...} while the run progresses. Engines
+    that report no steps (the ODE solvers) give the rows of their result once
+    it is done. Every iterator starts with the rows reported so far, so
+    callers sharing a deduplicated job all see every row.
+    """
+
+    def __init__(self, service, job_id, engine, params, seed, key):
+        self.service = service
+        self.id = job_id
+        self.engine = engine
+        self.params = params
+        self.seed = seed
+        self.key = key
+        self.rows = []
+        self.streamed = False
+        self.stream_closed = False
+        self.outcome = None
+        self.waiting = 0
+        self.future = service.loop.create_future()
+        self.subscribers = []
+        self.cancel_event = None
+        self.process_future = None
+
+    def _add_row(self, row):
+        self.rows.append(row)
+        for queue in self.subscribers:
+            queue.put_nowait(row)
+
+    def _finish(self, result=None, error=None, cancelled=False):
+        if self.future.done():
+            return
+        if result is not None and not self.streamed:
+            for row in result_rows(result):
+                self._add_row(row)
+        for queue in self.subscribers:
+            queue.put_nowait(None)
+        if cancelled:
+            self.future.cancel()
+        elif error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(result)
+
+    def done(self):
+        return self.future.done()
+
+    def cancel(self):
+        """
+        Cancels the run, also for the other callers sharing it; awaiting the
+        job then raises asyncio.CancelledError
+        """
+        if self.future.done():
+            return False
+        if self.process_future is not None:
+            self.process_future.cancel()
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+        # New requests start a new run instead of sharing the cancelled one
+        if self.key is not None and self.service.in_flight.get(self.key) is self:
+            del self.service.in_flight[self.key]
+        self._finish(cancelled=True)
+        return True
+
+    def __await__(self):
+        return asyncio.shield(self.future).__await__()
+
+    async def __aiter__(self):
+        queue = asyncio.Queue()
+        for row in self.rows:
+            queue.put_nowait(row)
+        if self.future.done():
+            queue.put_nowait(None)
+        else:
+            self.subscribers.append(queue)
+        try:
+            while True:
+                row = await queue.get()
+                if row is None:
+                    break
+                yield row
+        finally:
+            if queue in self.subscribers:
+                self.subscribers.remove(queue)
+
+
+class SimulationService():
+    """
+    Runs the registered engines on a pool of worker processes from asyncio code
+
+    Requests with the same engine, parameters and seed that are in flight at
+    the same time share one run (deterministic engines share it for any seed;
+    stochastic runs without a seed are never shared, as in sir.cache).
+    A ResultCache, if given, answers repeated requests without running them.
+
+    Optional Arguments:
+        workers - Number of worker processes (default os.cpu_count())
+        cache - sir.cache.ResultCache finished runs are stored in (default None)
+    """
+
+    def __init__(self, workers=None, cache=None):
+        self.workers = workers or os.cpu_count()
+        self.cache = cache
+        self.loop = None
+        self.executor = None
+        self.manager = None
+        self.queue = None
+        self.pump = None
+        self.jobs = {}
+        self.in_flight = {}
+        self.ids = itertools.count()
+
+    def _start(self):
+        self.loop = asyncio.get_running_loop()
+        self.manager = multiprocessing.Manager()
+        self.queue = self.manager.Queue()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        # Rows arrive on a queue of the manager process and are handed to the event loop by a thread
+        self.pump = threading.Thread(target=self._pump, args=(self.loop, self.queue), daemon=True)
+        self.pump.start()
+
+    def _pump(self, loop, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            _call_soon(loop, self._dispatch, *item)
+
+    def _dispatch(self, job_id, step, counts):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        if step is None:
+            job.stream_closed = True
+            self._settle(job)
+        elif not job.done():
+            job.streamed = True
+            job._add_row(dict({'step': step}, **counts))
+
+    def submit(self, engine, params, seed=None):
+        """
+        Starts a run of the engine called engine with the keyword arguments in
+        params and returns its Job; must be called from a running event loop
+
+        A service can be used again from a new event loop, e.g. of a later
+        asyncio.run, once the loop of its earlier runs is closed.
+        """
+        loop = asyncio.get_running_loop()
+        if self.loop is not None and self.loop is not loop:
+            if not self.loop.is_closed():
+                raise RuntimeError('the service is in use by another event loop')
+            self.close()
+        if self.loop is None:
+            self._start()
+        engine = get_engine(engine)
+        params = engine.normalize(params)
+
+        key = None
+        if not engine.stochastic or seed is not None:
+            key = result_key(engine, params, seed)
+            if key in self.in_flight:
+                return self.in_flight[key]
+
+        job = Job(self, next(self.ids), engine.name, params, seed, key)
+        cached = self.cache.get(key) if self.cache is not None and key is not None else None
+        if cached is not None:
+            job._finish(result=cached)
+            return job
+
+        self.jobs[job.id] = job
+        if key is not None:
+            self.in_flight[key] = job
+        job.cancel_event = self.manager.Event()
+        job.process_future = self.executor.submit(_run_job, engine.name, params, seed, job.id,
+                                                  self.queue, job.cancel_event)
+        job.process_future.add_done_callback(lambda future: _call_soon(loop, self._completed, job, future))
+        return job
+
+    def _completed(self, job, future):
+        if future.cancelled():
+            # The run never started, so no rows will come
+            job.stream_closed = True
+            job.outcome = (None, None)
+        else:
+            job.outcome = (future.result() if future.exception() is None else None, future.exception())
+        self._settle(job)
+
+    def _settle(self, job):
+        """
+        Finishes a job once both its result and the end of its rows have arrived
+        """
+        if job.outcome is None or not job.stream_closed:
+            return
+        self.jobs.pop(job.id, None)
+        if job.key is not None and self.in_flight.get(job.key) is job:
+            del self.in_flight[job.key]
+
+        result, error = job.outcome
+        if error is None and result is None:
+            job._finish(cancelled=True)
+            return
+        if result is not None and self.cache is not None and job.key is not None:
+            self.cache.put(job.key, result)
+        job._finish(result, error)
+
+    async def run(self, engine, params, seed=None):
+        """
+        Runs the engine and returns its result; cancelling the awaiting task
+        cancels the run unless other callers are waiting for it too
+        """
+        job = self.submit(engine, params, seed)
+        job.waiting += 1
+        try:
+            return await job
+        except asyncio.CancelledError:
+            if not job.done() and job.waiting == 1:
+                job.cancel()
+            raise
+        finally:
+            job.waiting -= 1
+
+    def close(self):
+        """
+        Cancels the runs in flight and stops the worker processes; must be
+        called from the thread of the event loop, or once it is closed
+        """
+        if self.loop is not None and not self.loop.is_closed():
+            for job in list(self.jobs.values()):
+                job.cancel()
+        else:
+            # The futures of a closed loop can no longer be resolved, only the runs are stopped
+            for job in self.jobs.values():
+                job.process_future.cancel()
+                job.cancel_event.set()
+        self._shutdown()
+
+    def _shutdown(self):
+        """
+        Stops the worker processes, the pump thread and the manager; blocks
+        until they are done, but does not touch the event loop, so it can run
+        in another thread
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.queue.put(None)
+            self.pump.join()
+            self.manager.shutdown()
+        self.loop = self.executor = self.manager = self.queue = self.pump = None
+        self.jobs = {}
+        self.in_flight = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        # Futures and queues of the loop are cancelled here, only the blocking shutdown runs in a thread
+        for job in list(self.jobs.values()):
+            job.cancel()
+        await asyncio.get_running_loop().run_in_executor(None, self._shutdown)
+
+
+# Services used by run_async and stream when none is given, one per event loop
+_default_services = {}
+
+
+def default_service():
+    """
+    Returns the service shared by run_async and stream in the running event
+    loop, created on first use; the services of loops that have been closed
+    since, e.g. of an earlier asyncio.run, are closed
+    """
+    loop = asyncio.get_running_loop()
+    for other in [other for other in _default_services if other.is_closed()]:
+        _default_services.pop(other).close()
+    if loop not in _default_services:
+        _default_services[loop] = SimulationService()
+    return _default_services[loop]
+
+
+@atexit.register
+def _close_default_services():
+    # The worker processes and the manager would otherwise outlive the interpreter
+    while _default_services:
+        _default_services.popitem()[1].close()
+
+
+async def run_async(engine, params, seed=None, service=None):
+    """
+    Runs a registered engine on a worker process without blocking the event loop
+
+    Example:
+        S, I, R = (await run_async('discreteSim', {'n': 1000, 'b': 2, 'k': 0.3, 't': 100}, seed=1)).values()
+
+    Returns a dictionary of output name to array
+    """
+    return await (service or default_service()).run(engine, params, seed)
+
+
+async def stream(engine, params, seed=None, service=None):
+    """
+    Runs a registered engine like run_async and yields the daily rows of
+    counts while it runs
+
+    Example:
+        async for row in stream('discreteSim', {'n': 1000, 'b': 2, 'k': 0.3, 't': 100}):
+            print(row['step'], row['I'])
+    """
+    job = (service or default_service()).submit(engine, params, seed)
+    async for row in job:
+        yield row
+    await job
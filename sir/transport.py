@@ -0,0 +1,262 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArrays():
+    """
+    Named NumPy arrays that several processes read and write without copies
+
+    The arrays live in multiprocessing.shared_memory blocks, or in memory mapped
+    .npy files when a directory is given, which keeps them on disk after the
+    run. The process that creates them passes spec to the other processes,
+    which open the same arrays with SharedArrays.attach(spec).
+
+    Arguments:
+        fields - Dictionary of array name to (shape, dtype)
+
+    Optional Arguments:
+        path - Directory of memory mapped .npy files, None for shared memory (default None)
+    """
+
+    def __init__(self, fields, path=None):
+        self.path = path
+        self.owner = True
+        self.blocks = []
+        self.arrays = {}
+        self.spec = []
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+        for name, (shape, dtype) in fields.items():
+            shape = tuple(int(size) for size in shape)
+            dtype = np.dtype(dtype)
+            if path is None:
+                shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+                self.blocks.append(shm)
+                array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                array[...] = 0
+                self.spec.append((name, 'shm', shm.name, shape, dtype.str))
+            else:
+                filename = os.path.join(path, name + '.npy')
+                array = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+                self.spec.append((name, 'memmap', filename, shape, dtype.str))
+            self.arrays[name] = array
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        Opens the arrays described by the spec of a SharedArrays created in another process
+        """
+        self = cls.__new__(cls)
+        self.path = None
+        self.owner = False
+        self.blocks = []
+        self.arrays = {}
+        self.spec = list(spec)
+
+        for name, kind, location, shape, dtype in spec:
+            if kind == 'shm':
+                shm = shared_memory.SharedMemory(name=location)
+                self.blocks.append(shm)
+                self.arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            else:
+                self.arrays[name] = np.load(location, mmap_mode='r+')
+        return self
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def keys(self):
+        return self.arrays.keys()
+
+    def close(self):
+        """
+        Releases the arrays of this process; views of them must not be used
+        anymore, and BufferError is raised while some are still referenced
+        """
+        for array in self.arrays.values():
+            if isinstance(array, np.memmap):
+                array.flush()
+        self.arrays = {}
+        for shm in self.blocks:
+            shm.close()
+        self.blocks = []
+
+    def unlink(self):
+        """
+        Frees the shared memory blocks once every process has closed them.
+        The arrays of processes that still have them open stay valid, so the
+        creating process can unlink as soon as the other processes are done.
+        Memory mapped files are kept.
+        """
+        if self.owner:
+            for name, kind, location, shape, dtype in self.spec:
+                if kind == 'shm':
+                    try:
+                        block = shared_memory.SharedMemory(name=location)
+                    except FileNotFoundError:
+                        continue
+                    block.close()
+                    block.unlink()
+            self.owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        self.unlink()
+
+
+class SharedResults(SharedArrays):
+    """
+    Preallocated results of a sweep of n tasks: every field gets a leading
+    dimension of size n, and the task i writes its outputs into row i
+
+    Arguments:
+        fields - Dictionary of output name to (shape, dtype) of one task
+        n - Number of tasks
+
+    Optional Arguments:
+        path - Directory of memory mapped .npy files, None for shared memory (default None)
+    """
+
+    def __init__(self, fields, n, path=None):
+        super().__init__({name: ((n,) + tuple(shape), dtype) for name, (shape, dtype) in fields.items()}, path)
+        self.n = n
+
+    @classmethod
+    def attach(cls, spec):
+        self = super().attach(spec)
+        self.n = spec[0][3][0] if len(spec) > 0 else 0
+        return self
+
+    def write(self, index, values):
+        """
+        Writes a dictionary of output name to array into the row of task index.
+        Raises ValueError when the outputs differ from the preallocated fields,
+        e.g. for tasks with different t or a run that stopped early.
+        """
+        for name, value in values.items():
+            if name not in self.arrays:
+                raise ValueError("Task {} returned the output '{}', which the first task did not".format(index, name))
+            shape = self.arrays[name].shape[1:]
+            if np.shape(value) != shape:
+                raise ValueError("Output '{}' of task {} has shape {}, but the first task gave {}; run_sweep "
+                                 "needs outputs of one shape, e.g. reduce them to fixed size summaries"
+                                 .format(name, index, np.shape(value), shape))
+        for name, value in values.items():
+            self.arrays[name][index] = value
+
+
+def fields_of(values):
+    """
+    Returns the (shape, dtype) of every array of a dictionary of outputs
+    """
+    return {name: (np.shape(value), np.asarray(value).dtype) for name, value in values.items()}
+
+
+# Results opened by a worker process of run_sweep
+_worker_results = None
+
+
+def _init_worker(spec):
+    global _worker_results
+    _worker_results = SharedResults.attach(spec)
+
+
+def _run_task(task):
+    index, fn, kwargs, reduce = task
+    values = fn(**kwargs)
+    if reduce is not None:
+        values = reduce(values)
+    _worker_results.write(index, values)
+    return index
+
+
+def run_sweep(fn, tasks, reduce=None, workers=None, path=None):
+    """
+    Runs fn(**task) for every task and collects the outputs without pickling them
+
+    The first task runs in this process to find the shapes of the outputs,
+    which are then preallocated for all tasks as SharedResults, so every task
+    must give outputs of the same shapes, otherwise ValueError is raised. The worker
+    processes attach to them once and write the outputs of every task
+    straight into its row, so only the task index travels back.
+
+    Arguments:
+        fn - Function returning a dictionary of output name to array, defined
+            at module level so that it can be sent to the worker processes
+        tasks - List of dictionaries of keyword arguments of fn
+
+    Optional Arguments:
+        reduce - Function applied to the outputs of every task in the worker,
+            e.g. to keep only the final sizes instead of whole trajectories (default None)
+        workers - Number of worker processes, 1 runs in this process (default os.cpu_count())
+        path - Directory of memory mapped .npy files, None for shared memory (default None)
+
+    Returns the SharedResults, whose arrays are views of the shared outputs
+    """
+    if workers is None:
+        workers = os.cpu_count()
+
+    first = fn(**tasks[0])
+    if reduce is not None:
+        first = reduce(first)
+    results = SharedResults(fields_of(first), len(tasks), path)
+    results.write(0, first)
+
+    rest = [(index, fn, task, reduce) for index, task in enumerate(tasks) if index > 0]
+    try:
+        if workers == 1 or len(rest) == 0:
+            for index, fn, task, reduce in rest:
+                values = fn(**task)
+                results.write(index, values if reduce is None else reduce(values))
+        else:
+            chunksize = max(1, len(rest) // (4 * workers))
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(results.spec,)) as executor:
+                list(executor.map(_run_task, rest, chunksize=chunksize))
+    except BaseException:
+        results.close()
+        results.unlink()
+        raise
+
+    # The workers are done, so the blocks can already be freed once this process closes them
+    results.unlink()
+    return results
+
+
+def _engine_task(name, params, seed):
+    from sir.engines import get_engine
+    return get_engine(name).run(params, seed)
+
+
+def run_engine_sweep(name, params, seeds=None, reduce=None, workers=None, path=None):
+    """
+    Runs a registered engine for every parameter set with run_sweep
+
+    Arguments:
+        name - Name of a registered engine, e.g. 'odeSim_spatial'
+        params - List of dictionaries of keyword arguments of the engine's entry point
+
+    Optional Arguments:
+        seeds - List of seeds, one per parameter set (default None)
+        reduce, workers, path - As in run_sweep
+
+    Returns the SharedResults with one row per parameter set
+    """
+    if reduce is None and len({repr(task_params.get('t')) for task_params in params}) > 1:
+        raise ValueError("The parameter sets have different t, so their trajectories have different "
+                         "shapes; give a reduce to fixed size outputs or run them in separate sweeps")
+    if seeds is None:
+        seeds = [None] * len(params)
+    tasks = [{'name': name, 'params': task_params, 'seed': seed} for task_params, seed in zip(params, seeds)]
+    return run_sweep(_engine_task, tasks, reduce, workers, path)
@@ -1,7 +1,9 @@
 import numpy as np
-from scipy.spatial import KDTree
 
 from sir.discreteSim_spatial import *
+from sir.backend import get_backend
+from sir.population import PopulationState
+from sir.profiling import NULL_PROFILER
 
 # Toka's Variation
 
@@ -61,7 +63,8 @@ class varPerson(Person):
 
 
         
-def runSimulation(k, q, p=0.03, n=1000, t=100, s=0.5, a=0.4, L=30, position='Random', num_initial_infected=10):
+def runSimulation(k, q, p=0.03, n=1000, t=100, s=0.5, a=0.4, L=30, position='Random', num_initial_infected=10, profiler=None,
+                  backend=None):
     """
     Arguments:
     k -  rate of recovery
@@ -76,10 +79,55 @@ def runSimulation(k, q, p=0.03, n=1000, t=100, s=0.5, a=0.4, L=30, position='Ran
     L - number of days of lockdown (defaults to L = 30)
     position - the start of infection (defaults to position = 'random')
     num_initial_infected - the number of initial infection (defaults to 10)
+    profiler - optional sir.profiling.Profiler that receives per step timings (defaults to None)
+    backend - run on position and state arrays with the kernels of sir.backend
+        ('numpy', 'numba' or 'auto') instead of varPerson objects; gives the
+        same result for the same seed (defaults to None)
 
     Return:
         List of S, I, R at time t
+    See iter_runSimulation for a version that yields the steps one at a time.
     """
+    S, I, R = [], [], []
+    for row in iter_runSimulation(k, q, p, n, t, s, a, L, position, num_initial_infected, profiler=profiler,
+                                  backend=backend):
+        S.append(row['S'])
+        I.append(row['I'])
+        R.append(row['R'])
+
+    return S, I, R
+
+
+def iter_runSimulation(k, q, p=0.03, n=1000, t=100, s=0.5, a=0.4, L=30, position='Random', num_initial_infected=10,
+                       snapshot=False, profiler=None, backend=None):
+    """
+    Generator version of runSimulation that yields the counts of every step
+    as soon as it is simulated, so that memory does not grow with the number of steps
+
+    Arguments as in runSimulation, and
+    t - the number of time iterations, None to go on until the consumer stops
+    snapshot - also yield the state codes (int8, see STATE_CODES) and the
+        positions (float32, inf while quarantined) of all people (defaults to False)
+
+    Yields:
+        Dictionaries {'day', 'S', 'I', 'R'} (and 'states', 'positions'), from
+        the initial counts at day 0. The random numbers are drawn as in
+        runSimulation, so both give the same counts for the same seed.
+    """
+    from scipy.spatial import KDTree
+    if profiler is None:
+        profiler = NULL_PROFILER
+    profiler.begin('variation_2.runSimulation', k=k, q=q, p=p, n=n, t=t, s=s, a=a, L=L,
+                   position=position, num_initial_infected=num_initial_infected, backend=backend)
+
+    if backend is not None:
+        try:
+            yield from iter_array_runSimulation(k, q, n, t, s, a, L, position, num_initial_infected,
+                                                get_backend(backend), profiler, snapshot)
+        finally:
+            profiler.end()
+        return
+
     # Create a population
     pop = [varPerson(p, s, a, L) for i in range(n)] 
 
@@ -100,89 +148,163 @@ def runSimulation(k, q, p=0.03, n=1000, t=100, s=0.5, a=0.4, L=30, position='Ran
         for i in range(num_initial_infected):
             pop[i].change_state()
 
-    # Initialize number of S, I and R people in population
-    S = [returnCounts(pop, 'S')]
-    I = [returnCounts(pop, 'I')]
-    R = [returnCounts(pop, 'R')]
+    # Keep the number of S, I and R people and the infected people up to date as states change
+    pop_state = PopulationState(pop, ('S', 'I', 'R'))
+
+    def day_row(day):
+        row = {'day': day, 'S': pop_state.count('S'), 'I': pop_state.count('I'), 'R': pop_state.count('R')}
+        if snapshot:
+            row['states'] = np.array([STATE_CODES[person.state] for person in pop], dtype=np.int8)
+            row['positions'] = np.array([person.pos for person in pop], dtype=np.float32)
+        return row
 
     # Check if each individual is social distancing then check if they're also quarantining
-    for p in pop:
-        p.isSocialDist()
+    for person in pop:
+        person.isSocialDist()
         # If someone is not social distancing then it's unlikely they're following lockdown protocols either
-        if p.SD is True:  
-            p.isQuarantined()
+        if person.SD is True:  
+            person.isQuarantined()
 
-    # Start simulation over time t
-    for t in range(t):
-        
-        # Lockdown is for the first self.L days of simulation then lockdown is over
-        if t <= p.L:
-            lockdown = True
-        else:
-            lockdown = False
-            
-        position = []
-        counts = []
-        counter = 0
-        
-        # During lockdown, people who are quarantined get moved away from the rest of the population
-        # While others move around in random directions
-        if lockdown == True:
-        
-            for p in pop:
-                if p.Q is False: # Not quarantined
-                    p.move()
-                    position.append(p.pos)
-                    counter +=1
+    try:
+        # Initial number of S, I and R people in population
+        yield day_row(0)
+
+        # Start simulation over time t
+        step = 0
+        while t is None or step < t:
+
+            # Lockdown is for the first L days of simulation then lockdown is over
+            if step <= L:
+                lockdown = True
+            else:
+                lockdown = False
                 
-                else:
-                    p.moveToQuarantine() # Move to isolation (denoted by infinity)
-                    position.append(p.pos)
-                    counts.append(counter)
-                    counter +=1
+            position = []
             
-            # Remove quarantined people from the list of people's locations then form a KDTree
-            position = [i for j, i in enumerate(position) if j not in counts] 
-            tree = KDTree(position)
-        
-        # When lockdown is over, quarantined people go back to their old positions and everyone starts moving randomly
-        else:
+            # During lockdown, people who are quarantined get moved away from the rest of the population
+            # While others move around in random directions
+            if lockdown == True:
             
-            for p in pop:
+                with profiler.phase('move'):
+                    for person in pop:
+                        if person.Q is False: # Not quarantined
+                            person.move()
+                        else:
+                            person.moveToQuarantine() # Move to isolation (denoted by infinity)
+                        position.append(person.pos)
                 
-                if p.oldpos is not None:
-                    p.pos = p.oldpos
-                    
-                p.move()
-                position.append(p.pos)
-                
-            tree = KDTree(position)
-        
-        for i in range(n):
+                # Leave quarantined people out of the KDTree; free maps its indices back to people
+                with profiler.phase('index'):
+                    free = np.array([j for j, person in enumerate(pop) if person.Q is False], dtype=np.intp)
+                    tree = KDTree([position[j] for j in free])
             
-            if pop[i].state == 'I': 
+            # When lockdown is over, quarantined people go back to their old positions and everyone starts moving randomly
+            else:
                 
-                if pop[i].Q is True: # If infected person is quarantined, they don't infect anyone else
-                    pass
-                elif pop[i].SD is True:  # If infected person is social distancing, they don't infect anyone else
-                    pass
-                else:
-                    inds = tree.query_ball_point(position[i], q)
-                    for ind in inds:
-                        if pop[ind].state == 'S':
+                with profiler.phase('move'):
+                    for person in pop:
+                        
+                        if person.oldpos is not None:
+                            person.pos = person.oldpos
+                            person.oldpos = None
                             
-                            if pop[ind].SD is True: # If the neighbor of the infected person is social distancing then they aren't infected
-                                pass
-                            else:
-                                pop[ind].change_state()
-                
-                # Infected person recovers with probability k
-                if np.random.rand() < k:
-                    pop[i].change_state()
-   
+                        person.move()
+                        position.append(person.pos)
+                    
+                with profiler.phase('index'):
+                    free = None
+                    tree = KDTree(position)
+            
+            # Neighbour queries, infections and recoveries are interleaved per agent
+            # Only the infected people are visited, in the order of a loop over everyone
+            with profiler.phase('infection'):
+                for i in pop_state.scan('I'):
                     
-        S.append(returnCounts(pop, 'S'))
-        I.append(returnCounts(pop, 'I'))
-        R.append(returnCounts(pop, 'R'))
+                    if pop[i].Q is True: # If infected person is quarantined, they don't infect anyone else
+                        pass
+                    elif pop[i].SD is True:  # If infected person is social distancing, they don't infect anyone else
+                        pass
+                    else:
+                        inds = tree.query_ball_point(position[i], q)
+                        if free is not None:
+                            inds = free[inds]
+                        for ind in inds:
+                            if pop[ind].state == 'S':
+                                
+                                if pop[ind].SD is True: # If the neighbor of the infected person is social distancing then they aren't infected
+                                    pass
+                                else:
+                                    pop_state.set_state(ind, 'I')
+                    
+                    # Infected person recovers with probability k
+                    if np.random.rand() < k:
+                        pop_state.set_state(i, 'R')
 
-    return S, I, R
+            step += 1
+            with profiler.phase('counting'):
+                row = day_row(step)
+            profiler.end_step(step, S=row['S'], I=row['I'], R=row['R'])
+            yield row
+    finally:
+        profiler.end()
+
+
+def iter_array_runSimulation(k, q, n, t, s, a, L, position, num_initial_infected, backend, profiler,
+                             snapshot=False):
+    """
+    iter_runSimulation on arrays of positions and states with the kernels of
+    backend (see sir.backend). Quarantined people stay put during lockdown,
+    and social distancing people neither infect nor get infected. The random
+    numbers are drawn in the same order as the varPerson objects draw them,
+    so both paths agree for the same seed.
+    Input:
+        backend: object returned by sir.backend.get_backend
+        Other arguments as in iter_runSimulation
+    """
+    pos, states = initial_agents(n, position, num_initial_infected)
+    counts = np.bincount(states, minlength=3)
+
+    # Every person draws whether they are social distancing, then if so whether they quarantine
+    distancing = np.zeros(n, dtype=bool)
+    quarantined = np.zeros(n, dtype=bool)
+    for j in range(n):
+        distancing[j] = np.random.rand() <= s
+        if distancing[j]:
+            quarantined[j] = np.random.rand() <= a
+    contacts = ~distancing
+
+    def day_row(day, lockdown):
+        row = {'day': day, 'S': int(counts[0]), 'I': int(counts[1]), 'R': int(counts[2])}
+        if snapshot:
+            row['states'] = states.copy()
+            row['positions'] = pos.astype(np.float32)
+            if lockdown:
+                row['positions'][quarantined] = np.inf
+        return row
+
+    yield day_row(0, False)
+
+    step = 0
+    while t is None or step < t:
+        # Lockdown is for the first L days of simulation then lockdown is over
+        lockdown = step <= L
+        moving = ~quarantined if lockdown else np.ones(n, dtype=bool)
+
+        with profiler.phase('move'):
+            directions = np.zeros((n, 2))
+            draws = np.random.randn(np.count_nonzero(moving), 2)
+            directions[moving] = draws / np.linalg.norm(draws, axis=1)[:, None]
+            # varPerson takes steps of 0.01 whatever p is
+            backend.move(pos, directions, 0.01, False, moving)
+
+        with profiler.phase('infection'):
+            new_infected, infected = backend.infect_sequential(pos, states, q, False, contacts)
+        with profiler.phase('recovery'):
+            recovered = backend.recover(states, infected, np.random.rand(len(infected)), k)
+
+        step += 1
+        with profiler.phase('counting'):
+            counts += [-len(new_infected), len(new_infected) - len(recovered), len(recovered)]
+            row = day_row(step, lockdown)
+        profiler.end_step(step, S=row['S'], I=row['I'], R=row['R'])
+        yield row
@@ -1,5 +1,8 @@
 import numpy as np
 
+from sir.population import PopulationState
+from sir.profiling import NULL_PROFILER
+
 
 class Person:
     """
@@ -26,14 +29,26 @@ class Person:
         self.state = newState
 
 
-def simulateInteractions(people, b, a, c):
+def simulateInteractions(people, b, a, c, population=None):
     """
     This function loops through each person in people.
     If the person has state I_A (infected, asymptomatic),
     then they will have interactions using the helper
     function simulate_asymptomatic. If the person has state I_S
     they will have interactions using the helper function I_S
+
+    If population (a sir.population.PopulationState) is given, only the
+    infected people are visited, in the same order as the loop over everyone,
+    and state changes go through it, so that the counts stay up to date
     """
+    if population is not None:
+        for i in population.scan("I_A", "I_S"):
+            if people[i].state == "I_A":
+                simulate_asymptomatic(people, a, b, i, population)
+            else:
+                simulate_symptomatic(people, c, b, i, population)
+        return
+
     for i in range(people.size):  # Loop through each person in  people
         person = people[i]
         index = i
@@ -48,7 +63,7 @@ def simulateInteractions(people, b, a, c):
             simulate_symptomatic(people, c, b, index)
 
 
-def simulate_asymptomatic(people, a, b, i):
+def simulate_asymptomatic(people, a, b, i, population=None):
     """
     This function simulates interactions for
     people who are asymptomatic. If they interact
@@ -56,13 +71,14 @@ def simulate_asymptomatic(people, a, b, i):
     will possibly become infected (prob = a). If that person
     becomes infected, there is a 50% chance they will be asymptomatic
     or
+    State changes go through population if it is given
     """
 
     d = 1-a  # Probability that interaction
 
     for num in range(b):
 
-        I2 = np.random.choice(np.arange(0, people.size - 1))  # Generate a random index
+        I2 = np.random.randint(0, people.size - 1)  # Generate a random index
         secondperson = people[I2]  # index of second person in interaction
 
         # If that randomly selected index is the same as the current
@@ -78,22 +94,26 @@ def simulate_asymptomatic(people, a, b, i):
 
             if is_infected == 'yes':
                 symptom_query = np.random.choice(['I_S', 'I_A'])  # Determine if new infected is asymptomatic
-                secondperson.changeState(symptom_query)
+                if population is not None:
+                    population.set_state(I2, symptom_query)
+                else:
+                    secondperson.changeState(symptom_query)
 
 
 
-def simulate_symptomatic(people, c, b, i):
+def simulate_symptomatic(people, c, b, i, population=None):
     """
     This function simulates interactions for the
     infected that are asymptomatic. If person i has b interacts
     with a person in people who with state S, then that person
     will possibly become infected (prob = c)
+    State changes go through population if it is given
     """
     f = 1-c
 
     for num in range(b):
 
-        I2 = np.random.choice(np.arange(0, people.size - 1))  # Generate a random index
+        I2 = np.random.randint(0, people.size - 1)  # Generate a random index
         secondperson = people[I2]  # index of second person in interaction
 
         # If that randomly selected index is the same as the current
@@ -109,14 +129,26 @@ def simulate_symptomatic(people, c, b, i):
 
             else:
                 symptom_query = np.random.choice(['I_A', 'I_S'])  # Determine if new infected is asymptomatic
-                secondperson.changeState(symptom_query)  # Second
+                if population is not None:
+                    population.set_state(I2, symptom_query)
+                else:
+                    secondperson.changeState(symptom_query)  # Second
 
 
-def simulateRecoveries(people, k):
+def simulateRecoveries(people, k, population=None):
     """
     This function changes the state of a fraction k
     of people with state I to state R
+
+    If population (a sir.population.PopulationState) is given, only the
+    infected people are visited and state changes go through it
     """
+    if population is not None:
+        for i in population.members("I_A", "I_S"):
+            if np.random.random() <= k:
+                population.set_state(i, "R")
+        return
+
     for person in people:
 
         # If a person is infected
@@ -141,7 +173,7 @@ def returnCounts(people, state):
     return num
 
 
-def simulateSIR(n, b, k, a, c, t):
+def simulateSIR(n, b, k, a, c, t, profiler=None):
     """
     Driver code for the discrete simulation.
     Uses simulaterecoveries and simulateinteractions to model
@@ -151,7 +183,12 @@ def simulateSIR(n, b, k, a, c, t):
     b is the number of interactions for a single person
     k is the portion of infected individuals who are removed each day, as a decimal
     t is the number of days to simulate
+    profiler is an optional sir.profiling.Profiler that receives per day timings
     """
+    if profiler is None:
+        profiler = NULL_PROFILER
+    profiler.begin('varsim_tori.simulateSIR', n=n, b=b, k=k, a=a, c=c, t=t)
+
     people = np.zeros(n, dtype=Person)  # Create a matrix of people with their state
 
     for i in range(n):
@@ -163,24 +200,26 @@ def simulateSIR(n, b, k, a, c, t):
     I_S = np.zeros(t)
     R = np.zeros(t)
 
+    # Keep the counts and the infected people up to date as states change
+    population = PopulationState(people, ("S", "I_A", "I_S", "R"))
+
     # Create patient zero, the first person that is infected
-    patient0 = people[0]
-    patient0.changeState("I_A")
-    people[0] = patient0
+    population.set_state(0, "I_A")
 
     # Collect the counts of each state for each day
     for day in range(t):
-        if day == 0:
-            S[day] = returnCounts(people, "S")
-            I_A[day] = returnCounts(people, "I_A")
-            I_S[day] = returnCounts(people, "I_S")
-            R[day] = returnCounts(people, "R")
-        else:
-            simulateInteractions(people, b, a, c)
-            simulateRecoveries(people, k)
-            S[day] = returnCounts(people, "S")
-            I_A[day] = returnCounts(people, "I_A")
-            I_S[day] = returnCounts(people, "I_S")
-            R[day] = returnCounts(people, "R")
+        if day > 0:
+            with profiler.phase('infection'):
+                simulateInteractions(people, b, a, c, population)
+            with profiler.phase('recovery'):
+                simulateRecoveries(people, k, population)
+        with profiler.phase('counting'):
+            S[day] = population.count("S")
+            I_A[day] = population.count("I_A")
+            I_S[day] = population.count("I_S")
+            R[day] = population.count("R")
+        profiler.end_step(day, S=S[day], I_A=I_A[day], I_S=I_S[day], R=R[day])
+
+    profiler.end()
 
     return S, I_A, I_S, R
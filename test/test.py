@@ -1,8 +1,45 @@
+import os
+import sys
+import json
+import tempfile
+import asyncio
+import itertools
+import subprocess
 import unittest
+from unittest import mock
 import numpy as np
 
 from sir.odeSim import odeSim
 from sir.discreteSim import simulateSIR
+from sir.discreteSim_spatial import Person, discrete_spatial_simulation, infect_synchronous, STATE_CODES
+from sir.odeSim_spatial import odeSim_spatial, laplacian, laplacian_eigenvalues
+from sir import profiling
+from sir.profiling import Profiler, import_times
+from sir.population import PopulationState
+from sir import discreteSim, varsim_tori
+from sir.cache import ResultCache
+from sir.engines import get_engine, run_engine
+from sir.phase_diagram import phase_diagram_discrete
+from sir.fitting import fit_odeSim, simulate_sensitivities
+from sir.covid_data import country_series, sir_fractions, CovidStore
+from sir.metapopulation import metapopSim, multinomial_rows
+from sir.network import Graph, barabasi_albert, erdos_renyi, network_simulation, spatial_graph, watts_strogatz
+from sir.backend import HAVE_NUMBA, get_backend
+from sir import domain
+from sir.transport import SharedArrays, run_engine_sweep
+from sir.initial_conditions import SEED_LEVEL, initial_state
+from sir.coupling import bin_agents, field_diagnostics, hybrid_simulation, sample_population
+from sir.cli import load_results, main as cli_main, plan_manifest
+from sir.checkpoint import solve_pdes_checkpointed, spatial_simulation_checkpointed
+from sir.service import SimulationService, default_service, run_async
+from sir.discreteSim import iter_simulateSIR
+from sir.discreteSim_spatial import iter_discrete_spatial_simulation
+from sir.variation_2 import iter_runSimulation, runSimulation
+from sir.sensitivity import evaluate, integer_flags, morris_analysis, saltelli_sample, sobol_analysis
+from sir.emulator import Emulator, GaussianProcess
+from sir.inference import abc_smc, bootstrap_filter, particle_log_likelihood, simulate_counts
+
+COVID_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'script', 'covid-data')
 
 '''
 Ref:
@@ -130,6 +167,15 @@ class TestDiscreteSim(unittest.TestCase):
                 sir_sum = s[t]+i[t]+r[t]
                 self.assertAlmostEqual(sir_sum, n, msg=f'sum of sir = {sir_sum} is not {n} when t = {t}')
 
+    def testDiscrete_extinct(self):
+        '''
+        Test that stopping at extinction keeps the final counts for the remaining days
+        '''
+        n = 100
+        s, i, r = simulateSIR(n, 1, 0.9, 100, stop_when_extinct=True)
+        self.assertEqual(i[-1], 0)
+        self.assertTrue(np.all(s + i + r == n))
+
     def testDiscrete_t(self):
         '''
         Test t: the amount of time we want to run the simulation for     
@@ -142,4 +188,1146 @@ class TestDiscreteSim(unittest.TestCase):
             s, i, r = simulateSIR(n, int(n*b), k, t) # 
             for t in range(len(s)):
                 sir_sum = s[t]+i[t]+r[t]
-                self.assertAlmostEqual(sir_sum, n, msg=f'sum of sir = {sir_sum} is not {n} when t = {t}')
\ No newline at end of file
+                self.assertAlmostEqual(sir_sum, n, msg=f'sum of sir = {sir_sum} is not {n} when t = {t}')
+
+
+class TestPeriodic(unittest.TestCase):
+    '''
+    Test the periodic (toroidal) boundary mode of the spatial simulations
+    '''
+    def test_periodic_move(self):
+        '''
+        Test that agents on a torus always move and stay inside [0, 1)
+        '''
+        person = Person(0.3, periodic=True)
+        for step in range(100):
+            old = np.array(person.pos)
+            person.move()
+            self.assertTrue(np.all((np.array(person.pos) >= 0) & (np.array(person.pos) < 1)))
+            self.assertFalse(np.allclose(old, person.pos))
+
+    def test_periodic_spatial_simulation(self):
+        '''
+        Test that the periodic agent simulation conserves the population
+        '''
+        n = 200
+        S, I, R = discrete_spatial_simulation(0.1, 0.05, 0.3, n, 20, position='Corner', periodic=True)
+        for t in range(len(S)):
+            self.assertEqual(S[t] + I[t] + R[t], n)
+
+    def test_fft_laplacian(self):
+        '''
+        Test that the FFT eigenvalues diagonalize the periodic laplacian
+        '''
+        M = 16
+        u = np.random.rand(M, M)
+        Lu = laplacian(M, periodic=True) @ u.flatten()
+        Lu_fft = np.real(np.fft.ifft2(laplacian_eigenvalues(M) * np.fft.fft2(u)))
+        self.assertTrue(np.allclose(Lu, Lu_fft.flatten()))
+
+    def test_solve_pdes_fft(self):
+        '''
+        Test that the split step FFT solver agrees with solve_ivp on a torus
+        '''
+        model = odeSim_spatial(b=3, k=0.1, t=40, M=20, initial_position='center', periodic=True)
+        np.random.seed(1)
+        time, s, i, r = model.solve_pdes()
+        np.random.seed(1)
+        time_fft, s_fft, i_fft, r_fft = model.solve_pdes_fft(dt=0.1)
+        self.assertTrue(np.allclose(s + i + r, 1))
+        self.assertTrue(np.allclose(i, i_fft, atol=1e-3))
+
+
+class TestContactKernel(unittest.TestCase):
+    '''
+    Test the synchronous pair enumeration infection kernel
+    '''
+    def test_synchronous_chain(self):
+        '''
+        Test that agents infected during a step do not infect others in the same step
+        '''
+        positions = np.array([[0.1, 0.5], [0.15, 0.5], [0.2, 0.5], [0.9, 0.9]])
+        states = np.array([STATE_CODES['I'], STATE_CODES['S'], STATE_CODES['S'], STATE_CODES['S']])
+        new_infected, recovered = infect_synchronous(positions, states, q=0.06, k=0)
+        self.assertEqual(list(new_infected), [1])
+        self.assertEqual(len(recovered), 0)
+        self.assertEqual(list(states), [1, 1, 0, 0])
+
+    def test_sequential_mode(self):
+        '''
+        Test that both infection modes conserve the population
+        '''
+        n = 200
+        for sequential in [False, True]:
+            S, I, R = discrete_spatial_simulation(0.1, 0.05, 0.1, n, 20, position='Center', sequential=sequential)
+            for t in range(len(S)):
+                self.assertEqual(S[t] + I[t] + R[t], n)
+
+
+class TestProfiling(unittest.TestCase):
+    '''
+    Test the instrumentation hooks of the simulation engines
+    '''
+    def test_agent_profile(self):
+        '''
+        Test that an agent engine reports one record per step and a run summary
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'profile.jsonl')
+            profiler = Profiler(path=path)
+            S, I, R = discrete_spatial_simulation(0.1, 0.05, 0.1, 100, 10, profiler=profiler)
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+
+        steps = [rec for rec in records if rec['record'] == 'step']
+        self.assertEqual(len(steps), 10)
+        self.assertEqual(steps[-1]['counts'], {'S': S[-1], 'I': I[-1], 'R': R[-1]})
+        summary = records[-1]
+        self.assertEqual(summary['record'], 'run')
+        for phase in ['move', 'index', 'counting']:
+            self.assertIn(phase, summary['phases'])
+
+    def test_ode_profile(self):
+        '''
+        Test that the ODE solver reports right hand side calls and step sizes
+        '''
+        profiler = Profiler()
+        sol = odeSim(100, 0.5, 1/3, 100).solve_odes(profiler=profiler)
+        summary = profiler.summary()
+        self.assertEqual(summary['rhs_calls'], sol.nfev)
+        self.assertGreater(summary['n_steps'], 0)
+
+    @unittest.skipIf(profiling.resource is None, 'resource is not available')
+    def test_peak_rss(self):
+        '''
+        Test that the peak RSS is reported in kilobytes on Linux and on macOS
+        '''
+        usage = mock.Mock(ru_maxrss=2048 * 1024)
+        with mock.patch.object(profiling.resource, 'getrusage', return_value=usage):
+            with mock.patch.object(profiling.sys, 'platform', 'darwin'):
+                self.assertEqual(profiling.peak_rss(), 2048)
+            with mock.patch.object(profiling.sys, 'platform', 'linux'):
+                self.assertEqual(profiling.peak_rss(), 2048 * 1024)
+
+
+class TestPopulationState(unittest.TestCase):
+    '''
+    Test the incremental compartment counters
+    '''
+    def test_counts(self):
+        '''
+        Test that the counters and the infected index follow the transitions
+        '''
+        people = np.array([discreteSim.Person() for i in range(10)])
+        population = PopulationState(people)
+        population.set_state(3, 'I')
+        population.set_state(5, 'I')
+        population.set_state(3, 'R')
+        population.set_state(5, 'I')
+        self.assertEqual(population.counts, {'S': 8, 'I': 1, 'R': 1})
+        self.assertEqual(population.members('I'), [5])
+        for state in ['S', 'I', 'R']:
+            self.assertEqual(population.count(state), discreteSim.returnCounts(people, state))
+
+    def test_scan(self):
+        '''
+        Test that a scan visits the agents infected ahead of it and skips those that leave the state
+        '''
+        people = np.array([discreteSim.Person() for i in range(10)])
+        population = PopulationState(people)
+        population.set_state(2, 'I')
+        population.set_state(6, 'I')
+        visited = []
+        for i in population.scan('I'):
+            visited.append(i)
+            if i == 2:
+                population.set_state(8, 'I')
+                population.set_state(1, 'I')
+                population.set_state(6, 'R')
+        self.assertEqual(visited, [2, 8])
+
+    def test_same_dynamics(self):
+        '''
+        Test that the counters give the same days as the loops over everyone for the same seed
+        '''
+        for seed in range(3):
+            np.random.seed(seed)
+            S, I, R = simulateSIR(300, 2, 0.3, 20)
+            np.random.seed(seed)
+            people = np.array([discreteSim.Person() for i in range(300)])
+            people[0].changeState('I')
+            for day in range(1, 20):
+                discreteSim.simulateInteractions(people, 2)
+                discreteSim.simulateRecoveries(people, 0.3)
+                self.assertEqual(I[day], discreteSim.returnCounts(people, 'I'))
+                self.assertEqual(R[day], discreteSim.returnCounts(people, 'R'))
+
+    def test_asymptomatic_counts(self):
+        '''
+        Test that the varsim_tori counts conserve the population
+        '''
+        n = 200
+        S, I_A, I_S, R = varsim_tori.simulateSIR(n, 3, 0.1, 0.5, 0.5, 30)
+        self.assertTrue(np.all(S + I_A + I_S + R == n))
+
+
+class TestResultCache(unittest.TestCase):
+    '''
+    Test the content addressed result cache
+    '''
+    def test_cache_hit(self):
+        '''
+        Test that a seeded run is computed once and then served from the cache
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ResultCache(tmp)
+            first = run_engine('discreteSim', {'n': 100, 'b': 2, 'k': 0.3, 't': 20}, seed=1, cache=cache)
+            # Defaults and argument order do not change the address of a run
+            second = cache.wrap('discreteSim')(100, 2, 0.3, 20, seed=1)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertTrue(np.array_equal(first['S'], second[0]))
+
+            # A new cache on the same directory reads the disk tier
+            disk = ResultCache(tmp)
+            third = run_engine('discreteSim', {'n': 100, 'b': 2, 'k': 0.3, 't': 20}, seed=1, cache=disk)
+            self.assertEqual(disk.hits, 1)
+            self.assertTrue(np.array_equal(first['I'], third['I']))
+
+    def test_unseeded_runs_bypass_cache(self):
+        '''
+        Test that stochastic runs without a seed are never cached
+        '''
+        cache = ResultCache(None)
+        for i in range(2):
+            run_engine('discreteSim', {'n': 50, 'b': 2, 'k': 0.3, 't': 5}, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+    def test_eviction(self):
+        '''
+        Test that the disk tier stays below its size bound
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ResultCache(tmp, max_bytes=2000, memory_items=1)
+            for t in range(10, 30):
+                run_engine('odeSim', {'n': 100, 't': t}, cache=cache)
+            total = sum(entry.stat().st_size for entry in os.scandir(tmp))
+            self.assertLessEqual(total, 2000)
+
+    def test_disk_only(self):
+        '''
+        Test a cache without a memory tier
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ResultCache(tmp, memory_items=0)
+            first = cache.run(get_engine('odeSim'), {'n': 100, 't': 20})
+            second = cache.run(get_engine('odeSim'), {'n': 100, 't': 20})
+            self.assertEqual((cache.hits, cache.misses, len(cache.memory)), (1, 1, 0))
+            self.assertTrue(np.array_equal(first['i'], second['i']))
+
+
+class TestPhaseDiagram(unittest.TestCase):
+    '''
+    Test the phase diagram generator of the discrete model
+    '''
+    def test_refinement(self):
+        '''
+        Test that refinement adds k values and that the maps are in range
+        '''
+        k_values = [1, 0.55, 0.1]
+        diagram = phase_diagram_discrete([1, 3], k_values, n=200, t=100, replicates=2, workers=1, refine=1, seed=0)
+        self.assertGreater(len(diagram.k), len(k_values))
+        self.assertEqual(diagram.mean.shape, (len(diagram.k), 2))
+        filled = diagram.filled()
+        self.assertFalse(np.any(np.isnan(filled)))
+        self.assertTrue(np.all((filled >= 0) & (filled <= 1)))
+        self.assertTrue(np.all(diagram.var[~np.isnan(diagram.var)] >= 0))
+
+    def test_invalid_grid(self):
+        '''
+        Test that non-integer b and non-positive k are rejected before anything is run
+        '''
+        with self.assertRaises(ValueError):
+            phase_diagram_discrete([1, 2.5], [0.5], workers=1)
+        with self.assertRaises(ValueError):
+            phase_diagram_discrete([1, 3], [0.5, 0], workers=1, refine=1)
+        diagram = phase_diagram_discrete([2.0], [0.5], n=50, t=10, replicates=1, workers=1, seed=0)
+        self.assertEqual(diagram.b.dtype.kind, 'i')
+
+
+class TestFitting(unittest.TestCase):
+    '''
+    Test the calibration of the mean-field ODE model
+    '''
+    def test_recover_parameters(self):
+        '''
+        Test that b(t) and k are recovered from curves generated by the model
+        '''
+        b = np.array([[0.6, 0.3], [0.4, 0.2]])
+        k = np.array([0.2, 0.1])
+        y0 = np.tile([0.999, 0.001, 0], (2, 1))
+        y, sens = simulate_sensitivities(b, k, y0, 80, knots=[40])
+        fit = fit_odeSim(y[:, :, 1], y[:, :, 2], knots=[40], starts=4, seed=0)
+        self.assertTrue(np.allclose(fit.b, b, rtol=1e-3))
+        self.assertTrue(np.allclose(fit.k, k, rtol=1e-3))
+        s, i, r = fit.predict(80)
+        self.assertTrue(np.allclose(i, y[:, :, 1], atol=1e-6))
+
+        i_obs = y[:, :, 1].copy()
+        i_obs[0, 10] = np.nan
+        fit = fit_odeSim(i_obs, y[:, :, 2], knots=[40], starts=4, seed=0)
+        self.assertTrue(np.allclose(fit.b, b, rtol=1e-3))
+        i_obs[1, 0] = np.nan
+        with self.assertRaises(ValueError):
+            fit_odeSim(i_obs, y[:, :, 2], knots=[40], starts=4, seed=0)
+
+    def test_ode_agreement(self):
+        '''
+        Test that the sensitivity integrator agrees with odeSim
+        '''
+        sol = odeSim(100, 0.5, 1/3, 100).solve_odes()
+        y, sens = simulate_sensitivities([[0.5]], [1/3], [[0.999, 0.001, 0]], 101)
+        self.assertTrue(np.allclose(np.interp(np.arange(101), sol.t, sol.y[1]), y[0, :, 1], atol=1e-3))
+
+    def test_covid_series(self):
+        '''
+        Test that a cached country series matches the CSV files
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            series = country_series(COVID_DATA, 'Portugal', cache_dir=tmp)
+            cached = country_series(COVID_DATA, 'Portugal', cache_dir=tmp)
+        self.assertTrue(np.array_equal(series['confirmed'], cached['confirmed']))
+        self.assertEqual(len(series['dates']), len(series['deaths']))
+        s, i, r = sir_fractions(series, 10.3e6)
+        self.assertTrue(np.allclose(s + i + r, 1))
+
+    def test_covid_store(self):
+        '''
+        Test that the columnar store matches the per country CSV cleaning
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            store = CovidStore.build(COVID_DATA, os.path.join(tmp, 'store'))
+            for country in ['Canada', 'Portugal']:
+                series = country_series(COVID_DATA, country)
+                stored = store.series(country)
+                for name in ['confirmed', 'deaths', 'recovered']:
+                    self.assertTrue(np.array_equal(series[name], stored[name]))
+
+            S, I, R = store.sir_series('Portugal', 10.3e6, '1/22/20', '3/25/21')
+            self.assertEqual(len(S), 429)
+            populations = np.full(len(store.countries), 10.3e6)
+            S_all, I_all, R_all = store.sir_all(populations, '1/22/20', '3/25/21')
+            self.assertTrue(np.array_equal(S_all[store.index['Portugal']], S))
+
+
+class TestMetapopulation(unittest.TestCase):
+    '''
+    Test the metapopulation model of patches coupled by mobility
+    '''
+    def test_single_patch(self):
+        '''
+        Test that one isolated patch reproduces odeSim
+        '''
+        sim = metapopSim([1.0], [[0.0]], b=0.5, k=1/3, t=100)
+        t, S, I, R = sim.solve()
+        sol = odeSim(100, 0.5, 1/3, 100).solve_odes()
+        self.assertTrue(np.allclose(np.interp(t, sol.t, sol.y[1]), I[0], atol=1e-3))
+
+    def test_conservation(self):
+        '''
+        Test that both modes conserve the total population and that the infection spreads between patches
+        '''
+        K = 50
+        rows = np.arange(K)
+        mobility = np.zeros((K, K))
+        mobility[rows, (rows + 1) % K] = 0.05
+        mobility[rows, (rows - 1) % K] = 0.05
+        sizes = np.full(K, 1000.0)
+
+        t, S, I, R = metapopSim(sizes, mobility, b=0.8, t=60).solve()
+        self.assertTrue(np.allclose(S + I + R, 1000, rtol=1e-4))
+        self.assertGreater(R[K // 2, -1], 0)
+
+        np.random.seed(1)
+        t, S, I, R = metapopSim(sizes, mobility, b=0.8, t=60, infected=np.eye(K)[0] * 10).simulate()
+        self.assertTrue(np.all((S + I + R).sum(axis=0) == K * 1000))
+        self.assertTrue(np.all(S >= 0) and np.all(I >= 0))
+
+    def test_step_size(self):
+        '''
+        Test that a step size that does not divide a day still simulates whole days
+        '''
+        peaks = {}
+        for dt in [0.4, 0.5]:
+            np.random.seed(2)
+            sim = metapopSim([1000.0], [[0.0]], b=0.5, k=1/3, t=80, infected=[10])
+            peaks[dt] = np.mean([np.argmax(sim.simulate(dt)[2][0]) for r in range(40)])
+        self.assertLess(abs(peaks[0.4] - peaks[0.5]), 2)
+
+    def test_multinomial_rows(self):
+        '''
+        Test that the row multinomials split every count exactly
+        '''
+        np.random.seed(0)
+        indptr = np.array([0, 3, 3, 5])
+        probs = np.array([0.2, 0.3, 0.5, 0.9, 0.1])
+        out = multinomial_rows(np.array([100, 0, 7]), indptr, probs)
+        self.assertEqual(out[:3].sum(), 100)
+        self.assertEqual(out[3:].sum(), 7)
+
+
+class TestNetwork(unittest.TestCase):
+    '''
+    Test the contact network engine and its graph generators
+    '''
+    def test_graphs(self):
+        '''
+        Test that the generators build symmetric graphs without self loops
+        '''
+        np.random.seed(0)
+        graph = Graph.from_edges(4, [0, 1, 1, 2, 3], [1, 0, 2, 2, 0])
+        self.assertEqual(graph.num_edges(), 3)
+        self.assertTrue(np.array_equal(graph.neighbours([0]), [1, 3]))
+
+        # int32 indices of a large graph, whose keys u * n + v overflow int32
+        graph = Graph.from_edges(100000, np.array([99999], dtype=np.int32), np.array([5], dtype=np.int32))
+        self.assertTrue(np.array_equal(graph.neighbours([99999]), [5]))
+        self.assertTrue(np.array_equal(graph.neighbours([5]), [99999]))
+
+        for graph in [erdos_renyi(1000, 6), watts_strogatz(1000, 6, 0.1), barabasi_albert(1000, 3),
+                      spatial_graph(np.random.rand(1000, 2), 0.05)]:
+            dense = np.zeros((graph.n, graph.n), dtype=bool)
+            dense[np.repeat(np.arange(graph.n), graph.degree()), graph.indices] = True
+            self.assertTrue(np.array_equal(dense, dense.T))
+            self.assertFalse(np.any(np.diag(dense)))
+        self.assertGreater(barabasi_albert(1000, 3).degree().max(), 30)
+
+    def test_ring(self):
+        '''
+        Test that certain transmission on a ring infects two new people per day
+        '''
+        np.random.seed(0)
+        S, I, R = network_simulation(watts_strogatz(101, 2, 0), 1, 0, 20)
+        self.assertTrue(np.array_equal(I, 2 * np.arange(20) + 1))
+        self.assertTrue(np.all(S + I + R == 101))
+
+
+class TestBackend(unittest.TestCase):
+    '''
+    Test the agent kernels of the array based spatial simulation
+    '''
+    def test_array_path(self):
+        '''
+        Test that the array path reproduces the synchronous and the sequential Person path for the same seed
+        '''
+        backends = ['numpy', 'numba'] if HAVE_NUMBA else ['numpy']
+        for periodic, sequential in itertools.product([False, True], [False, True]):
+            np.random.seed(3)
+            expected = discrete_spatial_simulation(0.1, 0.03, 0.02, 1000, 20, 'Corner', periodic=periodic,
+                                                   sequential=sequential)
+            for backend in backends:
+                np.random.seed(3)
+                result = discrete_spatial_simulation(0.1, 0.03, 0.02, 1000, 20, 'Corner', periodic=periodic,
+                                                     sequential=sequential, backend=backend)
+                self.assertEqual(result, expected)
+
+    def test_variation_2(self):
+        '''
+        Test that the array path of variation_2 reproduces the varPerson path, quarantine and snapshots included
+        '''
+        backends = ['numpy', 'numba'] if HAVE_NUMBA else ['numpy']
+        np.random.seed(4)
+        expected = list(iter_runSimulation(0.1, 0.04, n=600, t=25, L=10, snapshot=True))
+        self.assertTrue(np.isinf(expected[5]['positions']).any())
+        self.assertFalse(np.isinf(expected[15]['positions']).any())
+        for backend in backends:
+            np.random.seed(4)
+            result = list(iter_runSimulation(0.1, 0.04, n=600, t=25, L=10, snapshot=True, backend=backend))
+            for row, other in zip(result, expected):
+                self.assertEqual([row[c] for c in 'SIR'], [other[c] for c in 'SIR'])
+                self.assertTrue(np.array_equal(row['states'], other['states']))
+                self.assertTrue(np.array_equal(row['positions'], other['positions']))
+
+    @unittest.skipUnless(HAVE_NUMBA, 'numba is not installed')
+    def test_numba_kernels(self):
+        '''
+        Test that every Numba kernel agrees with the NumPy kernel for the same random numbers
+        '''
+        numpy_backend, numba_backend = get_backend('numpy'), get_backend('numba')
+        np.random.seed(0)
+        n = 2000
+        for periodic in [False, True]:
+            pos = np.random.rand(n, 2)
+            directions = np.random.randn(n, 2)
+            directions /= np.linalg.norm(directions, axis=1)[:, None]
+            moving = np.random.rand(n) < 0.5
+            expected, result = pos.copy(), pos.copy()
+            numpy_backend.move(expected, directions, 0.05, periodic, moving)
+            numba_backend.move(result, directions, 0.05, periodic, moving)
+            self.assertTrue(np.array_equal(result, expected))
+
+            for a, b in zip(numba_backend.cell_list(pos, 7), numpy_backend.cell_list(pos, 7)):
+                self.assertTrue(np.array_equal(a, b))
+
+            states = np.random.choice([0, 1, 2], size=n, p=[0.8, 0.1, 0.1]).astype(np.int8)
+            expected, result = states.copy(), states.copy()
+            self.assertTrue(np.array_equal(numba_backend.infect(pos, result, 0.03, periodic),
+                                           numpy_backend.infect(pos, expected, 0.03, periodic)))
+            self.assertTrue(np.array_equal(result, expected))
+
+            active = np.random.rand(n) < 0.7
+            expected, result = states.copy(), states.copy()
+            for a, b in zip(numba_backend.infect_sequential(pos, result, 0.03, periodic, active),
+                            numpy_backend.infect_sequential(pos, expected, 0.03, periodic, active)):
+                self.assertTrue(np.array_equal(a, b))
+            self.assertTrue(np.array_equal(result, expected))
+
+            infected = np.flatnonzero(states == 1)
+            draws = np.random.rand(len(infected))
+            expected, result = states.copy(), states.copy()
+            self.assertTrue(np.array_equal(numba_backend.recover(result, infected, draws, 0.3),
+                                           numpy_backend.recover(expected, infected, draws, 0.3)))
+            self.assertTrue(np.array_equal(result, expected))
+
+    def test_get_backend(self):
+        '''
+        Test the backend switch
+        '''
+        self.assertEqual(get_backend('auto').name, 'numba' if HAVE_NUMBA else 'numpy')
+        with self.assertRaises(ValueError):
+            get_backend('cuda')
+        if not HAVE_NUMBA:
+            with self.assertRaises(ImportError):
+                get_backend('numba')
+
+
+class TestDomainDecomposition(unittest.TestCase):
+    '''
+    Test the domain decomposed spatial simulation on worker processes
+    '''
+    def test_strips(self):
+        '''
+        Test that without movement and with certain recovery the strips reproduce the single process engine
+        '''
+        for periodic in [False, True]:
+            np.random.seed(3)
+            expected = discrete_spatial_simulation(1, 0.2, 0, 1000, 10, 'Corner', periodic=periodic, backend='numpy')
+            np.random.seed(3)
+            result = discrete_spatial_simulation(1, 0.2, 0, 1000, 10, 'Corner', periodic=periodic, workers=3)
+            self.assertEqual(result, expected)
+
+        np.random.seed(0)
+        S, I, R = discrete_spatial_simulation(0.1, 0.05, 0.02, 1000, 10, workers=2)
+        self.assertTrue(np.all(np.array(S) + I + R == 1000))
+
+    def test_failed_worker(self):
+        '''
+        Test that a worker that raises or is killed stops the run with an error instead of a hang
+        '''
+        halo_strips = domain.halo_strips
+
+        def failing(j, strips, q, periodic):
+            if j == 1:
+                raise ValueError('injected failure')
+            return halo_strips(j, strips, q, periodic)
+
+        def killed(j, strips, q, periodic):
+            if j == 1:
+                os._exit(9)
+            return halo_strips(j, strips, q, periodic)
+
+        for fault in [failing, killed]:
+            with mock.patch('sir.domain.halo_strips', fault):
+                with self.assertRaises(RuntimeError):
+                    domain.decomposed_simulation(0.1, 0.05, 0.02, 500, 5, workers=3, timeout=30)
+
+
+class TestTransport(unittest.TestCase):
+    '''
+    Test the shared memory transport of engine sweeps
+    '''
+    def test_engine_sweep(self):
+        '''
+        Test that the worker processes write the same results as serial runs
+        '''
+        params = [{'n': 500, 'b': 2, 'k': k, 't': 50} for k in [0.2, 0.4, 0.6]]
+        results = run_engine_sweep('discreteSim', params, seeds=[0, 1, 2], workers=2)
+        self.assertEqual(results['I'].shape, (3, 50))
+        for row in range(3):
+            expected = run_engine('discreteSim', params[row], seed=row)
+            self.assertTrue(np.array_equal(results['I'][row], expected['I']))
+
+    def test_shapes(self):
+        '''
+        Test that tasks with outputs of different shapes raise ValueError instead of a broadcast error
+        '''
+        params = [{'n': 500, 'b': 2, 'k': 0.3, 't': t} for t in [40, 50]]
+        with self.assertRaises(ValueError):
+            run_engine_sweep('discreteSim', params, workers=2)
+        with self.assertRaisesRegex(ValueError, 'shape'):
+            run_engine_sweep('discreteSim', params, reduce=lambda values: {'I': values['I']}, workers=1)
+        results = run_engine_sweep('discreteSim', params, reduce=lambda values: {'R': values['R'][-1]}, workers=1)
+        self.assertEqual(results['R'].shape, (2,))
+
+    def test_memmap(self):
+        '''
+        Test that memory mapped results stay on disk
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            results = run_engine_sweep('odeSim', [{'n': 100, 't': 50}], workers=1, path=tmp)
+            self.assertTrue(np.array_equal(np.load(os.path.join(tmp, 'i.npy')), results['i']))
+            results.close()
+
+            with SharedArrays({'x': ((4,), np.int64)}) as shared:
+                other = SharedArrays.attach(shared.spec)
+                other['x'][2] = 7
+                self.assertEqual(shared['x'][2], 7)
+                other.close()
+
+
+class TestAdaptive(unittest.TestCase):
+    '''
+    Test the PDE solver restricted to the active blocks of the grid
+    '''
+    def test_adaptive(self):
+        '''
+        Test that evolving only the active blocks matches the full solve
+        '''
+        np.random.seed(1)
+        full = odeSim_spatial(M=40, t=60, initial_position='corner').solve_pdes()
+        np.random.seed(1)
+        model = odeSim_spatial(M=40, t=60, initial_position='corner')
+        adaptive = model.solve_pdes_adaptive(block=8)
+        for a, b in zip(full[1:], adaptive[1:]):
+            self.assertTrue(np.allclose(a, b, atol=2e-3))
+
+        idx, blocks = model.active_cells(model.ics.reshape(3, -1), block=8)
+        self.assertLess(len(idx), 40 * 40 / 2)
+
+
+class TestInitialConditions(unittest.TestCase):
+    '''
+    Test the initial condition patterns of the PDE model
+    '''
+    def test_patterns(self):
+        '''
+        Test the seeding patterns of the initial state vector
+        '''
+        M = 50
+        np.random.seed(0)
+        y = initial_state(M, 'corner').reshape(3, M, M)
+        rows, cols = np.nonzero(y[1])
+        self.assertTrue(np.all(rows < M / 5) and np.all(cols < M / 5))
+        self.assertTrue(np.all(y[1][rows, cols] == SEED_LEVEL))
+        self.assertTrue(np.allclose(y.sum(axis=0), 1))
+
+        mask = np.zeros((M, M), dtype=bool)
+        mask[10, 20] = True
+        y = initial_state(M, mask).reshape(3, M, M)
+        self.assertEqual(y[1].sum(), SEED_LEVEL)
+
+        y = initial_state(M, 'gaussian').reshape(3, M, M)
+        self.assertEqual(np.unravel_index(np.argmax(y[1]), (M, M)), (24, 24))
+
+        positions = np.array([[0.01, 0.01], [0.015, 0.012], [0.99, 0.5]])
+        y = initial_state(M, positions, n=M * M * 4).reshape(3, M, M)
+        self.assertEqual(y[1][0, 0], 0.5)
+        self.assertEqual(y[1][49, 25], 0.25)
+
+    def test_solver_state(self):
+        '''
+        Test that the solvers start from the single initial state vector
+        '''
+        np.random.seed(0)
+        model = odeSim_spatial(M=20, t=5, initial_position='center')
+        model.solve_pdes()
+        np.random.seed(0)
+        s0, i0, r0 = model.initial_conditions()
+        self.assertTrue(np.array_equal(np.concatenate([s0, i0, r0]), model.ics))
+
+
+class TestCoupling(unittest.TestCase):
+    '''
+    Test the binning and sampling bridge between agents and PDE fields
+    '''
+    def test_binning(self):
+        '''
+        Test that binned agents have the compartment fractions as field means and that sampling inverts binning
+        '''
+        np.random.seed(0)
+        positions = np.random.rand(1000, 2)
+        states = np.random.randint(0, 3, 1000)
+        fields = bin_agents(positions, states, 10)
+        self.assertTrue(np.allclose(fields.reshape(3, -1).mean(axis=1), np.bincount(states) / 1000))
+
+        target = np.random.rand(3, 10, 10)
+        positions, states = sample_population(target, 400000)
+        sampled = bin_agents(positions, states, 10) * target.sum(axis=0).mean()
+        self.assertTrue(np.allclose(sampled, target, atol=0.1))
+        self.assertTrue(np.allclose(field_diagnostics(target)['centroid'], 0.5, atol=0.05))
+
+    def test_hybrid(self):
+        '''
+        Test that the hybrid run hands cells over to the PDE and back and conserves the population
+        '''
+        np.random.seed(0)
+        S, I, R, used = hybrid_simulation(0.2, 0.03, 0.02, 2000, 80, M=20)
+        self.assertEqual(used[0], 0)
+        # Only part of the grid is ever in the PDE region
+        self.assertTrue(0 < max(used) < 0.5)
+        self.assertEqual(used[-1], 0)
+        self.assertTrue(np.allclose(np.array(S) + I + R, 2000, rtol=1e-2))
+        self.assertGreater(R[-1], 1000)
+
+
+class TestImportTime(unittest.TestCase):
+    '''
+    Test the import time and lazy submodules of the package
+    '''
+    # Seconds that importing the package and the engine registry may take on top of numpy
+    BUDGET = 0.25
+
+    def test_lazy_import(self):
+        '''
+        Test that importing the package and the engine registry neither loads scipy nor exceeds the budget
+        '''
+        times = import_times(['sir', 'sir.engines'])
+        self.assertFalse([name for name in times if name.startswith(('scipy', 'pandas'))])
+        self.assertLess(times['sir.engines'], self.BUDGET)
+
+    def test_numba_deferred(self):
+        '''
+        Test that importing the engines only looks Numba up, using a stand-in numba module that fails on import
+        '''
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'numba.py'), 'w') as f:
+                f.write("raise ImportError('numba was imported')\n")
+            code = "import sys, sir.engines, sir.variation_2, sir.backend; print(sir.backend.HAVE_NUMBA, 'numba' in sys.modules)"
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join([directory, root]))
+            proc = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        self.assertEqual(proc.stdout.split(), ['True', 'False'])
+
+    def test_submodule_access(self):
+        '''
+        Test that submodules are imported on first attribute access
+        '''
+        import sir
+        self.assertIs(sir.odeSim_spatial.odeSim_spatial, odeSim_spatial)
+        self.assertIn('coupling', dir(sir))
+        with self.assertRaises(AttributeError):
+            sir.no_such_module
+
+
+class TestCli(unittest.TestCase):
+    '''
+    Test the command line runner of manifest sweeps
+    '''
+    def write_manifest(self, directory, runs):
+        path = os.path.join(directory, 'manifest.json')
+        with open(path, 'w') as f:
+            json.dump({'output': os.path.join(directory, 'results'), 'workers': 1, 'runs': runs}, f)
+        return path
+
+    def test_run_and_resume(self):
+        '''
+        Test that a manifest sweep writes a columnar store with one row per job and that a rerun skips finished jobs
+        '''
+        runs = [{'name': 'agents', 'engine': 'discreteSim', 'params': {'n': 200, 't': 20},
+                 'grid': {'b': [1, 2], 'k': [0.1, 0.3]}, 'replicates': 2, 'seed': 5},
+                {'engine': 'odeSim', 'params': {'n': 1000, 't': 30}, 'grid': {'b': [0.5, 1]}, 'replicates': 3}]
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_manifest(directory, runs)
+            self.assertEqual(cli_main(['run', path]), 0)
+
+            agents = load_results(os.path.join(directory, 'results', 'agents.npz'))
+            self.assertEqual(agents['S'].shape, (8, 20))
+            self.assertEqual(sorted(set(agents['seed'])), [5, 6])
+            row = np.flatnonzero((agents['params.b'] == 2) & (agents['params.k'] == 0.3) & (agents['seed'] == 6))[0]
+            np.random.seed(6)
+            self.assertTrue(np.array_equal(agents['I'][row], simulateSIR(200, 2, 0.3, 20)[1]))
+
+            # Deterministic engines run once per grid point
+            ode = load_results(os.path.join(directory, 'results', 'odeSim.npz'))
+            self.assertEqual(len(ode['key']), 2)
+            self.assertEqual(ode['run']['engine'], 'odeSim')
+
+            # Removing one job result reruns only that job
+            jobs = os.path.join(directory, 'results', 'agents', 'jobs')
+            os.remove(os.path.join(jobs, agents['key'][row] + '.npz'))
+            lines = []
+            from sir.cli import run_manifest
+            with open(path) as f:
+                run_manifest(json.load(f), log=lines.append)
+            self.assertIn('(7 already done)', lines[0])
+            again = load_results(os.path.join(directory, 'results', 'agents.npz'))
+            self.assertTrue(np.array_equal(again['I'], agents['I']))
+
+    def test_invalid_manifest(self):
+        '''
+        Test that unknown engines and parameters are reported before anything is run
+        '''
+        with self.assertRaises(KeyError):
+            plan_manifest({'runs': [{'engine': 'no_such_engine'}]})
+        with self.assertRaises(TypeError):
+            plan_manifest({'runs': [{'engine': 'discreteSim', 'params': {'n': 10, 'b': 1, 'k': 1, 't': 1, 'x': 1}}]})
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.write_manifest(directory, [{'engine': 'odeSim', 'grid': {'beta': [1]}}])
+            self.assertEqual(cli_main(['run', path]), 2)
+            self.assertFalse(os.path.exists(os.path.join(directory, 'results')))
+
+        # Runs without jobs
+        with self.assertRaisesRegex(ValueError, 'no values'):
+            plan_manifest({'runs': [{'engine': 'odeSim', 'grid': {'b': [0.5], 'k': []}}]})
+        with self.assertRaisesRegex(ValueError, 'no replicates'):
+            plan_manifest({'runs': [{'engine': 'discreteSim', 'params': {'n': 10, 'b': 1, 'k': 1, 't': 1},
+                                     'replicates': 0}]})
+
+        # Grid values that collect could only store as pickled objects
+        spatial = {'k': 0.1, 'q': 0.03, 'p': 0.02, 'n': 10, 't': 1}
+        with self.assertRaisesRegex(ValueError, 'mixes'):
+            plan_manifest({'runs': [{'engine': 'discreteSim_spatial', 'params': spatial,
+                                     'grid': {'backend': ['numpy', None]}}]})
+        ode = {'n': 10, 'k': 0.2, 't': 5}
+        with self.assertRaisesRegex(ValueError, 'mixes'):
+            plan_manifest({'runs': [{'engine': 'odeSim', 'params': ode, 'grid': {'b': [0.5, '1']}}]})
+        run, jobs = plan_manifest({'runs': [{'engine': 'odeSim', 'params': ode, 'grid': {'b': [1, 0.5]}}]})[0]
+        self.assertEqual(len(jobs), 2)
+
+
+class TestCheckpoint(unittest.TestCase):
+    '''
+    Test checkpointing and resuming of long runs
+    '''
+    def test_pdes_resume(self):
+        '''
+        Test that a PDE run interrupted twice and resumed is bit identical to an uninterrupted run
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            np.random.seed(3)
+            whole = solve_pdes_checkpointed(odeSim_spatial(M=20, t=40, initial_position='center'),
+                                            os.path.join(directory, 'whole.npz'), every=5)
+            np.random.seed(3)
+            expected = odeSim_spatial(M=20, t=40, initial_position='center').solve_pdes()
+            self.assertTrue(np.allclose(whole[2], expected[2], rtol=1e-12, atol=0))
+
+            filename = os.path.join(directory, 'parts.npz')
+            np.random.seed(3)
+            part = solve_pdes_checkpointed(odeSim_spatial(M=20, t=40, initial_position='center'), filename, stop=12)
+            self.assertLess(len(part[0]), 40)
+            # The random initial state comes from the snapshot, not from the generator
+            np.random.seed(7)
+            solve_pdes_checkpointed(odeSim_spatial(M=20, t=40, initial_position='center'), filename, stop=30)
+            resumed = solve_pdes_checkpointed(odeSim_spatial(M=20, t=40, initial_position='center'), filename)
+            for a, b in zip(whole, resumed):
+                self.assertTrue(np.array_equal(a, b))
+
+            with self.assertRaises(ValueError):
+                solve_pdes_checkpointed(odeSim_spatial(M=20, t=40, b=2), filename)
+
+    def test_agents_resume(self):
+        '''
+        Test that an agent run resumed from a snapshot matches discrete_spatial_simulation for the same seed
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'agents.npz')
+            np.random.seed(4)
+            expected = discrete_spatial_simulation(0.1, 0.03, 0.02, 2000, 30, backend='numpy')
+            np.random.seed(4)
+            S, I, R = spatial_simulation_checkpointed(0.1, 0.03, 0.02, 2000, 30, filename, every=4, stop=13)
+            self.assertEqual(len(S), 14)
+            np.random.seed(1)
+            self.assertEqual(spatial_simulation_checkpointed(0.1, 0.03, 0.02, 2000, 30, filename, every=4), expected)
+
+
+class TestService(unittest.TestCase):
+    '''
+    Test the asynchronous simulation service
+    '''
+    def test_stream_and_dedup(self):
+        '''
+        Test that identical requests share one run, that rows stream as the run progresses and that results match the entry points
+        '''
+        async def main():
+            async with SimulationService(workers=1) as service:
+                params = {'n': 500, 'b': 2, 'k': 0.3, 't': 30}
+                job = service.submit('discreteSim', params, seed=1)
+                self.assertIs(service.submit('discreteSim', dict(params, profiler=None), seed=1), job)
+                rows = [row async for row in job]
+                result = await job
+                ode = await service.run('odeSim', {'n': 1000, 't': 50})
+            return rows, result, ode
+
+        rows, result, ode = asyncio.run(main())
+        np.random.seed(1)
+        S, I, R = simulateSIR(500, 2, 0.3, 30)
+        self.assertTrue(np.array_equal(result['I'], I))
+        self.assertEqual([row['I'] for row in rows], list(I))
+        self.assertTrue(np.allclose(ode['s'], odeSim(1000, t=50).solve_odes().y[0]))
+
+    def test_cancel(self):
+        '''
+        Test that cancelling a streaming run stops it and that a new identical request starts a new run
+        '''
+        async def main():
+            async with SimulationService(workers=1) as service:
+                params = {'k': 0.01, 'q': 0.01, 'p': 0.01, 'n': 5000, 't': 10000}
+                job = service.submit('discreteSim_spatial', params, seed=2)
+                async for row in job:
+                    if row['step'] >= 2:
+                        job.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await job
+                self.assertIsNot(service.submit('discreteSim_spatial', params, seed=2), job)
+                return len(job.rows)
+
+        self.assertLess(asyncio.run(main()), 100)
+
+    def test_event_loops(self):
+        '''
+        Test that services follow asyncio.run to new event loops and that leaving a service cancels its runs on the loop
+        '''
+        async def final_infected(service=None):
+            result = await run_async('odeSim', {'n': 100, 't': 20}, service=service)
+            return result['i'][-1], service or default_service()
+
+        first, service_1 = asyncio.run(final_infected())
+        second, service_2 = asyncio.run(final_infected())
+        self.assertEqual(first, second)
+        self.assertIsNot(service_1, service_2)
+        self.assertIsNone(service_1.executor)
+
+        service = SimulationService(workers=1)
+        self.assertEqual(asyncio.run(final_infected(service))[0], first)
+        self.assertEqual(asyncio.run(final_infected(service))[0], first)
+        service.close()
+
+        async def leave():
+            async with SimulationService(workers=1) as service:
+                task = asyncio.create_task(service.run('discreteSim_spatial', {'k': 0.01, 'q': 0.01, 'p': 0.01,
+                                                                               'n': 5000, 't': 10000}, seed=2))
+                await asyncio.sleep(0.2)
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        # Debug mode raises on callbacks of the loop scheduled from another thread
+        asyncio.run(leave(), debug=True)
+
+
+class TestGenerators(unittest.TestCase):
+    '''
+    Test the generator versions of the engines
+    '''
+    def test_same_counts(self):
+        '''
+        Test that the generators yield the same daily counts as the functions returning whole histories
+        '''
+        np.random.seed(1)
+        expected = simulateSIR(500, 2, 0.3, 20)
+        np.random.seed(1)
+        rows = list(iter_simulateSIR(500, 2, 0.3, 20))
+        self.assertEqual([row['I'] for row in rows], list(expected[1]))
+
+        for backend in (None, 'numpy'):
+            np.random.seed(2)
+            expected = discrete_spatial_simulation(0.1, 0.04, 0.02, 500, 15, backend=backend)
+            np.random.seed(2)
+            rows = list(iter_discrete_spatial_simulation(0.1, 0.04, 0.02, 500, 15, backend=backend))
+            self.assertEqual([row['R'] for row in rows], expected[2])
+
+        np.random.seed(3)
+        expected = runSimulation(0.1, 0.05, n=300, t=15, L=5)
+        np.random.seed(3)
+        rows = list(iter_runSimulation(0.1, 0.05, n=300, t=15, L=5))
+        self.assertEqual([row['S'] for row in rows], expected[0])
+
+    def test_unbounded_and_snapshots(self):
+        '''
+        Test that a run without t stops when the consumer does and that snapshots agree with the counts
+        '''
+        np.random.seed(4)
+        for row in iter_discrete_spatial_simulation(0.2, 0.04, 0.02, 400, t=None, backend='numpy', snapshot=True):
+            self.assertEqual(np.bincount(row['states'], minlength=3).tolist(), [row['S'], row['I'], row['R']])
+            self.assertEqual(row['positions'].dtype, np.float32)
+            if row['I'] == 0:
+                break
+        self.assertEqual(row['S'] + row['R'], 400)
+
+        days = iter_simulateSIR(100, 2, 0.5, snapshot=True)
+        for row in days:
+            if row['day'] == 3:
+                break
+        days.close()
+        self.assertEqual(int((row['states'] == 1).sum()), row['I'])
+
+
+class TestSensitivity(unittest.TestCase):
+    '''
+    Test the Sobol and Morris sensitivity analyses
+    '''
+    def test_sobol_ishigami(self):
+        '''
+        Test the Sobol indices of the Ishigami function against their analytic values
+        '''
+        def ishigami(X):
+            return np.sin(X[:, 0]) + 7 * np.sin(X[:, 1])**2 + 0.1 * X[:, 2]**4 * np.sin(X[:, 0])
+
+        bounds = {'x1': (-np.pi, np.pi), 'x2': (-np.pi, np.pi), 'x3': (-np.pi, np.pi)}
+        indices = sobol_analysis(ishigami, bounds, 2**12, seed=1, num_resamples=100)
+        self.assertTrue(np.allclose(indices['S1'], [0.314, 0.442, 0.0], atol=0.03))
+        self.assertTrue(np.allclose(indices['ST'], [0.558, 0.442, 0.244], atol=0.03))
+        self.assertTrue(np.all(indices['S1_conf'][0] <= indices['S1']) and np.all(indices['S1'] <= indices['S1_conf'][1]))
+
+    def test_morris_linear(self):
+        '''
+        Test that the Morris effects of a linear model are its coefficients times the parameter ranges
+        '''
+        bounds = {'a': (0.0, 1.0), 'b': (0.0, 2.0), 'c': (-1.0, 1.0)}
+        effects = morris_analysis(lambda X: 3 * X[:, 0] - X[:, 1], bounds, 10, seed=0)
+        self.assertTrue(np.allclose(effects['mu'], [3, -2, 0]))
+        self.assertTrue(np.allclose(effects['sigma'], 0))
+
+    def test_engine_cache(self):
+        '''
+        Test that engine runs of a design match single runs and that a repeated evaluation comes from the cache
+        '''
+        bounds = {'b': (1, 4), 'k': (0.1, 0.5)}
+        X = saltelli_sample(bounds, 4, seed=0)
+        self.assertTrue(np.all(X[:, 0] == np.round(X[:, 0])))
+        self.assertEqual(integer_flags(bounds), [True, False])
+        self.assertEqual(integer_flags({'b': (np.int64(1), np.int64(4)), 'k': (np.float64(0.1), 0.5)}), [True, False])
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory)
+            Y = evaluate('discreteSim', X, ['b', 'k'], {'n': 200, 't': 30}, seed=3,
+                         output='final_recovered', workers=1, cache=cache, chunk=7, integer=integer_flags(bounds))
+            np.random.seed(3)
+            self.assertEqual(Y[5], simulateSIR(200, int(X[5, 0]), X[5, 1], 30)[2][-1])
+            self.assertEqual(len(os.listdir(directory)), 3)
+            again = evaluate('discreteSim', X, ['b', 'k'], {'n': 200, 't': 30}, seed=3,
+                             output='final_recovered', workers=1, cache=ResultCache(directory), chunk=7,
+                             integer=integer_flags(bounds))
+            self.assertTrue(np.array_equal(Y, again))
+
+
+class TestEmulator(unittest.TestCase):
+    '''
+    Test the Gaussian process emulator of the engines
+    '''
+    def test_accuracy_and_fallback(self):
+        '''
+        Test that the emulator of a smooth model is accurate within its uncertainty and runs the model where it is uncertain
+        '''
+        def model(X):
+            return np.sin(3 * X[:, 0]) * X[:, 1] + X[:, 1]**2
+
+        emulator = Emulator(model, {'a': (0.0, 2.0), 'b': (0.0, 1.0)}).train(32)
+        X = np.random.default_rng(0).random((500, 2)) * [2, 1]
+        mean, std = emulator.predict(X)
+        self.assertLess(np.abs(mean - model(X)).max(), 0.02)
+        self.assertGreater(np.mean(np.abs(mean - model(X)) <= 3 * std + 1e-4), 0.95)
+
+        # Far outside the design the emulator is uncertain, so the model is run and learned
+        value, std = emulator.query({'a': 3.5, 'b': 0.5}, max_std=0.05)
+        self.assertEqual((emulator.runs, std), (33, 0))
+        self.assertAlmostEqual(value, model(np.array([[3.5, 0.5]]))[0])
+        self.assertLess(emulator.predict({'a': 3.5, 'b': 0.5})[1][0], 0.05)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'emulator.npz')
+            emulator.save(filename)
+            loaded = Emulator(model, {'a': (0.0, 2.0), 'b': (0.0, 1.0)}).load(filename)
+            self.assertTrue(np.allclose(loaded.predict(X)[0], emulator.predict(X)[0]))
+
+    def test_untrained(self):
+        '''
+        Test that an untrained emulator refuses queries and can be saved and loaded
+        '''
+        def model(X):
+            return X[:, 0] * X[:, 1]
+
+        emulator = Emulator(model, {'a': (0.0, 1.0), 'b': (0.0, 1.0)})
+        with self.assertRaises(RuntimeError):
+            emulator.predict({'a': 0.5, 'b': 0.5})
+        with self.assertRaises(RuntimeError):
+            emulator.query({'a': 0.5, 'b': 0.5})
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'emulator.npz')
+            emulator.save(filename)
+            loaded = Emulator(model, {'a': (0.0, 1.0), 'b': (0.0, 1.0)}).load(filename)
+            self.assertEqual(len(loaded.X), 0)
+
+    def test_factor_update(self):
+        '''
+        Test that extending the Cholesky factor by new points agrees with refactorizing
+        '''
+        rng = np.random.default_rng(0)
+        X = rng.random((60, 2))
+        y = np.sin(3 * X[:, 0]) * X[:, 1]
+        extended = GaussianProcess().fit(X[:50], y[:50]).fit(X, y, optimize=False)
+        refactorized = GaussianProcess()
+        refactorized.theta = extended.theta
+        refactorized.fit(X, y, optimize=False)
+        Q = rng.random((20, 2))
+        for a, b in zip(extended.predict(Q), refactorized.predict(Q)):
+            self.assertTrue(np.allclose(a, b, atol=1e-6))
+
+    def test_engine(self):
+        '''
+        Test an emulator of the attack rate of odeSim over b and k
+        '''
+        emulator = Emulator('odeSim', {'b': (0.5, 2.0), 'k': (0.1, 0.3)}, params={'n': 1000, 't': 200},
+                            workers=1).train(16)
+        value, std = emulator.query({'b': 1.0, 'k': 0.2}, max_std=0.02)
+        sol = odeSim(1000, 1.0, 0.2, 200).solve_odes()
+        self.assertAlmostEqual(value, sol.y[2][-1] / sol.y[:, 0].sum(), delta=max(3 * std, 0.01))
+
+
+class TestInference(unittest.TestCase):
+    '''
+    Test the likelihood free inference of the stochastic engines
+    '''
+    def test_kernels(self):
+        '''
+        Test that the count kernels keep the population and follow the mean of the per person models
+        '''
+        counts = simulate_counts('varsim_tori', {'b': 3, 'k': 0.3, 'a': 0.5, 'c': 0.8}, 200, 30,
+                                 particles=2000, seed=1)
+        self.assertTrue(np.all(counts.sum(axis=2) == 200))
+        self.assertTrue(np.all(counts >= 0))
+
+        np.random.seed(0)
+        R = np.array([simulateSIR(200, 2, 0.3, 30)[2] for i in range(40)])
+        R_counts = simulate_counts('discreteSim', {'b': 2, 'k': 0.3}, 200, 30, particles=4000, seed=2)[:, :, 2]
+        self.assertLess(np.abs(R.mean(axis=0) - R_counts.mean(axis=0)).max(), 10)
+
+    def test_abc_smc(self):
+        '''
+        Test that ABC-SMC recovers b and k of a synthetic epidemic, with the same result on any number of workers
+        '''
+        counts = simulate_counts('discreteSim', {'b': 3, 'k': 0.3}, 1000, 40, seed=1)[0]
+        data = {'I': counts[:, 1], 'R': counts[:, 2]}
+        posterior = abc_smc('discreteSim', data, 1000, {'b': (0.5, 5), 'k': (0.05, 0.6)}, particles=300,
+                            generations=5, workers=1)
+        mean = posterior.mean()
+        self.assertAlmostEqual(mean['b'], 3, delta=0.6)
+        self.assertAlmostEqual(mean['k'], 0.3, delta=0.06)
+        self.assertAlmostEqual(posterior.weights.sum(), 1)
+        self.assertTrue(np.all(np.diff(posterior.epsilons) < 0))
+
+        small = [abc_smc('discreteSim', data, 1000, {'b': (0.5, 5)}, {'k': 0.3}, particles=100, generations=2,
+                         workers=workers, chunk=32).particles for workers in (1, 2)]
+        self.assertTrue(np.array_equal(*small))
+
+    def test_particle_filter(self):
+        '''
+        Test that the particle filter likelihood is highest at the true parameters
+        '''
+        counts = simulate_counts('discreteSim', {'b': 3, 'k': 0.3}, 1000, 40, seed=1)[0]
+        data = {'I': counts[:, 1]}
+        result = bootstrap_filter('discreteSim', data, 1000, {'b': 3, 'k': 0.3}, particles=500, seed=0)
+        self.assertEqual(result['mean'].shape, (40, 3))
+        self.assertTrue(np.all(result['ess'] <= 500))
+
+        log_likelihood = particle_log_likelihood('discreteSim', data, 1000, [[3, 0.3], [2, 0.3], [3, 0.45]],
+                                                 ['b', 'k'], particles=500, workers=1)
+        self.assertAlmostEqual(log_likelihood[0], result['log_likelihood'], delta=10)
+        self.assertEqual(np.argmax(log_likelihood), 0)